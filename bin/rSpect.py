@@ -24,12 +24,52 @@ import robospect as RS
 
 def main(args=None):
     if args is None:
-        args = sys.argv
-        args.pop(0)  ## Remove script name
+        args = sys.argv[1:]  ## Remove script name
+    if "--serve" in args:
+        # Run a fitting server; the remaining options apply to every request.
+        index = args.index("--serve")
+        address = args[index + 1]
+        del args[index:index + 2]
+        workers = None
+        if "--workers" in args:
+            index = args.index("--workers")
+            workers = int(args[index + 1])
+            del args[index:index + 2]
+        RS.server.serve(address, args=args, workers=workers)
+        return
+
+    if "--enqueue" in args:
+        # Add the spectra to a shared work queue, to be fit by workers.
+        index = args.index("--enqueue")
+        path = args[index + 1]
+        del args[index:index + 2]
+        config = RS.Config(args)
+        queue = RS.workqueue.WorkQueue(path, stale=config.queue_stale)
+        queue.enqueue(config.spectrum_files,
+                      [RS.Pipeline.path_base(config.path_base, f) for f in config.spectrum_files])
+        print(queue.counts())
+        return
+    if "--worker" in args:
+        # Fit spectra from a shared work queue until it is empty.
+        index = args.index("--worker")
+        path = args[index + 1]
+        del args[index:index + 2]
+        config = RS.Config(args)
+        queue = RS.workqueue.WorkQueue(path, stale=config.queue_stale)
+        RS.workqueue.work(config, queue, heartbeat=config.queue_heartbeat)
+        return
+
     config  = RS.Config(args)
-    spectra = config.read_spectrum()
-    results = spectra.fit()
-    config.write_results(spectra)
+    if len(config.spectrum_files) > 1:
+        pipeline = RS.Pipeline(config, read_depth=config.read_queue,
+                               write_depth=config.write_queue,
+                               fit_workers=config.fit_workers)
+        pipeline.run(config.spectrum_files)
+    else:
+        spectra = config.read_spectrum()
+        config.fit_spectrum(spectra)
+        config.write_results(spectra)
+    config.wait_for_plots()
 
 if __name__ == "__main__":
     main()
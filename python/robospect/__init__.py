@@ -18,11 +18,35 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
+import importlib
+
 from . import models
+from . import kernels
+from . import registry
 from .flags import *
 from .lines import *
 from .spectra import *
 from .config import *
 from .io import *
-from .models import *
+
+# Modules only needed for batch processing, tiling, caching or the
+# server, which import threading, sqlite3, asyncio and so on, are
+# imported on first use.
+_lazy_modules = ('pipeline', 'tiling', 'server', 'cache', 'workqueue')
+_lazy_names = {'Pipeline': 'pipeline', 'StageStats': 'pipeline'}
+
+
+def __getattr__(name):
+    # The models are imported on first use; see robospect.models.
+    if name in models.__all__:
+        return getattr(models, name)
+    if name in _lazy_modules:
+        return importlib.import_module(f".{name}", __name__)
+    if name in _lazy_names:
+        return getattr(importlib.import_module(f".{_lazy_names[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(models.__all__) | set(_lazy_modules) | set(_lazy_names))
 
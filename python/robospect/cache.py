@@ -0,0 +1,273 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import zipfile
+
+import numpy as np
+
+__all__ = ['ResultCache', 'IGNORED_PARAMETERS']
+
+CACHE_VERSION = 2
+
+# Arrays of the fit result that are stored.
+RESULT_ARRAYS = ('x', 'continuum', 'lines', 'alternate', 'error')
+
+# Fitting parameters that only control input, output or scheduling,
+# and so do not change the fit result.
+IGNORED_PARAMETERS = frozenset(['spectrum_file', 'spectrum_files', 'line_list', 'line_cache',
+                                'line_margin', 'cache_dir', 'path_base', 'output',
+                                'plot_all', 'plot_lines', 'plot_background', 'plot_workers',
+                                'read_queue', 'write_queue', 'fit_workers', 'tile_workers',
+                                'out_of_core', 'result_cache', 'result_cache_size',
+                                'result_cache_bypass', 'executor', 'workers',
+                                'queue_stale', 'queue_heartbeat'])
+
+
+class ResultCache():
+    r"""On disk cache of fit results, with least recently used eviction.
+
+    Parameters
+    ----------
+    directory : `str`
+        Directory holding the cached results.
+    max_size : `int`, optional
+        Maximum total size of the cached results, in bytes.
+
+    Notes
+    -----
+    Each result is stored in a `.npz` file named by its key, holding
+    the result arrays and the line catalog as JSON, so loading a result
+    never runs code from the cache.  The file's modification time is
+    updated whenever it is used, and the least recently used results
+    are removed once the cache exceeds `max_size`.  The total size is
+    found by scanning the directory once, and then tracked as results
+    are stored, so the directory is only scanned again when the total
+    is exceeded.  Results stored by other processes are not tracked
+    until then.  Files are written to a temporary name and renamed, so
+    several processes may share one cache, and the counters are
+    locked, so several threads may share one `ResultCache`.
+    """
+    def __init__(self, directory, max_size=1 << 30):
+        self.directory = directory
+        self.max_size = int(max_size)
+        self.log = logging.getLogger(__name__)
+        self.hits = 0
+        self.misses = 0
+        self.size = None
+        self._lock = threading.RLock()
+
+    def key(self, spectrum, arg_dict):
+        r"""Construct the cache key for a spectrum that is ready to fit.
+
+        Parameters
+        ----------
+        spectrum : `robospect.spectra.spectrum`
+            Spectrum with its input data and line list.
+        arg_dict : `dict` of `dict`
+            Per-phase configuration, as in `Config.arg_dict`.
+
+        Returns
+        -------
+        key : `str`
+            Hex digest of the input arrays, the line list, the model
+            classes, and the configuration, excluding the
+            `IGNORED_PARAMETERS`.
+        """
+        from robospect.config import VERSION
+
+        h = hashlib.sha256()
+        h.update(f"{CACHE_VERSION} {VERSION}".encode())
+        for cls in type(spectrum).__mro__:
+            h.update(f"{cls.__module__}.{cls.__qualname__};".encode())
+
+        config = {phase: {k: v for k, v in values.items() if k not in IGNORED_PARAMETERS}
+                  for phase, values in arg_dict.items()}
+        h.update(json.dumps(config, sort_keys=True, default=str).encode())
+
+        for name in ('x', 'y', 'e0'):
+            values = np.ascontiguousarray(getattr(spectrum, name), dtype=float)
+            h.update(f"{name} {len(values)};".encode())
+            h.update(memoryview(values).cast('B'))
+
+        for line in spectrum.L:
+            h.update(repr((float(line.x0), line.comment, int(line.flags.value),
+                           np.asarray(line.Q, dtype=float).tolist())).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def load(self, key, spectrum):
+        r"""Restore a cached fit result.
+
+        Parameters
+        ----------
+        key : `str`
+            Cache key, from `ResultCache.key`.
+        spectrum : `robospect.spectra.spectrum`
+            Spectrum to update in place.
+
+        Returns
+        -------
+        hit : `bool`
+            True if a result was found and restored.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                result = {name: data[name] for name in RESULT_ARRAYS}
+                catalog = json.loads(data['catalog'].tobytes().decode())
+            L = [_line_from_dict(values) for values in catalog]
+            os.utime(path)
+        except (OSError, EOFError, ValueError, KeyError, TypeError, zipfile.BadZipFile) as e:
+            if not isinstance(e, FileNotFoundError):
+                self.log.warning(f"Ignoring unreadable cached result {path}: {e}")
+            with self._lock:
+                self.misses += 1
+            return False
+
+        for name in RESULT_ARRAYS:
+            setattr(spectrum, name, result[name])
+        spectrum.L = L
+        spectrum.set_grid()
+        with self._lock:
+            self.hits += 1
+        self.log.info(f"Using cached result {key}")
+        return True
+
+    def store(self, key, spectrum):
+        r"""Add a fit result to the cache, and evict old results.
+
+        Parameters
+        ----------
+        key : `str`
+            Cache key, from `ResultCache.key`, calculated before the fit.
+        spectrum : `robospect.spectra.spectrum`
+            Fit spectrum.
+        """
+        result = {name: np.asarray(getattr(spectrum, name), dtype=float)
+                  for name in RESULT_ARRAYS}
+        catalog = json.dumps([_line_to_dict(line) for line in spectrum.L])
+        result['catalog'] = np.frombuffer(catalog.encode(), dtype=np.uint8)
+        path = self._path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with self._lock:
+                if self.size is None:
+                    self.size = self._scan()[0]
+            try:
+                replaced = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced = 0
+            fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez(f, **result)
+                size = os.path.getsize(temp)
+                os.replace(temp, path)
+            except BaseException:
+                os.unlink(temp)
+                raise
+        except OSError as e:
+            self.log.warning(f"Cannot write cached result {path}: {e}")
+            return
+        with self._lock:
+            self.size += size - replaced
+            if self.size > self.max_size:
+                self.evict()
+
+    def _scan(self):
+        """Find the cached results.
+
+        Returns
+        -------
+        total : `int`
+            Total size of the results, in bytes.
+        entries : `list` of `tuple`
+            Modification time, size and path of each result.
+        """
+        entries = []
+        try:
+            scan = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0, entries
+        for entry in scan:
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return sum(size for mtime, size, path in entries), entries
+
+    def evict(self):
+        r"""Remove the least recently used results until the cache fits.
+
+        Returns
+        -------
+        removed : `int`
+            Number of results removed.
+        """
+        with self._lock:
+            total, entries = self._scan()
+            removed = 0
+            for mtime, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self.size = total
+        return removed
+
+
+# Attributes of `robospect.lines.line` that are stored, with the
+# array valued ones first.
+_LINE_ARRAYS = ('Q', 'dQ', 'pQ')
+_LINE_VALUES = ('x0', 'chi', 'R', 'Niter', 'nfev', 'blend', 'comment')
+
+
+def _line_to_dict(line):
+    values = {name: np.asarray(getattr(line, name), dtype=float).tolist() for name in _LINE_ARRAYS}
+    for name in _LINE_VALUES:
+        value = getattr(line, name)
+        values[name] = value.item() if isinstance(value, np.generic) else value
+    values['flags'] = int(line.flags.value)
+    return values
+
+
+def _line_from_dict(values):
+    from robospect import lines
+
+    line = lines.line(values['x0'])
+    for name in _LINE_ARRAYS:
+        setattr(line, name, np.array(values[name], dtype=float))
+    for name in _LINE_VALUES:
+        setattr(line, name, values[name])
+    line.flags.value = values['flags']
+    return line
@@ -22,7 +22,8 @@ import argparse
 import logging
 
 from . import spectra
-from . import models
+from . import registry
+from . import executors
 from . import io
 
 __all__ = ['Config', 'VERSION']
@@ -44,7 +45,6 @@ class Config:
     """
     model_phases = ['repair', 'detection', 'noise', 'continuum',
                     'initial', 'line', 'deblend']
-    rs_models = dict()
 
     def __init__(self, *args, **kwargs):
         # Initialize logging code.
@@ -67,46 +67,88 @@ class Config:
         self.version = VERSION
         self.log.info(f"code version: {self.version}")
 
-        # Pack models into dict for access later
-        for rsModel in (dir(models)):
-            for modelPhase in self.model_phases:
-                if rsModel.startswith(modelPhase):
-                    model = getattr(models, rsModel)
-                    modelName = model.modelName
-                    self.rs_models.setdefault(modelPhase,
-                                              dict()).setdefault(modelName, model)
-                    self.log.debug("init: name: %s phase: %s" %
-                                   (modelName, modelPhase))
-
-        # Model selection setting
+        # Model selection setting.  Only the selected models are imported.
         for modelPhase in self.model_phases:
             modelName = self.arg_dict[modelPhase].get("name", None)
             if modelName is None:
                 setattr(self, f"{modelPhase}_model", None)
             else:
                 setattr(self, f"{modelPhase}_model",
-                        self.rs_models[modelPhase][modelName])
+                        registry.get_model(modelPhase, modelName))
+                self.log.debug("init: name: %s phase: %s" %
+                               (modelName, modelPhase))
 
         # This almost certainly needs to be fixed and updated.
         # Set defaults
         if self.continuum_model is None:
-            self.continuum_model = self.rs_models["continuum"]["boxcar"]
+            self.continuum_model = registry.get_model("continuum", "boxcar")
         if self.detection_model is None:
-            self.detection_model = self.rs_models["detection"]["naive"]
+            self.detection_model = registry.get_model("detection", "naive")
         if self.initial_model is None:
-            self.initial_model = self.rs_models["line"]["pre"]
+            self.initial_model = registry.get_model("initial", "pre")
         if self.line_model is None:
-            self.line_model = self.rs_models["line"]["mp_nlls"]
+            self.line_model = registry.get_model("line", "mp_nlls")
+        # The fused continuum sets the error itself, and a noise
+        # model would silently replace it.
+        if self.noise_model is not None and self.continuum_model.modelName == 'fusedbox':
+            raise RuntimeError("The fusedbox continuum also estimates the noise; "
+                               "no noise model can be selected with it.")
 
         # Handle fitting arguments
         fittingArgs = self.arg_dict["fitting"]
         self.spectrum_file = fittingArgs.setdefault("spectrum_file", None)
+        self.spectrum_files = fittingArgs.setdefault("spectrum_files",
+                                                     [self.spectrum_file] if self.spectrum_file else [])
         self.line_list = fittingArgs.setdefault("line_list", None)
         self.path_base = fittingArgs.setdefault("path_base", None)
         self.max_iterations = fittingArgs.setdefault("max_iterations", 1)
         self.tolerance = fittingArgs.setdefault("tolerance", 1e-3)
         self.output = fittingArgs.setdefault("output", "/tmp/rs")
         self.plot_all = fittingArgs.setdefault("plot_all", False)
+        if self.plot_all in (True, "True", "true", "1"):
+            self.plot_lines = fittingArgs.setdefault("plot_lines", "all")
+        else:
+            self.plot_lines = fittingArgs.setdefault("plot_lines", "supplied")
+        self.plot_background = fittingArgs.setdefault("plot_background", True)
+        if self.plot_background in ("False", "false", "0"):
+            self.plot_background = False
+        self.plot_jobs = []
+        self.plot_workers = int(fittingArgs.setdefault("plot_workers", 2))
+        self.read_queue = int(fittingArgs.setdefault("read_queue", 2))
+        self.write_queue = int(fittingArgs.setdefault("write_queue", 2))
+        self.fit_workers = int(fittingArgs.setdefault("fit_workers", 1))
+        # These are not added to the fitting parameters, as those are
+        # passed to every phase.
+        self.executor = fittingArgs.get("executor", "process")
+        self.workers = int(fittingArgs.get("workers", 0))
+        for executor in [phase_args['executor'] for phase_args in self.arg_dict.values()
+                         if 'executor' in phase_args]:
+            if executor not in executors.EXECUTORS:
+                raise RuntimeError(f"No such executor: {executor}")
+        self.tiles = int(fittingArgs.setdefault("tiles", 1))
+        self.tile_workers = int(fittingArgs.setdefault("tile_workers", 0))
+        self.tile_halo = fittingArgs.setdefault("tile_halo", None)
+        if self.tile_halo is not None:
+            self.tile_halo = float(self.tile_halo)
+        self.out_of_core = fittingArgs.setdefault("out_of_core", None)
+        self.tile_size = int(fittingArgs.setdefault("tile_size", 1 << 18))
+        self.line_cache = fittingArgs.setdefault("line_cache", True)
+        if self.line_cache in ("False", "false", "0"):
+            self.line_cache = False
+        self.line_margin = float(fittingArgs.setdefault("line_margin", 10.0))
+        self.cache_dir = fittingArgs.setdefault("cache_dir", None)
+        self.result_cache_dir = fittingArgs.setdefault("result_cache", None)
+        self.result_cache_size = float(fittingArgs.setdefault("result_cache_size", 1024))
+        self.result_cache_bypass = fittingArgs.setdefault("result_cache_bypass", False)
+        if self.result_cache_bypass in ("False", "false", "0"):
+            self.result_cache_bypass = False
+        self.queue_stale = float(fittingArgs.setdefault("queue_stale", 300.0))
+        self.queue_heartbeat = float(fittingArgs.setdefault("queue_heartbeat", 30.0))
+        self.result_cache = None
+        if self.result_cache_dir is not None:
+            from . import cache
+            self.result_cache = cache.ResultCache(self.result_cache_dir,
+                                                  max_size=self.result_cache_size * (1 << 20))
 
         self.iteration = 0
 
@@ -194,7 +236,8 @@ class Config:
         backwardsCompatParser.add_argument('-O', "--output",
                                            help="Output filename.")
         # backwardsCompatParser.add_argument('-I', "--save_temp", )
-        # backwardsCompatParser.add_argument('-A', "--plot_all", )
+        backwardsCompatParser.add_argument('-A', "--plot_all", action='store_true',
+                                           help="Plot all lines, not just those supplied.")
         # backwardsCompatParser.add_argument('', "--flux_calibrated", )
         # backwardsCompatParser.add_argument('-r', "--deblend_radius", nargs=1)
         # backwardsCompatParser.add_argument('', "--deblend_ratio", nargs=1)
@@ -204,12 +247,17 @@ class Config:
         # backwardsCompatParser.add_argument('', "--wavelength_min_error", nargs=1)
         # backwardsCompatParser.add_argument('', "--wavelength_max_error", nargs=1)
         # backwardsCompatParser.add_argument('', "--wavelength_limit", nargs=1)
-        # backwardsCompatParser.add_argument('', "--radial_velocity", nargs=1)
-        # backwardsCompatParser.add_argument('', "--measure_radial_velocity", nargs=1)
-        # backwardsCompatParser.add_argument('', "--radial_velocity_range", nargs=1)
+        backwardsCompatParser.add_argument("--radial_velocity", type=float,
+                                           help="Known radial velocity (in km/s) to apply to the line list.")
+        backwardsCompatParser.add_argument("--measure_radial_velocity", action='store_true',
+                                           help="Measure the radial velocity by cross-correlation.")
+        backwardsCompatParser.add_argument("--radial_velocity_range", type=float,
+                                           help="Largest radial velocity (in km/s) to search.")
         # backwardsCompatParser.add_argument('', "--radial_velocity_error", nargs=1)
-        # backwardsCompatParser.add_argument('', "--radial_velocity_step", nargs=1)
-        # backwardsCompatParser.add_argument('', "--radial_velocity_sigma", nargs=1)
+        backwardsCompatParser.add_argument("--radial_velocity_step", type=float,
+                                           help="Velocity resolution (in km/s) of the cross-correlation.")
+        backwardsCompatParser.add_argument("--radial_velocity_sigma", type=float,
+                                           help="Template line width (in km/s) for the cross-correlation.")
         # backwardsCompatParser.add_argument('', "--loosen", )
         # backwardsCompatParser.add_argument('', "--strict_center", )
         # backwardsCompatParser.add_argument('', "--strict_width", )
@@ -249,9 +297,27 @@ class Config:
             arguments['fitting']['line_list'] = BCparsed.line_list
         if "output" in vars(BCparsed).keys():
             arguments['fitting']['output'] = BCparsed.output
+        if BCparsed.plot_all:
+            arguments['fitting']['plot_all'] = True
+
+        radialVelocity = {'velocity': BCparsed.radial_velocity,
+                          'velocity_range': BCparsed.radial_velocity_range,
+                          'velocity_step': BCparsed.radial_velocity_step,
+                          'template_sigma': BCparsed.radial_velocity_sigma}
+        radialVelocity = {k: v for k, v in radialVelocity.items() if v is not None}
+        if BCparsed.measure_radial_velocity:
+            radialVelocity['measure'] = True
+        if len(radialVelocity) > 0:
+            arguments['repair'].setdefault('name', 'rv')
+            arguments['repair'].update(radialVelocity)
 
         if len(unparsed) > 0:
             arguments['fitting']['spectrum_file'] = unparsed.pop(0)
+        # Any further filenames are fit in a batch.
+        additional = [u for u in unparsed if not u.startswith('-')]
+        if len(additional) > 0:
+            arguments['fitting']['spectrum_files'] = [arguments['fitting']['spectrum_file']] + additional
+            unparsed = [u for u in unparsed if u.startswith('-')]
         if len(unparsed) > 0:
             self.log.warning(f"Unparsed arguments: {unparsed}")
 
@@ -262,31 +328,147 @@ class Config:
 
         if spectrum_file is not None:
             self.spectrum_file = spectrum_file
-        S = io.read_ascii_spectrum(self.spectrum_file, spectrum=S)
-        S.L = io.read_ascii_linelist(self.line_list, lines=None) if self.line_list is not None else []
+        if self.out_of_core is not None:
+            S = io.read_ascii_spectrum_memmap(self.spectrum_file, self.out_of_core, spectrum=S)
+        else:
+            S = io.read_ascii_spectrum(self.spectrum_file, spectrum=S)
+        S.L = self.read_line_list(S)
         S.log.debug(f"spectrum structure: {dir(S)}")
 
         return S
 
-    def write_results(self, spectrum):
+    def read_line_list(self, spectrum, line_list=None):
+        """Read the supplied lines that may be measured in a spectrum.
+
+        Parameters
+        ----------
+        spectrum : `robospect.spectra.spectrum`
+            Spectrum the lines will be fit in.
+        line_list : `str`, optional
+            Line list filename, overriding the configured `line_list`.
+
+        Returns
+        -------
+        lines : `list` of `robospect.lines.line`
+            Sorted list of lines.
+
+        Notes
+        -----
+        Unless `line_cache` is false, the line list is read from the
+        binary cache in `cache_dir`, and only lines within
+        `line_margin` of the spectrum (widened by the radial velocity
+        search range, if any) are returned.
+        """
+        if line_list is None:
+            line_list = self.line_list
+        if line_list is None:
+            return []
+        if self.line_cache is False or len(spectrum.x) == 0:
+            return io.read_ascii_linelist(line_list, lines=None)
+
+        low = float(spectrum.min())
+        high = float(spectrum.max())
+        margin = self.line_margin
+        if hasattr(spectrum, 'velocity_range'):
+            from .models.repair_rv import SPEED_OF_LIGHT
+            velocity = abs(spectrum.velocity) + abs(spectrum.velocity_range)
+            margin += max(abs(low), abs(high)) * velocity / SPEED_OF_LIGHT
+        return io.read_linelist_cached(line_list, low - margin, high + margin,
+                                       cache_dir=self.cache_dir)
+
+    def fit_spectrum(self, spectrum):
+        """Fit a spectrum, split into `tiles` segments if requested.
+
+        Out of core spectra are always split, into segments of at
+        most `tile_size` pixels.  If a `result_cache` directory is
+        configured, a previous result for the same input and
+        configuration is reused; `result_cache_bypass` refits and
+        replaces it.  Out of core spectra are not cached.
+
+        Parameters
+        ----------
+        spectrum : `robospect.spectra.spectrum`
+            Spectrum to fit in place.
+
+        Returns
+        -------
+        spectrum : `robospect.spectra.spectrum`
+            The fit spectrum.
+        """
+        key = None
+        if self.result_cache is not None and self.out_of_core is None:
+            key = self.result_cache.key(spectrum, self.arg_dict)
+            if self.result_cache_bypass is False and self.result_cache.load(key, spectrum):
+                return spectrum
+
+        tiles = self.tiles
+        if self.out_of_core is not None:
+            tiles = max(tiles, -(-len(spectrum.x) // max(self.tile_size, 1)))
+        if tiles > 1:
+            from . import tiling
+            tiling.fit_tiled(spectrum, tiles, workers=self.tile_workers,
+                             halo=self.tile_halo)
+        else:
+            spectrum.fit()
+
+        if key is not None:
+            self.result_cache.store(key, spectrum)
+        return spectrum
+
+    def write_results(self, spectrum, path_base=None):
+        """Write the fit catalog, spectrum, and line plots.
+
+        Parameters
+        ----------
+        spectrum : `robospect.spectra.spectrum`
+            Fit spectrum to write.
+        path_base : `str`, optional
+            Output path base, overriding the configured `path_base`.
+        """
         if spectrum is None:
             raise RuntimeError("No spectrum supplied for writing.")
-        if self.path_base is None:
+        if path_base is None:
+            path_base = self.path_base
+        if path_base is None:
             outfile = None
             outfile2 = None
         else:
             if self.iteration < self.max_iterations - 1 and False:
-                outfile = ("%s.iter%d.robolines" % (self.path_base, self.iteration))
-                outfile2 = ("%s.iter%d.robospect" % (self.path_base, self.iteration))
+                outfile = ("%s.iter%d.robolines" % (path_base, self.iteration))
+                outfile2 = ("%s.iter%d.robospect" % (path_base, self.iteration))
             else:
-                outfile = ("%s.robolines" % (self.path_base))
-                outfile2 = ("%s.robospect" % (self.path_base))
+                outfile = ("%s.robolines" % (path_base))
+                outfile2 = ("%s.robospect" % (path_base))
         io.write_ascii_catalog(outfile, spectrum.L)
         io.write_ascii_spectrum(outfile2, spectrum)
 
-        if self.path_base is not None:
-            io.plots.plot_lines(spectrum, output=f"{self.path_base}.pdf",
-                                width=5.0, all=False)
+        if path_base is not None and self.plot_lines != "none":
+            # Limit the number of rendering processes in a batch.
+            self.plot_jobs = [job for job in self.plot_jobs if job.is_alive() or job.exitcode != 0]
+            while len([job for job in self.plot_jobs if job.is_alive()]) >= max(self.plot_workers, 1):
+                next(job for job in self.plot_jobs if job.is_alive()).join()
+            job = io.plots.plot_lines(spectrum, output=f"{path_base}.pdf",
+                                      width=5.0, which=self.plot_lines,
+                                      background=self.plot_background is not False)
+            if job is not None:
+                self.plot_jobs.append(job)
+
+    def wait_for_plots(self):
+        """Wait for any background plot rendering to finish.
+
+        Raises
+        ------
+        RuntimeError :
+            Raised if a rendering process failed.
+        """
+        jobs, self.plot_jobs = self.plot_jobs, []
+        failed = []
+        for job in jobs:
+            job.join()
+            if job.exitcode != 0:
+                failed.append(job.name)
+        if len(failed) > 0:
+            raise RuntimeError(f"Plot rendering failed: {failed}")
 
     def construct_spectra_class(self, *args, **kwargs):
         r"""Construct the spectra class.
@@ -297,11 +479,12 @@ class Config:
 
         Notes
         -----
-        I would like this to be able to append the correct entries to
-        the inheritance list by name, instead of relying on the
-        sub-class being set in the configuration class.
+        The composed class is cached by `registry.compose`, so every
+        spectrum read with the same models shares one class.
         """
         inheritance_list = []
+        if self.repair_model is not None:
+            inheritance_list.append(self.repair_model)
         if self.detection_model is not None:
             inheritance_list.append(self.detection_model)
         if self.noise_model is not None:
@@ -313,30 +496,8 @@ class Config:
         if self.line_model is not None:
             inheritance_list.append(self.line_model)
         inheritance_list.append(spectra.spectrum)
-
-        inheritance = tuple(inheritance_list)
         for i in inheritance_list:
             self.log.debug(i)
 
-        class Spectra(*inheritance):
-            def __init__(self, *args, **kwargs):
-                if "verbose" in kwargs.keys():
-                    self.verbose = kwargs["verbose"]
-                    self.log = logging.getLogger("robospect.spectra")
-                    self.log.setLevel(self.verbose)
-                super().__init__(*args, **kwargs)
-
-            def copy_data(self, spectrum):
-                self.x = spectrum.x
-                self.y = spectrum.y
-                self.e0 = spectrum.e0
-                self.comment = spectrum.comment
-
-                self.continuum = spectrum.continuum
-                self.lines = spectrum.lines
-                self.alternate = spectrum.alternate
-                self.error = spectrum.error
-                self.L = spectrum.L
-                self.filename = spectrum.filename
-
+        Spectra = registry.compose(inheritance_list)
         return Spectra(*args, **kwargs, verbose=self.verbose)
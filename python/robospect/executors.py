@@ -0,0 +1,170 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import logging
+import os
+import sys
+
+__all__ = ['EXECUTORS', 'default_workers', 'gil_enabled', 'process_context', 'get_pool', 'SerialPool']
+
+EXECUTORS = ('serial', 'thread', 'process', 'freethread')
+
+
+def default_workers():
+    """Number of processors this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def process_context():
+    """Return the multiprocessing context used to start worker processes.
+
+    Returns
+    -------
+    context : `multiprocessing.context.BaseContext`
+        The `forkserver` context where it is available, and `spawn`
+        otherwise.
+
+    Notes
+    -----
+    The fits may run in threads of a `robospect.Pipeline`, next to
+    threads that read, write and log.  A process forked from there can
+    inherit a lock held by one of those threads, and block on it, so
+    worker processes are never forked from the calling process.  The
+    fork server imports numpy and scipy once, so the workers forked
+    from it start quickly.
+    """
+    import multiprocessing
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['numpy', 'scipy.optimize', 'robospect'])
+    return context
+
+
+def gil_enabled():
+    """Return True unless this is a free-threaded interpreter running without the GIL."""
+    is_enabled = getattr(sys, '_is_gil_enabled', None)
+    return True if is_enabled is None else is_enabled()
+
+
+class _SerialResults():
+    """Iterator over results computed as they are requested."""
+    def __init__(self, results):
+        self.results = iter(results)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.results)
+
+    def next(self, timeout=None):
+        # The item is computed here, so it cannot be abandoned after
+        # `timeout`; the argument is accepted for compatibility.
+        return next(self.results)
+
+
+class SerialPool():
+    r"""Run work items in the calling process.
+
+    This provides the subset of the `multiprocessing.pool.Pool`
+    interface used by the models, so that the serial case does not
+    need to start processes or pickle the work items.
+    """
+    def __init__(self, processes=1):
+        self.processes = 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.terminate()
+
+    def map(self, func, iterable, chunksize=None):
+        return [func(item) for item in iterable]
+
+    def starmap(self, func, iterable, chunksize=None):
+        return [func(*item) for item in iterable]
+
+    def imap(self, func, iterable, chunksize=1):
+        return _SerialResults(func(item) for item in iterable)
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        return self.imap(func, iterable, chunksize)
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def get_pool(executor='process', workers=None):
+    """Construct the pool that runs the independent work items of a fit phase.
+
+    Parameters
+    ----------
+    executor : `str`, optional
+        One of `serial`, `thread`, `process` or `freethread`.
+        `thread` suits work that releases the GIL, such as most numpy
+        operations, and avoids pickling the work items.  `freethread`
+        uses threads on an interpreter running without the GIL, and
+        processes otherwise.
+    workers : `int`, optional
+        Number of workers.  Defaults to the number of processors
+        available.
+
+    Returns
+    -------
+    pool : `multiprocessing.pool.Pool`, `multiprocessing.pool.ThreadPool`, or `SerialPool`
+        The pool, to be used as a context manager.
+
+    Raises
+    ------
+    RuntimeError :
+        Raised if the executor is not known.
+    """
+    if executor is None:
+        executor = 'process'
+    if executor not in EXECUTORS:
+        raise RuntimeError(f"No such executor: {executor}")
+    if workers is None or int(workers) < 1:
+        workers = default_workers()
+    workers = int(workers)
+
+    if executor == 'freethread':
+        if gil_enabled():
+            logging.getLogger(__name__).info("The GIL is enabled; using processes instead of threads.")
+            executor = 'process'
+        else:
+            executor = 'thread'
+
+    if executor == 'serial' or workers == 1:
+        return SerialPool()
+
+    import multiprocessing.pool
+    if executor == 'thread':
+        return multiprocessing.pool.ThreadPool(workers)
+    return process_context().Pool(workers)
@@ -21,4 +21,5 @@
 from .ascii import *
 from .plots import *
 from .catalog import *
+from .linelist import *
 # from .fits import *
@@ -18,12 +18,18 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 import contextlib
+import itertools
+import os
+import shutil
 import sys
+import tempfile
+import weakref
 import numpy as np
 import robospect as RS
 
 
-__all__ = ['read_ascii_spectrum', 'read_ascii_linelist', 'write_ascii_spectrum']
+__all__ = ['read_ascii_spectrum', 'read_ascii_spectrum_memmap',
+           'read_ascii_linelist', 'write_ascii_spectrum']
 
 
 def read_ascii_linelist(filename, lines=None):
@@ -144,9 +150,107 @@ def read_ascii_spectrum(filename, spectrum=None):
     spectrum.lines = np.zeros(len(spectrum.x))
     spectrum.alternate = np.zeros(len(spectrum.x))
     spectrum.error = np.zeros(len(spectrum.x))
+    spectrum.set_grid()
 
     return spectrum
 
+def read_ascii_spectrum_memmap(filename, directory, spectrum=None, chunk_lines=1 << 16):
+    """Read an ascii spectrum into memory mapped arrays.
+
+    Parameters
+    ----------
+    filename : str
+        Filename containing the spectrum data.
+    directory : str
+        Directory to hold the array files.
+    spectrum : `robospect.spectra`, optional
+        An optional spectrum class containing option settings.
+    chunk_lines : int, optional
+        Number of input lines to convert at once.
+
+    Returns
+    -------
+    spectrum : `robospect.spectra`
+        The spectrum object.  Every array, including the model arrays,
+        is a `np.memmap` backed by a file in a new subdirectory of
+        `directory`, which is removed when the spectrum is deleted.
+
+    Raises
+    ------
+    RuntimeError
+       Raised if no filename is supplied.
+    IndexError
+       Raised if a line of the input file does not contain two entries
+       (wavelength and flux).
+
+    Notes
+    -----
+    The input format is as for `read_ascii_spectrum`, but comment
+    columns are not stored.  Only `chunk_lines` lines of the input are
+    held in memory, so spectra larger than memory can be read.
+    """
+    if filename is None:
+        raise RuntimeError("No spectrum filename specified.")
+
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    path = tempfile.mkdtemp(prefix=f"{stem}.", dir=directory)
+
+    N = 0
+    Nerror = 0
+    with open(filename, "r") as f, \
+         open(os.path.join(path, "x"), "wb") as fx, \
+         open(os.path.join(path, "y"), "wb") as fy, \
+         open(os.path.join(path, "e0"), "wb") as fe:
+        while True:
+            chunk = list(itertools.islice(f, chunk_lines))
+            if len(chunk) == 0:
+                break
+            x = []
+            y = []
+            e0 = []
+            for l in chunk:
+                if l.startswith("#"):
+                    continue
+                tokens = l.split()
+                if len(tokens) < 2:
+                    raise IndexError("Could not find wavelength/flux pair on line %d of file %s" %
+                                     (N + len(x), filename))
+                x.append(float(tokens[0]))
+                y.append(float(tokens[1]))
+                if len(tokens) >= 3:
+                    e0.append(float(tokens[2]))
+            fx.write(np.array(x, dtype=float).tobytes())
+            fy.write(np.array(y, dtype=float).tobytes())
+            fe.write(np.array(e0, dtype=float).tobytes())
+            N += len(x)
+            Nerror += len(e0)
+
+    if spectrum is None:
+        spectrum = RS.spectrum()
+
+    def array(name, mode, fill=None):
+        if N == 0:
+            return np.zeros(0)
+        values = np.memmap(os.path.join(path, name), dtype=float, mode=mode, shape=(N, ))
+        if fill is not None:
+            values[:] = fill
+        return values
+
+    spectrum.x = array("x", "r")
+    spectrum.y = array("y", "r")
+    spectrum.e0 = array("e0", "r") if Nerror == N and N > 0 else []
+    spectrum.comment = []
+    spectrum.filename = filename
+
+    spectrum.continuum = array("continuum", "w+", 1.0)
+    spectrum.lines = array("lines", "w+")
+    spectrum.alternate = array("alternate", "w+")
+    spectrum.error = array("error", "w+")
+    spectrum.set_grid()
+
+    weakref.finalize(spectrum, shutil.rmtree, path, True)
+    return spectrum
+
 
 ## CZW: This should be in a utilities section
 @contextlib.contextmanager
@@ -173,7 +277,7 @@ def write_ascii_spectrum(filename, spectrum=None):
         f.write("#inputWavelength inputFlux inputErrorPlacehldr modelContinuum modelError modelLines modelAlternate\n")
         for x, y, eP, c, e, l, l2 in zip(spectrum.x,
                                          spectrum.y,
-                                         np.zeros_like(spectrum.x),
+                                         itertools.repeat(0.0),
                                          spectrum.continuum,
                                          spectrum.error,
                                          spectrum.lines,
@@ -0,0 +1,204 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import hashlib
+import logging
+import os
+import tempfile
+import numpy as np
+import robospect as RS
+
+from .ascii import read_ascii_linelist
+
+__all__ = ['default_cache_dir', 'compile_linelist', 'read_linelist_cached']
+
+CACHE_VERSION = 1
+
+# Line lists loaded by this process, by cache filename.
+_loaded = dict()
+
+
+def default_cache_dir():
+    """Return the default directory for cached line lists.
+
+    Returns
+    -------
+    directory : str
+        `$XDG_CACHE_HOME/robospect`, or `~/.cache/robospect`.
+    """
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "robospect")
+
+
+def _digest(filename):
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def compile_linelist(filename, cache_file=None):
+    """Convert an ascii line list into the binary cache format.
+
+    Parameters
+    ----------
+    filename : str
+        Filename containing the line data.
+    cache_file : str, optional
+        Filename to write the cache to.  If None, nothing is written.
+
+    Returns
+    -------
+    table : dict
+        The sorted line wavelengths `x0`, their `comment` strings, and
+        the `mtime`, `size` and `digest` of the source file.
+
+    Notes
+    -----
+    The text is parsed with `read_ascii_linelist`, so the cached lines
+    are identical to those read directly.  The cache is written to a
+    temporary file and renamed, so concurrent readers never see a
+    partial file.
+    """
+    stat = os.stat(filename)
+    lines = read_ascii_linelist(filename, lines=None)
+    table = {'version': np.int64(CACHE_VERSION),
+             'mtime': np.int64(stat.st_mtime_ns),
+             'size': np.int64(stat.st_size),
+             'digest': np.str_(_digest(filename)),
+             'x0': np.array([l.x0 for l in lines], dtype=float),
+             'comment': np.array([l.comment for l in lines], dtype=str)}
+
+    if cache_file is not None:
+        _save(table, cache_file)
+    return table
+
+
+def _save(table, cache_file):
+    directory = os.path.dirname(cache_file)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **table)
+        os.replace(temp, cache_file)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def _load(filename, cache_dir):
+    """Return the current table for a line list, compiling it if needed."""
+    log = logging.getLogger(__name__)
+    source = os.path.abspath(filename)
+    cache_file = os.path.join(cache_dir, hashlib.sha1(source.encode()).hexdigest() + ".npz")
+    stat = os.stat(source)
+
+    table = _loaded.get(cache_file, None)
+    if table is None and os.path.exists(cache_file):
+        try:
+            with np.load(cache_file, allow_pickle=False) as data:
+                table = {key: data[key] for key in data.files}
+            if int(table['version']) != CACHE_VERSION:
+                table = None
+        except (OSError, ValueError, KeyError) as e:
+            log.warning(f"Ignoring unreadable line list cache {cache_file}: {e}")
+            table = None
+
+    if table is not None and (int(table['mtime']) != stat.st_mtime_ns or
+                              int(table['size']) != stat.st_size):
+        # The file has been touched; only reparse it if the contents changed.
+        if int(table['size']) == stat.st_size and str(table['digest']) == _digest(source):
+            table['mtime'] = np.int64(stat.st_mtime_ns)
+            try:
+                _save(table, cache_file)
+            except OSError as e:
+                log.warning(f"Cannot write line list cache {cache_file}: {e}")
+        else:
+            table = None
+        _loaded.pop(cache_file, None)
+
+    if table is None or cache_file not in _loaded:
+        if table is None:
+            log.debug(f"Compiling line list {source} to {cache_file}")
+            try:
+                table = compile_linelist(source, cache_file)
+            except OSError as e:
+                log.warning(f"Cannot write line list cache {cache_file}: {e}")
+                table = compile_linelist(source)
+        _loaded[cache_file] = table
+    return table
+
+
+def read_linelist_cached(filename, min_wavelength=None, max_wavelength=None,
+                         cache_dir=None):
+    """Read the lines of a line list within a wavelength range.
+
+    Parameters
+    ----------
+    filename : str
+        Filename containing the line data, in the format read by
+        `read_ascii_linelist`.
+    min_wavelength, max_wavelength : float, optional
+        Wavelength range of lines to return.  The full list is
+        returned by default.
+    cache_dir : str, optional
+        Directory holding the compiled line lists.  Defaults to
+        `default_cache_dir()`.
+
+    Returns
+    -------
+    lines : List of `robospect.lines.line`
+        Sorted list of lines in the range.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if no filename is supplied.
+
+    Flags
+    -----
+    SUPPLIED :
+        Set to note that a line came from a supplied line list.
+
+    Notes
+    -----
+    The first read of a line list stores the sorted wavelengths and
+    comments in `cache_dir`.  The cache is reused until the size or
+    contents of the file change; a changed modification time alone
+    only causes the contents to be hashed.  Only the lines inside
+    the range are constructed, found with `np.searchsorted`.
+    """
+    if filename is None:
+        raise RuntimeError("No line list supplied to read.")
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    table = _load(filename, cache_dir)
+    x0 = table['x0']
+    start = 0 if min_wavelength is None else np.searchsorted(x0, min_wavelength, side='left')
+    end = len(x0) if max_wavelength is None else np.searchsorted(x0, max_wavelength, side='right')
+
+    lines = []
+    for wavelength, comment in zip(x0[start:end].tolist(), table['comment'][start:end].tolist()):
+        new_line = RS.line(wavelength, comment=comment)
+        new_line.flags.set("SUPPLIED")
+        lines.append(new_line)
+    return lines
@@ -18,18 +18,97 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
 import numpy as np
 from robospect.spectra import spectrum
+from robospect.flags import Flags
 
 __all__ = ['plot_spectrum']
 
+def envelope_indices(x, y, bins, xmin, xmax):
+    """Select the samples that trace the min/max envelope of a series.
+
+    Parameters
+    ----------
+    x : `np.ndarray`
+        Sorted sample positions.
+    y : `np.ndarray`
+        Sample values.
+    bins : `int`
+        Number of output pixels spanning [`xmin`, `xmax`].
+    xmin, xmax : `float`
+        Plotted range.
+
+    Returns
+    -------
+    indices : `np.ndarray`
+        Sorted indices of the first, last, minimum and maximum sample
+        in each bin.  All indices are returned if there are fewer
+        than four samples per bin.
+
+    Notes
+    -----
+    A line through these samples covers the same pixels as the line
+    through every sample: in each pixel column it spans the same
+    range, and it enters and leaves the column at the same values.
+    The bin extrema come from `reduceat`, and their positions from a
+    search of the samples equal to them, so there is no per-bin loop.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    N = len(y)
+    if N <= 4 * bins or xmax <= xmin:
+        return np.arange(N)
+
+    column = np.clip(((x - xmin) * (bins / (xmax - xmin))).astype(int), 0, bins - 1)
+    starts = np.flatnonzero(np.concatenate(([True], column[1:] != column[:-1])))
+    ends = np.append(starts[1:], N) - 1
+    counts = ends - starts + 1
+
+    def first_equal(values):
+        match = np.flatnonzero(y == np.repeat(values, counts))
+        if len(match) == 0:
+            return starts
+        position = np.searchsorted(match, starts)
+        found = match[np.minimum(position, len(match) - 1)]
+        # Bins with only NaN values have no match.
+        return np.where((position < len(match)) & (found <= ends), found, starts)
+
+    low = np.fmin.reduceat(y, starts)
+    high = np.fmax.reduceat(y, starts)
+    return np.unique(np.concatenate((starts, ends, first_equal(low), first_equal(high))))
+
+
 def plot_spectrum(spectrum,
                   min=None, max=None,
                   line=None, width=None,
                   autoscale=False, output=None,
-                  errors=False):
+                  errors=False, decimate=True):
+    """Plot the spectrum and its model components.
+
+    Parameters
+    ----------
+    spectrum : `robospect.spectra.spectrum`
+        Data to plot.
+    min, max : `float`, optional
+        Wavelength range to plot.  Defaults to the full spectrum.
+    line : `int`, optional
+        Index of a line to center the plot on.
+    width : `float`, optional
+        Number of line sigmas to plot on either side of `line`.
+    autoscale : `bool`, optional
+        Scale the flux axis to the 1-99 percentile range.
+    output : `str` or `PdfPages`, optional
+        Output destination.  The plot is shown if None.
+    errors : `bool`, optional
+        Plot the continuum +/- error band.
+    decimate : `bool`, optional
+        Reduce each series to its envelope at twice the output
+        resolution, using `envelope_indices`.  Default = True.
+    """
+    # matplotlib is slow to import, so only do so when plotting.
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
     if min is None:
         min = spectrum.x[0]
     if max is None:
@@ -37,35 +116,60 @@ def plot_spectrum(spectrum,
 
     if line is not None and width is not None:
         min = spectrum.L[line].x0 - width * spectrum.L[line].Q[1]
-        min = spectrum.L[line].x0 + width * spectrum.L[line].Q[1]
+        max = spectrum.L[line].x0 + width * spectrum.L[line].Q[1]
 
     plt.xlim(min, max)
     plt.ylim(0.0, 1.1)
+
+    # Only the requested range is plotted, plus one sample on either
+    # side so the lines reach the edges.
+    start, end = subset(spectrum.x, min, max, spectrum=spectrum)
+    start = np.clip(start - 1, 0, None)
+    end = np.clip(end + 1, None, spectrum.length())
+    X = np.asarray(spectrum.x)[start:end]
+
     if autoscale is True:
-        ymin, ymax = np.percentile(spectrum.y, [1.0, 99.0])
+        ymin, ymax = np.percentile(spectrum.y[start:end], [1.0, 99.0])
         plt.ylim(ymin,ymax)
 
     plt.xlabel("wavelength")
     plt.ylabel("flux")
 
+    ax = plt.gca()
+    dpi = plt.rcParams['savefig.dpi']
+    scale = 1.0 if dpi == 'figure' else float(dpi) / ax.figure.dpi
+    # Two bins per output pixel keeps the antialiased line edges
+    # unchanged as well.
+    bins = 2 * int(np.ceil(ax.get_window_extent().width * scale))
+
+    def plot(Y, **kwargs):
+        Y = np.asarray(Y)[start:end]
+        if decimate is True:
+            index = envelope_indices(X, Y, bins, min, max)
+            plt.plot(X[index], Y[index], **kwargs)
+        else:
+            plt.plot(X, Y, **kwargs)
+
     if spectrum.L is not None:
-        for l in spectrum.L:
-            plt.axvline(x=l.x0, color='#FFA500', linewidth=0.1)
+        x0 = np.array([l.x0 for l in spectrum.L], dtype=float)
+        x0 = x0[(x0 >= min) & (x0 <= max)]
+        ax.vlines(x0, 0.0, 1.0, transform=ax.get_xaxis_transform(),
+                  color='#FFA500', linewidth=0.1)
 
-    plt.plot(spectrum.x, spectrum.y, color='b')
+    plot(spectrum.y, color='b')
 
     if (spectrum.continuum is not None and
         len(spectrum.continuum) == spectrum.length()):
-        plt.plot(spectrum.x, spectrum.continuum, color='r')
+        plot(spectrum.continuum, color='r')
 
     if (spectrum.lines is not None and
         len(spectrum.lines) == spectrum.length()):
-        plt.plot(spectrum.x, spectrum.lines, color='g')
+        plot(spectrum.lines, color='g')
 
     if (errors is True and spectrum.error is not None and
         len(spectrum.error) == spectrum.length()):
-        plt.plot(spectrum.x, spectrum.continuum + spectrum.error, color='c')
-        plt.plot(spectrum.x, spectrum.continuum - spectrum.error, color='c')
+        plot(spectrum.continuum + spectrum.error, color='c')
+        plot(spectrum.continuum - spectrum.error, color='c')
 
     if output is None:
         plt.show()
@@ -74,7 +178,153 @@ def plot_spectrum(spectrum,
     else:
         plt.savefig(output)
 
-def plot_lines(spectrum, width=5.0, all=False, output=None):
+
+def select_lines(spectrum, which='supplied'):
+    """Choose the lines to plot.
+
+    Parameters
+    ----------
+    spectrum : `robospect.spectra.spectrum`
+        Spectrum with a fit line catalog.
+    which : `str`, optional
+        `all` lines, the `supplied` lines, the `flagged` lines (with
+        any quality flag set), or `none`.
+
+    Returns
+    -------
+    lines : `list` of `robospect.lines.line`
+        Lines inside the spectrum that do not have FIT_FAIL set.
+    """
+    if which == 'none':
+        return []
+    if which not in ('all', 'supplied', 'flagged'):
+        raise RuntimeError(f"Unknown line plot selection: {which}")
+    quality = (1 << Flags.BIT_PADDING) - 1
+
+    selected = []
+    for l in spectrum.L:
+        if which == 'supplied' and not l.flags.test("SUPPLIED"):
+            continue
+        if which == 'flagged' and not (l.flags.value & quality):
+            continue
+        if l.flags.test("FIT_FAIL"):
+            continue
+        if l.x0 < spectrum.min() or l.x0 > spectrum.max():
+            continue
+        selected.append(l)
+    return selected
+
+
+def line_plot_data(spectrum, width=5.0, which='supplied'):
+    """Collect the data needed to plot the selected lines.
+
+    Parameters
+    ----------
+    spectrum : `robospect.spectra.spectrum`
+        Data to plot.
+    width : `float`, optional
+        Number of line sigmas to plot on either side.
+    which : `str`, optional
+        Line selection, as for `select_lines`.
+
+    Returns
+    -------
+    data : `dict`
+        `panels`, a list of (arrays, min, max, x0, labels) tuples, one
+        per line.  `arrays` holds the wavelength, flux, continuum,
+        lines and error over the plotted range only, so the data is
+        small and cheap to send to another process, even for memory
+        mapped spectra.
+    """
+    panels = []
+    for l in select_lines(spectrum, which):
+        if len(l.Q) > 2 and l.Q[1] > 0 and l.Q[1] < 100:
+            min = l.x0 - width * l.Q[1]
+            max = l.x0 + width * l.Q[1]
+        else:
+            min = l.x0 - 0.5
+            max = l.x0 + 0.5
+        start, end = subset(spectrum.x, min, max, spectrum=spectrum)
+        labels = (f"chi^2 = {l.chi:.3f}  R = {l.R:.3f}  F = {l.flags}",
+                  f"fit = {np.array_str(np.asarray(l.Q), precision=2)}",
+                  f"# {l.x0} {l.comment}")
+        arrays = tuple(np.array(getattr(spectrum, name)[start:end], dtype=float)
+                       for name in ('x', 'y', 'continuum', 'lines', 'error'))
+        panels.append((arrays, min, max, l.x0, labels))
+
+    return {'panels': panels}
+
+
+def render_line_pages(data, output):
+    """Write the line plots to a multi-page PDF.
+
+    Parameters
+    ----------
+    data : `dict`
+        Plot data from `line_plot_data`.
+    output : `str`
+        Output filename.
+
+    Notes
+    -----
+    The figure does not use pyplot, so no interactive backend is
+    involved.  The six panels and their artists are created once,
+    and only their data, limits and labels change between pages.
+    Panels not needed on the last page are hidden.
+    """
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    panels = data['panels']
+    perPage = 6
+
+    with matplotlib.rc_context({'font.size': 8}), PdfPages(output) as pdf:
+        fig = Figure(figsize=(8, 10))
+        axes = fig.subplots(3, 2).ravel()
+        artists = []
+        for ax in axes:
+            ax.set_ylim(0.0, 1.1)
+            ax.set_xlabel("wavelength")
+            ax.set_ylabel("flux")
+            ax.ticklabel_format(style='plain', useOffset=False)
+            marker = ax.axvline(x=0.0, color='#FFA500', linewidth=0.1)
+            curves = (ax.plot([], [], '+-b')[0],
+                      ax.plot([], [], color='r')[0],
+                      ax.plot([], [], color='g')[0],
+                      ax.plot([], [], color='c')[0],
+                      ax.plot([], [], color='c')[0])
+            # Labels are at the left edge, at fixed flux values.
+            labels = tuple(ax.text(0.0, yText, "", transform=ax.get_yaxis_transform())
+                           for yText in (0.13, 0.08, 0.03))
+            artists.append((marker, curves, labels))
+
+        for page in range(0, len(panels), perPage):
+            for ax, (marker, curves, labels), panel in zip(axes, artists,
+                                                           panels[page:page + perPage] +
+                                                           [None] * perPage):
+                if panel is None:
+                    ax.set_visible(False)
+                    continue
+                (X, F, Cs, Ls, Es), min, max, x0, text = panel
+
+                ax.set_visible(True)
+                ax.set_xlim(min, max)
+                marker.set_xdata([x0, x0])
+                for curve, Y in zip(curves, (F, Cs, Cs + Ls, Cs + Es, Cs - Es)):
+                    curve.set_data(X, Y)
+                for label, t in zip(labels, text):
+                    label.set_text(t)
+            pdf.savefig(fig)
+
+
+def _render_in_background(data, output):
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+    render_line_pages(data, output)
+
+
+def plot_lines(spectrum, width=5.0, all=False, output=None, which=None, background=False):
     """Plot individual lines as part of a set.
 
     Parameters
@@ -87,68 +337,46 @@ def plot_lines(spectrum, width=5.0, all=False, output=None):
         Plot all lines, or just those that were supplied?
     output : `str`, optional
         Output filename.
+    which : `str`, optional
+        Line selection, as for `select_lines`.  This overrides `all`.
+    background : `bool`, optional
+        Render the pages in a separate process.  The process is
+        started with `spawn`, not forked, as the caller may have other
+        threads running, and so that it shares no matplotlib state
+        with the caller.
+
+    Returns
+    -------
+    process : `multiprocessing.Process` or None
+        The rendering process, if run in the background.  It is not a
+        daemon, so the interpreter waits for it before exiting.
     """
     if output is None:
-        pass
-
-    np.set_printoptions(precision=2)
-    plotN = 1
-    with PdfPages(output) as pdf:
-        fig = plt.figure(figsize=(8, 10))
-        plt.rcParams.update({'font.size': 8})
-        plt.ticklabel_format(style='plain', useOffset=False)
-        for l in spectrum.L:
-            if all is True or l.flags.test("SUPPLIED"):
-                if l.flags.test("FIT_FAIL"):
-                    continue
-                if l.x0 < spectrum.min() or l.x0 > spectrum.max():
-                    continue
+        return None
+    if which is None:
+        which = 'all' if all is True else 'supplied'
+
+    data = line_plot_data(spectrum, width=width, which=which)
+    if len(data['panels']) == 0:
+        return None
+    if background is True:
+        import multiprocessing
+        context = multiprocessing.get_context('spawn')
+        process = context.Process(target=_render_in_background,
+                                  args=(data, output), name="robospect-plots")
+        process.start()
+        return process
+    render_line_pages(data, output)
+    return None
 
-                print(f"{l}")
-                if len(l.Q) > 2 and l.Q[1] > 0 and l.Q[1] < 100:
-                    min = l.x0 - width * l.Q[1]
-                    max = l.x0 + width * l.Q[1]
-                else:
-                    min = l.x0 - 0.5
-                    max = l.x0 + 0.5
-                start, end = subset(spectrum.x, min, max)
-
-                X = spectrum.x[start:end]
-                Y = spectrum.y[start:end]
-                C = spectrum.continuum[start:end]
-                L = spectrum.lines[start:end]
-                E = spectrum.error[start:end]
-
-                subplotIndex = plotN % 6
-                if subplotIndex == 0:
-                    subplotIndex = 6
-                plt.subplot(3, 2, subplotIndex)
-                plt.xlim(min, max)
-                plt.ylim(0.0, 1.1)
-                plt.xlabel("wavelength")
-                plt.ylabel("flux")
-                # plt.text(min, 0.18, f"{l.x0}")
-                #                with np.printoptions(precision=2):
-
-                plt.text(min, 0.13, f"chi^2 = {l.chi:.3f}  R = {l.R:.3f}  F = {l.flags}")
-                plt.text(min, 0.08, f"fit = {np.array_str(l.Q, precision=2)}")
-                plt.text(min, 0.03, f"# {l.x0} {l.comment}")
-                plt.axvline(x=l.x0, color='#FFA500', linewidth=0.1)
-                plt.plot(X, Y, '+-b')
-                plt.plot(X, C, color='r')
-                plt.plot(X, C + L, color='g')
-                plt.plot(X, C + E, color='c')
-                plt.plot(X, C - E, color='c')
-
-                plotN += 1
-                if plotN % 6 == 0:
-                    pdf.savefig(fig)
-
-
-
-def subset(X, xl, xr):
-    start = np.searchsorted(X, xl, side='left')
-    end   = np.searchsorted(X, xr, side='right')
+
+def subset(X, xl, xr, spectrum=None):
+    if spectrum is not None:
+        start = spectrum.index_from_wavelength(xl, side='left')
+        end   = spectrum.index_from_wavelength(xr, side='right')
+    else:
+        start = np.searchsorted(X, xl, side='left')
+        end   = np.searchsorted(X, xr, side='right')
 
     if start == end:
         end += 1
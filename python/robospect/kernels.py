@@ -0,0 +1,562 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import logging
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+__all__ = ['resolve_backend', 'set_backend', 'get_backend', 'window_median', 'window_median_mad',
+           'window_continuum_noise', 'peak_runs', 'gaussian', 'half_widths']
+
+# Maximum number of elements gathered into a temporary window array.
+BLOCK_ELEMENTS = 4 * 1024 * 1024
+
+BACKENDS = ('numpy', 'numba', 'auto')
+_backend = 'numpy'
+_compiled = dict()
+
+
+def resolve_backend(name=None):
+    """Find the implementation a backend name selects.
+
+    Parameters
+    ----------
+    name : `str`, optional
+        One of `numpy` (the default), `numba`, or `auto`.  Both
+        `numba` and `auto` use Numba if it can be imported, and fall
+        back to the numpy implementation otherwise.
+
+    Returns
+    -------
+    backend : `str`
+        `numpy` or `numba`.
+
+    Raises
+    ------
+    RuntimeError :
+        Raised if the backend name is not known.
+
+    Notes
+    -----
+    Each spectrum resolves its `backend` fitting configuration value,
+    as `-F backend numba`, and passes it to the kernels it calls, so
+    spectra with different backends may be fit in one process.  Both
+    backends produce identical results; Numba is only imported (and
+    the kernels only compiled) when it is requested.
+    """
+    if name is None:
+        name = 'numpy'
+    if name not in BACKENDS:
+        raise RuntimeError(f"Unknown kernel backend: {name}")
+
+    if name in ('numba', 'auto'):
+        try:
+            import numba  # noqa: F401
+            return 'numba'
+        except ImportError:
+            if name == 'numba':
+                logging.getLogger(__name__).warning("Numba is not available.  Using numpy kernels.")
+    return 'numpy'
+
+
+def set_backend(name=None):
+    """Select the implementation used by kernels called without a backend.
+
+    Parameters
+    ----------
+    name : `str`, optional
+        Backend name, as for `resolve_backend`.
+
+    Returns
+    -------
+    backend : `str`
+        The backend that is now the default.
+    """
+    global _backend
+    _backend = resolve_backend(name)
+    return _backend
+
+
+def get_backend():
+    """Return the name of the default kernel backend.
+    """
+    return _backend
+
+
+def _use_numba(backend):
+    """Return True if `backend`, or the default if it is None, is Numba."""
+    if backend is None:
+        return _backend == 'numba'
+    if backend not in ('numpy', 'numba'):
+        backend = resolve_backend(backend)
+    return backend == 'numba'
+
+
+def _jit(name):
+    """Compile one of the loop kernels with Numba.
+
+    Parameters
+    ----------
+    name : `str`
+        Name of the kernel, such that `_{name}_loop` is the python
+        implementation.
+
+    Returns
+    -------
+    kernel : callable
+        The compiled kernel.  Compiled kernels are cached, both here
+        and on disk.
+    """
+    if name not in _compiled:
+        import numba
+        _compiled[name] = numba.njit(cache=True, error_model='numpy')(globals()[f"_{name}_loop"])
+    return _compiled[name]
+
+
+def _window_groups(start, end):
+    """Group windows by length.
+
+    Parameters
+    ----------
+    start : `np.ndarray` of `int`
+        First pixel of each window.
+    end : `np.ndarray` of `int`
+        One past the last pixel of each window.
+
+    Yields
+    ------
+    length : `int`
+        Window length for this group.
+    rows : `np.ndarray` of `int`
+        Indices of the windows with this length, in blocks small
+        enough to gather into memory.
+
+    Notes
+    -----
+    On a uniform wavelength grid nearly all windows have the same
+    length, so there are only a few groups.
+    """
+    length = np.asarray(end) - np.asarray(start)
+    order = np.argsort(length, kind='stable')
+    boundaries = np.flatnonzero(np.diff(length[order])) + 1
+    for rows in np.split(order, boundaries):
+        if len(rows) == 0:
+            continue
+        L = int(length[rows[0]])
+        blockRows = max(BLOCK_ELEMENTS // max(L, 1), 1)
+        for block in range(0, len(rows), blockRows):
+            yield L, rows[block:block + blockRows]
+
+
+def window_median(data, start, end, backend=None):
+    """Calculate the median of `data[start[i]:end[i]]` for each window.
+
+    Parameters
+    ----------
+    data : `np.ndarray`
+        Data to take the median of.
+    start : `np.ndarray` of `int`
+        First pixel of each window.
+    end : `np.ndarray` of `int`
+        One past the last pixel of each window.
+    backend : `str`, optional
+        Kernel backend, as for `resolve_backend`.  Defaults to the one
+        selected with `set_backend`.
+
+    Returns
+    -------
+    median : `np.ndarray`
+        Median of each window, NaN for empty windows.
+    """
+    data = np.asarray(data, dtype=float)
+    start = np.asarray(start, dtype=int)
+    if _use_numba(backend):
+        return _jit('window_median')(data, start, np.asarray(end, dtype=int))
+    median = np.full(len(start), np.nan)
+    for L, rows in _window_groups(start, end):
+        if L <= 0:
+            continue
+        windows = sliding_window_view(data, L)[start[rows]]
+        median[rows] = np.median(windows, axis=1)
+    return median
+
+
+def window_median_mad(data, start, end, backend=None):
+    """Calculate the median and median absolute deviation of each window.
+
+    Parameters
+    ----------
+    data : `np.ndarray`
+        Data to take the median of.
+    start : `np.ndarray` of `int`
+        First pixel of each window.
+    end : `np.ndarray` of `int`
+        One past the last pixel of each window.
+    backend : `str`, optional
+        Kernel backend, as for `resolve_backend`.  Defaults to the one
+        selected with `set_backend`.
+
+    Returns
+    -------
+    median : `np.ndarray`
+        Median of each window, NaN for empty windows.
+    mad : `np.ndarray`
+        Median of `abs(window - median)` for each window.  This is not
+        scaled to a gaussian sigma.
+    """
+    data = np.asarray(data, dtype=float)
+    start = np.asarray(start, dtype=int)
+    if _use_numba(backend):
+        return _jit('window_median_mad')(data, start, np.asarray(end, dtype=int))
+    median = np.full(len(start), np.nan)
+    mad = np.full(len(start), np.nan)
+    for L, rows in _window_groups(start, end):
+        if L <= 0:
+            continue
+        windows = sliding_window_view(data, L)[start[rows]]
+        m = np.median(windows, axis=1)
+        median[rows] = m
+        mad[rows] = np.median(np.abs(windows - m[:, np.newaxis]), axis=1)
+    return median, mad
+
+
+def window_continuum_noise(data, start, end, noise_start, noise_end, mad=True, backend=None):
+    """Calculate the windowed median, and the windowed median of the residuals from it.
+
+    Parameters
+    ----------
+    data : `np.ndarray`
+        Data to take the median of.
+    start : `np.ndarray` of `int`
+        First pixel of the median window centered on each pixel of
+        `data`.
+    end : `np.ndarray` of `int`
+        One past the last pixel of each median window.
+    noise_start : `np.ndarray` of `int`
+        First pixel of each noise window.
+    noise_end : `np.ndarray` of `int`
+        One past the last pixel of each noise window.
+    mad : `bool`, optional
+        Also calculate the median absolute deviation of each median
+        window.
+    backend : `str`, optional
+        Kernel backend, as for `resolve_backend`.  Defaults to the one
+        selected with `set_backend`.
+
+    Returns
+    -------
+    median : `np.ndarray`
+        Median of each window, NaN for empty windows.
+    mad : `np.ndarray` or None
+        Median of `abs(window - median)` for each window, if requested.
+    noise : `np.ndarray`
+        Median of `abs(data - median)` over each noise window.
+
+    Notes
+    -----
+    This is equivalent to `window_median_mad`, followed by
+    `window_median` of the residuals, but is done in one sweep over
+    the data: each noise window is evaluated as soon as the median of
+    every pixel it covers is known, so the residuals are still in
+    cache.
+    """
+    data = np.asarray(data, dtype=float)
+    start = np.asarray(start, dtype=int)
+    end = np.asarray(end, dtype=int)
+    noise_start = np.asarray(noise_start, dtype=int)
+    noise_end = np.asarray(noise_end, dtype=int)
+    if len(start) != len(data):
+        raise RuntimeError("The median windows must be centered on each pixel.")
+    if _use_numba(backend):
+        median, mad_, noise = _jit('window_continuum_noise')(data, start, end,
+                                                              noise_start, noise_end, mad)
+        return median, (mad_ if mad else None), noise
+
+    N = len(data)
+    median = np.full(N, np.nan)
+    mad_ = np.full(N, np.nan) if mad else None
+    noise = np.full(len(noise_start), np.nan)
+    residual = np.empty(N)
+    block = max(BLOCK_ELEMENTS // max(int(np.max(end - start, initial=1)), 1), 1)
+
+    done = 0
+    for a in range(0, N, block):
+        b = min(a + block, N)
+        for L, rows in _window_groups(start[a:b], end[a:b]):
+            if L <= 0:
+                continue
+            rows = rows + a
+            windows = sliding_window_view(data, L)[start[rows]]
+            m = np.median(windows, axis=1)
+            median[rows] = m
+            if mad:
+                mad_[rows] = np.median(np.abs(windows - m[:, np.newaxis]), axis=1)
+        residual[a:b] = np.abs(data[a:b] - median[a:b])
+
+        # Evaluate the noise windows that are now complete.
+        ready = noise_end[done:] <= b
+        count = len(ready) if ready.all() else int(np.argmin(ready))
+        if count > 0:
+            noise[done:done + count] = window_median(residual, noise_start[done:done + count],
+                                                     noise_end[done:done + count], backend)
+            done += count
+    if done < len(noise):
+        noise[done:] = window_median(residual, noise_start[done:], noise_end[done:], backend)
+    return median, mad_, noise
+
+
+def peak_runs(signal_to_noise, threshold, backend=None):
+    """Find the peak of each contiguous run of pixels above a threshold.
+
+    Parameters
+    ----------
+    signal_to_noise : `np.ndarray`
+        Signal-to-noise value for each pixel.
+    threshold : `float`
+        Detection threshold.
+    backend : `str`, optional
+        Kernel backend, as for `resolve_backend`.  Defaults to the one
+        selected with `set_backend`.
+
+    Returns
+    -------
+    peaks : `np.ndarray` of `int`
+        Index of the maximum pixel of each run.
+    values : `np.ndarray`
+        Signal-to-noise value at each peak.
+
+    Notes
+    -----
+    A run starts on a pixel above the threshold, and only ends on a
+    pixel that is below it.  Pixels equal to the threshold (or
+    undefined) therefore extend a run without being able to start
+    one, and a run that is still open at the end of the spectrum is
+    not reported.  Ties within a run resolve to the first pixel.
+    """
+    SN = np.asarray(signal_to_noise, dtype=float)
+    if _use_numba(backend):
+        return _jit('peak_runs')(SN, float(threshold))
+    active = ~(SN < threshold)
+
+    edges = np.diff(np.concatenate(([0], active.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    # Drop any run that does not close before the end of the data.
+    closed = ends < len(SN)
+    starts = starts[closed]
+    ends = ends[closed]
+    if len(starts) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0)
+
+    values = np.where(np.isnan(SN), -np.inf, SN)
+    bounds = np.column_stack((starts, ends)).ravel()
+    run_max = np.maximum.reduceat(values, bounds)[::2]
+
+    # Label each pixel with the run it would belong to.  Pixels
+    # outside of the runs are never inside a reduction segment.
+    run_id = np.cumsum(edges[:-1] == 1) - 1
+    run_id = np.clip(run_id, 0, len(starts) - 1)
+    candidate = np.where(values == run_max[run_id], np.arange(len(SN)), len(SN))
+    peaks = np.minimum.reduceat(candidate, bounds)[::2]
+
+    good = run_max > threshold
+    return peaks[good], run_max[good]
+
+
+def gaussian(x, m, s, A, backend=None):
+    """Evaluate a gaussian with peak amplitude `A`.
+
+    Parameters
+    ----------
+    x : `float` or `np.ndarray`
+        Wavelengths to evaluate.
+    m, s, A : `float`
+        Mean, sigma, and peak amplitude.
+    backend : `str`, optional
+        Kernel backend, as for `resolve_backend`.  Defaults to the one
+        selected with `set_backend`.
+
+    Returns
+    -------
+    f : `float` or `np.ndarray`
+        Profile values.
+    """
+    if _use_numba(backend) and np.ndim(x) == 1:
+        return _jit('gaussian')(np.asarray(x, dtype=float), float(m), float(s), float(A))
+    z = (x - m) / s
+    return A * np.exp(-0.5 * z*z)
+
+
+def _interp(X, Y, index, value):
+    dy = Y[index] - Y[index - 1]
+    dx = X[index] - X[index - 1]
+    return dx / dy * (value - Y[index - 1]) + X[index - 1]
+
+
+def half_widths(x, temp, center, start, end, F, backend=None):
+    """Walk out from a line center to find where the profile drops below
+    fixed fractions of the peak.
+
+    Parameters
+    ----------
+    x : `np.ndarray`
+        Pixel wavelengths.
+    temp : `np.ndarray`
+        Continuum subtracted flux.
+    center : `int`
+        Index of the peak pixel.
+    start, end : `int`
+        Pixel range to search.
+    F : `float`
+        Peak flux.
+    backend : `str`, optional
+        Kernel backend, as for `resolve_backend`.  Defaults to the one
+        selected with `set_backend`.
+
+    Returns
+    -------
+    widths : `np.ndarray`
+        Interpolated wavelengths of the three-quarter, half, and
+        quarter maximum crossings on the left side, followed by the
+        same on the right side.  Zero if no crossing is found.
+
+    Notes
+    -----
+    As in the original walk, the quarter maximum crossing is
+    interpolated to the half maximum value, and both sides share the
+    same interpolation formula.
+    """
+    x = np.asarray(x, dtype=float)
+    temp = np.asarray(temp, dtype=float)
+    if _use_numba(backend):
+        return _jit('half_widths')(x, temp, int(center), int(start), int(end), float(F))
+
+    widths = np.zeros(6)
+    levels = ((0.75, 0.75), (0.5, 0.5), (0.25, 0.5))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        left = np.arange(center, start, -1)
+        right = np.arange(center, min(end + 1, len(temp) - 1))
+        for offset, index, neighbor in ((0, left, left - 1), (3, right, right + 1)):
+            ratio = np.abs(temp[neighbor] / F)
+            for k, (level, value) in enumerate(levels):
+                hit = np.flatnonzero(ratio < level)
+                if len(hit) > 0:
+                    widths[offset + k] = _interp(x, temp, index[hit[0]], value * F)
+    return widths
+
+
+# Loop implementations.  These are only used through `_jit`.
+
+def _window_median_loop(data, start, end):
+    median = np.full(len(start), np.nan)
+    for i in range(len(start)):
+        if end[i] > start[i]:
+            median[i] = np.median(data[start[i]:end[i]])
+    return median
+
+
+def _window_median_mad_loop(data, start, end):
+    median = np.full(len(start), np.nan)
+    mad = np.full(len(start), np.nan)
+    for i in range(len(start)):
+        if end[i] > start[i]:
+            window = data[start[i]:end[i]]
+            m = np.median(window)
+            median[i] = m
+            mad[i] = np.median(np.abs(window - m))
+    return median, mad
+
+
+def _window_continuum_noise_loop(data, start, end, noise_start, noise_end, want_mad):
+    N = len(data)
+    median = np.full(N, np.nan)
+    mad = np.full(N, np.nan)
+    noise = np.full(len(noise_start), np.nan)
+    residual = np.empty(N)
+    k = 0
+    for i in range(N):
+        if end[i] > start[i]:
+            window = data[start[i]:end[i]]
+            m = np.median(window)
+            median[i] = m
+            if want_mad:
+                mad[i] = np.median(np.abs(window - m))
+        residual[i] = abs(data[i] - median[i])
+        while k < len(noise_start) and noise_end[k] <= i + 1:
+            if noise_end[k] > noise_start[k]:
+                noise[k] = np.median(residual[noise_start[k]:noise_end[k]])
+            k += 1
+    while k < len(noise_start):
+        if noise_end[k] > noise_start[k]:
+            noise[k] = np.median(residual[noise_start[k]:noise_end[k]])
+        k += 1
+    return median, mad, noise
+
+
+def _peak_runs_loop(SN, threshold):
+    peaks = np.zeros(len(SN), dtype=np.int64)
+    values = np.zeros(len(SN))
+    N = 0
+    in_line = False
+    peak_idx = -1
+    peak_val = -99.0
+    for idx in range(len(SN)):
+        if not in_line and SN[idx] > threshold:
+            in_line = True
+            peak_idx = idx
+            peak_val = SN[idx]
+        elif in_line and SN[idx] > peak_val:
+            peak_idx = idx
+            peak_val = SN[idx]
+        elif in_line and SN[idx] < threshold:
+            peaks[N] = peak_idx
+            values[N] = peak_val
+            N += 1
+            in_line = False
+    return peaks[:N], values[:N]
+
+
+def _gaussian_loop(x, m, s, A):
+    f = np.empty_like(x)
+    for i in range(len(x)):
+        z = (x[i] - m) / s
+        f[i] = A * np.exp(-0.5 * z*z)
+    return f
+
+
+def _half_widths_loop(x, temp, center, start, end, F):
+    widths = np.zeros(6)
+    levels = np.array([0.75, 0.5, 0.25])
+    values = np.array([0.75, 0.5, 0.5]) * F
+    for side in range(2):
+        if side == 0:
+            first, last, step = center, start, -1
+        else:
+            first, last, step = center, min(end + 1, len(temp) - 1), 1
+        for idx in range(first, last, step):
+            ratio = abs(temp[idx + step] / F)
+            for k in range(3):
+                if widths[3 * side + k] == 0.0 and ratio < levels[k]:
+                    dy = temp[idx] - temp[idx - 1]
+                    dx = x[idx] - x[idx - 1]
+                    widths[3 * side + k] = dx / dy * (values[k] - temp[idx - 1]) + x[idx - 1]
+            if ratio < levels[2]:
+                break
+    return widths
@@ -49,6 +49,7 @@ class line():
     chi = 0.0
     R = 0.0
     Niter = -1
+    nfev = -1
 
     comment = ""
     flags = Flags()
@@ -65,6 +66,7 @@ class line():
 
         self.chi = 0.0
         self.Niter = 0
+        self.nfev = 0
 
         self.comment = comment  if comment is not None else ""
         self.flags = flags      if flags is not None else Flags()
@@ -25,30 +25,81 @@ __all__ = ['line_gauss_guess',
            'line_best',
            'deblend_group',
            'detection_naive',
+           'detection_matched',
            'detection_null',
            'continuum_boxcar',
            'continuum_parallel_boxcar',
+           'continuum_fused_boxcar',
+           'continuum_kcs',
+           'continuum_bspline',
            'continuum_null',
            'noise_boxcar',
+           'repair_rv',
+           'repair_wavelength',
            'error_null',
            'initial_null',
            'profile_shapes',
        ]
 
-from .profile_shapes import *
+import importlib
 
-from .line_gauss_guess import *
-from .line_nlls import *
-from .line_mp_nlls import *
-from .line_best import *
+# The names provided by each model module.  The modules are only
+# imported when one of their names is first used, so that importing
+# robospect does not import scipy, multiprocessing, or any model that
+# the configuration does not select.  The models are selected through
+# robospect.registry.
+_exports = {'profile_shapes': ['profileFromName', 'profile', 'gaussian', 'voigt', 'humlicek',
+                               'humlicek_w4', 'lorentzian', 'planck', 'skewgauss'],
+            'line_gauss_guess': ['line_gauss_guess'],
+            'line_nlls': ['line_nlls'],
+            'line_mp_nlls': ['line_mp_nlls'],
+            'line_best': ['line_best'],
+            'deblend_group': ['deblend_group'],
+            'continuum_boxcar': ['continuum_boxcar'],
+            'continuum_parallel_boxcar': ['continuum_parallel_boxcar'],
+            'continuum_fused_boxcar': ['continuum_fused_boxcar'],
+            'continuum_kcs': ['continuum_kcs'],
+            'continuum_bspline': ['continuum_bspline'],
+            'noise_boxcar': ['noise_boxcar'],
+            'detection_naive': ['detection_naive'],
+            'detection_matched': ['detection_matched'],
+            'repair_rv': ['repair_rv'],
+            'repair_wavelength': ['repair_wavelength'],
+            'all_null': ['continuum_null', 'error_null', 'detection_null',
+                         'initial_null', 'line_null'],
+            }
+_modules = {name: module for module, names in _exports.items() for name in names}
 
-from .deblend_group import *
 
-from .continuum_boxcar import *
-from .continuum_parallel_boxcar import *
+def _load(module):
+    """Import a model module and bind its exported names.
 
-from .noise_boxcar import *
-from .detection_naive import *
+    Parameters
+    ----------
+    module : `str`
+        Name of the module to import.
 
-from .all_null import *
+    Returns
+    -------
+    exports : `dict`
+        The exported names and their values.
+    """
+    imported = importlib.import_module(f".{module}", __name__)
+    exports = {name: getattr(imported, name) for name in _exports[module]}
+    # Importing the submodule binds its name in this package.  Replace
+    # that with the exported object, as the star imports used to.
+    globals().update(exports)
+    return exports
 
+
+def __getattr__(name):
+    if name in _modules:
+        return _load(_modules[name])[name]
+    if name in _exports:
+        _load(name)
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_modules) | set(_exports))
@@ -113,7 +113,7 @@ class line_null(spectra.spectrum):
     def _configLine(self, **kwargs):
         if 'profileName' in kwargs:
             self.profileName = kwargs.get('profileName')
-        self.profile = profileFromName(self.profileName)
+        self.profile = profileFromName(self.profileName, backend=self.backend)
 
     def fit_lines(self, **kwargs):
         logger = logging.getLogger(__name__)
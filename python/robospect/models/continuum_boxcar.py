@@ -20,6 +20,7 @@
 import logging
 import numpy as np
 from robospect import spectra
+from robospect import kernels
 
 __all__ = ['continuum_boxcar']
 
@@ -33,8 +34,11 @@ class continuum_boxcar(spectra.spectrum):
 
         self.box_size = 40.0
         self.continuum_normalized = True
+        self.decimate = None
+        self.decimate_check = 10
+        self.continuum_deviation = None
         super().__init__(*args, **kwargs)
-        config = kwargs.get(self.modelPhase, dict())
+        config = self.phase_config(continuum_boxcar, kwargs)
         self._configContinuum(**config)
 
     def _configContinuum(self, **kwargs):
@@ -42,31 +46,98 @@ class continuum_boxcar(spectra.spectrum):
             self.box_size = float(kwargs.get('box_size'))
         if 'continuum_normalized' in kwargs:
             self.continuum_normalized = kwargs.get('continuum_normalized', True)
+        if 'decimate' in kwargs:
+            self.decimate = float(kwargs['decimate']) if kwargs['decimate'] is not None else None
+        if 'decimate_check' in kwargs:
+            self.decimate_check = int(kwargs.get('decimate_check', 10))
 
     def fit_continuum(self, **kwargs):
+        """Fit the continuum with a running median.
+
+        Parameters
+        ----------
+        box_size : `float`, optional
+            Width of the median window, in AA.
+        continuum_normalized : `bool`, optional
+            Scale the error estimate by the continuum.
+        decimate : `float`, optional
+            If set, only evaluate the median and MAD at knots spaced by
+            this fraction of `box_size`, and interpolate linearly
+            between them.
+        decimate_check : `int`, optional
+            When decimating, also evaluate the exact median at the
+            midpoint of every `decimate_check`-th knot interval (every
+            10th by default), and store the largest deviation from
+            the interpolated continuum in `continuum_deviation`.  This
+            is a sample, so the deviation elsewhere may be somewhat
+            larger.  1 checks every interval, at the cost of as many
+            medians again as the knots, and 0 disables the check.
+
+        Notes
+        -----
+        A window of `box_size` changes little from one pixel to the
+        next, so on finely sampled spectra decimating by a few percent
+        of `box_size` reduces the cost of the continuum by the number
+        of pixels between knots.
+        """
         self._configContinuum(**kwargs)
         logger = logging.getLogger(__name__)
         logger.setLevel(self.verbose)
 
         temp = self.y - self.lines
-        for idx, w in enumerate(self.x):
-            start = np.searchsorted(self.x, w - self.box_size / 2.0, side='left')
-            end = np.searchsorted(self.x, w + self.box_size / 2.0, side='right')
-            if start < 0:
-                start = 0
-            if end > len(self.x) - 1:
-                end = len(self.x) - 1
-
-            self.continuum[idx] = np.median(temp[start:end])
-
-            noise = temp[start:end]
-            noise = abs(noise - self.continuum[idx])
-
-            if self.continuum_normalized is True:
-                # This should be correct for continuum normalized data.
-                self.error[idx] = 1.4826 * np.median(noise) / self.continuum[idx]
-            else:
-                self.error[idx] = 1.4826 * np.median(noise)
+        start, end = self.window_bounds(self.box_size)
+        start = np.clip(start, 0, None)
+        end = np.clip(end, None, len(self.x) - 1)
+
+        if self.decimate is not None and self.decimate > 0:
+            continuum, mad = self._fit_decimated(temp, start, end, logger)
+        else:
+            continuum, mad = kernels.window_median_mad(temp, start, end, self.backend)
+            self.continuum_deviation = None
+        self.continuum = continuum
+        if self.continuum_normalized is True:
+            # This should be correct for continuum normalized data.
+            self.error = 1.4826 * mad / continuum
+        else:
+            self.error = 1.4826 * mad
+
+    def _fit_decimated(self, temp, start, end, logger):
+        """Evaluate the running median and MAD on a grid of knots.
+
+        Parameters
+        ----------
+        temp : `np.ndarray`
+            The line subtracted spectrum.
+        start, end : `np.ndarray` of `int`
+            The window of each pixel.
+        logger : `logging.Logger`
+            Logger for the deviation report.
+
+        Returns
+        -------
+        continuum, mad : `np.ndarray`
+            The interpolated median and MAD at each pixel.
+        """
+        x = np.asarray(self.x, dtype=float)
+        step = self.decimate * self.box_size
+        knots = self.index_from_wavelength(np.arange(x[0], x[-1], step), side='left')
+        knots = np.unique(np.concatenate((knots, [len(x) - 1])))
+
+        median, mad = kernels.window_median_mad(temp, start[knots], end[knots], self.backend)
+        valid = np.isfinite(median)
+        continuum = np.interp(x, x[knots[valid]], median[valid])
+        mad = np.interp(x, x[knots[valid]], mad[valid])
+
+        self.continuum_deviation = None
+        if self.decimate_check > 0 and len(knots) > 1:
+            check = ((knots[:-1] + knots[1:]) // 2)[::self.decimate_check]
+            exact = kernels.window_median(temp, start[check], end[check], self.backend)
+            deviation = np.abs(continuum[check] - exact)
+            self.continuum_deviation = float(np.nanmax(deviation, initial=0.0))
+            logger.info(f"continuum: {len(knots)} knots for {len(x)} pixels, "
+                        f"maximum deviation {self.continuum_deviation:.3g} "
+                        f"at {len(check)} check pixels")
+        return continuum, mad
 
     def fit_error(self, **kwargs):
         logger = logging.getLogger(__name__)
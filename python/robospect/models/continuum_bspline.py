@@ -0,0 +1,257 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import logging
+import numpy as np
+import scipy.interpolate as spI
+import scipy.linalg as spL
+from robospect import spectra
+
+__all__ = ['continuum_bspline']
+
+class continuum_bspline(spectra.spectrum):
+    modelName = 'bspline'
+    modelPhase = 'continuum'
+
+    def __init__(self, *args, **kwargs):
+        self.modelName = 'bspline'
+        self.modelPhase = 'continuum'
+
+        self.knot_spacing = 5.0
+        self.order = 3
+        self.reject_low = 2.5
+        self.reject_high = 3.0
+        self.reject_iterations = 5
+        self.continuum_normalized = True
+        super().__init__(*args, **kwargs)
+        config = kwargs.get(self.modelPhase, dict())
+        self._configContinuum(**config)
+
+    def _configContinuum(self, **kwargs):
+        if 'knot_spacing' in kwargs:
+            self.knot_spacing = float(kwargs.get('knot_spacing', 5.0))
+        if 'order' in kwargs:
+            self.order = int(kwargs.get('order', 3))
+        if 'reject_low' in kwargs:
+            self.reject_low = float(kwargs.get('reject_low', 2.5))
+        if 'reject_high' in kwargs:
+            self.reject_high = float(kwargs.get('reject_high', 3.0))
+        if 'reject_iterations' in kwargs:
+            self.reject_iterations = int(kwargs.get('reject_iterations', 5))
+        if 'continuum_normalized' in kwargs:
+            self.continuum_normalized = kwargs.get('continuum_normalized', True)
+
+    def _knots(self, x):
+        """Construct the interior and full knot vectors.
+
+        Parameters
+        ----------
+        x : `np.ndarray`
+            Sorted wavelengths of the pixels to fit.
+
+        Returns
+        -------
+        interior : `np.ndarray`
+            Interior knots, spaced by `knot_spacing`.
+        knots : `np.ndarray`
+            Full knot vector, with the end knots repeated.
+        """
+        nInterval = max(int(np.ceil((x[-1] - x[0]) / self.knot_spacing)), 1)
+        # Do not allow more intervals than the data can constrain.
+        nInterval = min(nInterval, max((len(x) - 1) // (self.order + 1), 1))
+        edges = np.linspace(x[0], x[-1], nInterval + 1)
+        interior = edges[1:-1]
+        knots = np.concatenate(([x[0]] * (self.order + 1), interior, [x[-1]] * (self.order + 1)))
+        return interior, knots
+
+    def fit_continuum(self, **kwargs):
+        """Fit a smoothing B-spline to the continuum, rejecting line pixels.
+
+        Parameters
+        ----------
+        knot_spacing : `float`, optional
+            Separation of the spline knots, in AA.  Default = 5.0.
+        order : `int`, optional
+            Spline order.  Default = 3.
+        reject_low : `float`, optional
+            Rejection threshold below the continuum, in units of the
+            local noise.  Default = 2.5.
+        reject_high : `float`, optional
+            Rejection threshold above the continuum.  Default = 3.0.
+        reject_iterations : `int`, optional
+            Maximum number of rejection iterations.  Default = 5.
+        continuum_normalized : `bool`, optional
+            Scale the error by the continuum level.
+
+        Notes
+        -----
+        The spline is a weighted least squares fit.  The basis
+        functions are evaluated once, and each iteration accumulates
+        the banded normal equations and solves them with
+        `scipy.linalg.solveh_banded`, and the noise estimate partitions
+        the residuals of each knot interval, so each iteration costs
+        O(N).  Rejected pixels keep a small weight, so that a knot
+        interval that is entirely covered by a line does not make the
+        system singular.  The noise is the MAD of the unrejected
+        residuals in each knot interval, interpolated between the
+        interval centers.
+        """
+        self._configContinuum(**kwargs)
+        logger = logging.getLogger(__name__)
+        logger.setLevel(self.verbose)
+
+        x = np.asarray(self.x, dtype=float)
+        temp = np.asarray(self.y - self.lines, dtype=float)
+        finite = np.isfinite(temp)
+        data = np.where(finite, temp, 0.0)
+        interior, knots = self._knots(x)
+        groups = np.searchsorted(interior, x, side='right')
+        centers = 0.5 * (knots[self.order:-self.order - 1] + knots[self.order + 1:-self.order])
+
+        basis, column = _design(x, knots, self.order)
+        nCoeff = len(knots) - self.order - 1
+
+        mask = finite.copy()
+        for iteration in range(self.reject_iterations + 1):
+            weight = np.where(mask, 1.0, 1e-3 * finite)
+            coeff = _solve(basis, column, weight, data, nCoeff)
+            continuum = np.sum(basis * coeff[column], axis=1)
+            residual = data - continuum
+
+            mad = _group_median(np.abs(residual[mask]), groups[mask], len(centers))
+            good = np.isfinite(mad)
+            if not np.any(good):
+                raise RuntimeError("No unmasked pixels remain for the continuum fit.")
+            sigma = 1.4826 * np.interp(x, centers[good], mad[good])
+
+            new_mask = (finite & (residual > -self.reject_low * sigma) &
+                        (residual < self.reject_high * sigma))
+            logger.debug("Iteration %d: %d pixels rejected" % (iteration, np.sum(~new_mask)))
+            if np.array_equal(new_mask, mask):
+                break
+            mask = new_mask
+
+        self.continuum = continuum
+        if self.continuum_normalized is True:
+            # This should be correct for continuum normalized data.
+            self.error = sigma / continuum
+        else:
+            self.error = sigma
+
+    def fit_error(self, **kwargs):
+        logger = logging.getLogger(__name__)
+        logger.setLevel(self.verbose)
+        pass
+
+
+def _design(x, knots, order):
+    """Evaluate the non-zero B-spline basis functions at each pixel.
+
+    Parameters
+    ----------
+    x : `np.ndarray`
+        Pixel wavelengths.
+    knots : `np.ndarray`
+        Full knot vector.
+    order : `int`
+        Spline order.
+
+    Returns
+    -------
+    basis : `np.ndarray`, (N, order + 1)
+        Values of the non-zero basis functions for each pixel.
+    column : `np.ndarray` of `int`, (N, order + 1)
+        Coefficient index of each of those basis functions.
+    """
+    design = spI.BSpline.design_matrix(x, knots, order).tocsr()
+    design.sort_indices()
+    basis = design.data.reshape(len(x), order + 1)
+    column = design.indices.reshape(len(x), order + 1)
+    return basis, column
+
+
+def _solve(basis, column, weight, data, nCoeff):
+    """Solve the banded weighted least squares system for the coefficients.
+
+    Parameters
+    ----------
+    basis : `np.ndarray`, (N, order + 1)
+        Values of the non-zero basis functions for each pixel.
+    column : `np.ndarray` of `int`, (N, order + 1)
+        Coefficient index of each of those basis functions.
+    weight : `np.ndarray`
+        Weight of each pixel.
+    data : `np.ndarray`
+        Values to fit.
+    nCoeff : `int`
+        Number of spline coefficients.
+
+    Returns
+    -------
+    coeff : `np.ndarray`
+        Spline coefficients.
+    """
+    order = basis.shape[1] - 1
+    weighted = basis * weight[:, np.newaxis]
+
+    # Upper form banded storage: band[order - d, i + d] = (A^T W A)[i, i + d]
+    band = np.zeros((order + 1, nCoeff))
+    for d in range(order + 1):
+        for j in range(order + 1 - d):
+            band[order - d] += np.bincount(column[:, j + d], weights=weighted[:, j] * basis[:, j + d],
+                                           minlength=nCoeff)
+    rhs = np.bincount(column.ravel(), weights=(weighted * data[:, np.newaxis]).ravel(),
+                      minlength=nCoeff)
+    return spL.solveh_banded(band, rhs)
+
+
+def _group_median(values, groups, nGroups):
+    """Calculate the median of the values in each group.
+
+    Parameters
+    ----------
+    values : `np.ndarray`
+        Values to take the median of.
+    groups : `np.ndarray` of `int`
+        Group index of each value, in the range [0, nGroups).  This
+        must not decrease, so that each group is a contiguous slice,
+        as the knot intervals are for sorted wavelengths.
+    nGroups : `int`
+        Total number of groups.
+
+    Returns
+    -------
+    median : `np.ndarray`
+        Median of each group, or NaN if the group is empty.
+
+    Notes
+    -----
+    The median of each slice is found with `np.partition`, so the cost
+    is O(N) in the total number of values.
+    """
+    counts = np.bincount(groups, minlength=nGroups)
+    ends = np.cumsum(counts)
+    median = np.full(nGroups, np.nan)
+    for group in np.flatnonzero(counts):
+        n = counts[group]
+        lower = (n - 1) // 2
+        upper = n // 2
+        part = np.partition(values[ends[group] - n:ends[group]], (lower, upper))
+        median[group] = 0.5 * (part[lower] + part[upper])
+    return median
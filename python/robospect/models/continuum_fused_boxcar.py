@@ -0,0 +1,125 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import logging
+import numpy as np
+from robospect import spectra
+from robospect import kernels
+
+__all__ = ['continuum_fused_boxcar']
+
+class continuum_fused_boxcar(spectra.spectrum):
+    modelName = 'fusedbox'
+    modelPhase = 'continuum'
+
+    def __init__(self, *args, **kwargs):
+        self.modelName = 'fusedbox'
+        self.modelPhase = 'continuum'
+
+        self.box_size = 40.0
+        self.noise_box_size = None
+        self.continuum_normalized = True
+        self.error_estimate = 'noise'
+        self.continuum_mad = None
+        self.noise = None
+        super().__init__(*args, **kwargs)
+        config = self.phase_config(continuum_fused_boxcar, kwargs)
+        self._configContinuum(**config)
+
+    def _configContinuum(self, **kwargs):
+        if 'box_size' in kwargs:
+            self.box_size = float(kwargs.get('box_size'))
+        if 'noise_box_size' in kwargs:
+            self.noise_box_size = float(kwargs.get('noise_box_size'))
+        if 'continuum_normalized' in kwargs:
+            self.continuum_normalized = kwargs.get('continuum_normalized', True)
+        if 'error' in kwargs:
+            self.error_estimate = kwargs.get('error', 'noise')
+            if self.error_estimate not in ('noise', 'mad', 'both'):
+                raise RuntimeError(f"No such error estimate: {self.error_estimate}")
+
+    def fit_continuum(self, **kwargs):
+        """Fit the boxcar median continuum and the noise together.
+
+        Parameters
+        ----------
+        box_size : `float`, optional
+            Width of the continuum window, in AA.  This is set with
+            `-V`/`--continuum_box`.
+        noise_box_size : `float`, optional
+            Width of the noise window, in AA.  Defaults to `box_size`.
+        continuum_normalized : `bool`, optional
+            Scale the MAD error estimate by the continuum.
+        error : `str`, optional
+            Which error estimate to calculate and use.  `noise` (the
+            default) is the `noise_boxcar` estimate, from the median
+            residual from the continuum.  `mad` is the
+            `continuum_boxcar` estimate, from the median absolute
+            deviation within each continuum window.  `both` calculates
+            both, and uses the `noise` estimate.
+
+        Notes
+        -----
+        This produces the same results as `-C name boxcar` followed by
+        `-N name boxcar` (for `error noise`), or `-C name boxcar`
+        alone (for `error mad`), in one sweep over the spectrum.  The
+        estimates are kept in `noise` and `continuum_mad`, and the one
+        selected is also stored as `error`.  A noise model would
+        replace the error, so `Config` does not allow one to be
+        selected with this model.
+        """
+        self._configContinuum(**kwargs)
+        logger = logging.getLogger(__name__)
+        logger.setLevel(self.verbose)
+
+        temp = self.y - self.lines
+        start, end = self.window_bounds(self.box_size)
+        noise_start, noise_end = start, end
+        if self.noise_box_size is not None and self.noise_box_size != self.box_size:
+            noise_start, noise_end = self.window_bounds(self.noise_box_size)
+        start = np.clip(start, 0, None)
+        end = np.clip(end, None, len(self.x) - 1)
+
+        want_mad = self.error_estimate in ('mad', 'both')
+        if self.error_estimate == 'mad':
+            # No residual windows are needed.
+            noise_start = noise_end = np.zeros(0, dtype=int)
+        continuum, mad, noise = kernels.window_continuum_noise(temp, start, end,
+                                                                noise_start, noise_end, mad=want_mad,
+                                                                backend=self.backend)
+        self.continuum = continuum
+        if want_mad:
+            if self.continuum_normalized is True:
+                # This should be correct for continuum normalized data.
+                self.continuum_mad = 1.4826 * mad / continuum
+            else:
+                self.continuum_mad = 1.4826 * mad
+        else:
+            self.continuum_mad = None
+        if self.error_estimate == 'mad':
+            self.noise = None
+            self.error = self.continuum_mad
+        else:
+            self.noise = 1.4826 * noise
+            self.error = self.noise
+
+    def fit_error(self, **kwargs):
+        logger = logging.getLogger(__name__)
+        logger.setLevel(self.verbose)
+        pass
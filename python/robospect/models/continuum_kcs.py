@@ -0,0 +1,155 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import logging
+import numpy as np
+import scipy.signal as spS
+from robospect import spectra
+
+__all__ = ['continuum_kcs']
+
+class continuum_kcs(spectra.spectrum):
+    modelName = 'kcs'
+    modelPhase = 'continuum'
+
+    def __init__(self, *args, **kwargs):
+        self.modelName = 'kcs'
+        self.modelPhase = 'continuum'
+
+        self.box_size = 40.0
+        self.kernel = 'boxcar'
+        self.clip_sigma = 3.0
+        self.clip_iterations = 5
+        self.continuum_normalized = True
+        super().__init__(*args, **kwargs)
+        config = kwargs.get(self.modelPhase, dict())
+        self._configContinuum(**config)
+
+    def _configContinuum(self, **kwargs):
+        if 'box_size' in kwargs:
+            self.box_size = float(kwargs.get('box_size'))
+        if 'kernel' in kwargs:
+            self.kernel = kwargs.get('kernel', 'boxcar')
+        if 'clip_sigma' in kwargs:
+            self.clip_sigma = float(kwargs.get('clip_sigma', 3.0))
+        if 'clip_iterations' in kwargs:
+            self.clip_iterations = int(kwargs.get('clip_iterations', 5))
+        if 'continuum_normalized' in kwargs:
+            self.continuum_normalized = kwargs.get('continuum_normalized', True)
+
+    def _kernel(self):
+        """Construct the smoothing kernel in pixel units.
+
+        Returns
+        -------
+        kernel : `np.ndarray`
+            Symmetric, odd length smoothing kernel.
+
+        Raises
+        ------
+        RuntimeError :
+            Raised if the kernel name is not known.
+
+        Notes
+        -----
+        The pixel scale is taken from the median wavelength spacing.
+        The boxcar kernel spans `box_size`, and the gaussian kernel
+        has sigma = `box_size` / 4, truncated at four sigma.
+        """
+        spacing = np.median(np.abs(np.diff(self.x))) if len(self.x) > 1 else 1.0
+        if self.kernel == 'boxcar':
+            half_width = max(int(0.5 * self.box_size / spacing), 0)
+            return np.ones(2 * half_width + 1)
+        elif self.kernel == 'gaussian':
+            sigma = max(0.25 * self.box_size / spacing, 0.5)
+            half_width = int(np.ceil(4.0 * sigma))
+            offsets = np.arange(-half_width, half_width + 1)
+            return np.exp(-0.5 * (offsets / sigma)**2)
+        else:
+            raise RuntimeError(f"No such kernel: {self.kernel}")
+
+    def fit_continuum(self, **kwargs):
+        """Measure the continuum with a sigma clipped kernel convolution.
+
+        Parameters
+        ----------
+        box_size : `float`, optional
+            Width of the smoothing kernel, in AA.  Default = 40.0.
+        kernel : `str`, optional
+            Kernel shape, either `boxcar` or `gaussian`.
+        clip_sigma : `float`, optional
+            Rejection threshold for line pixels, in units of the
+            local noise.  Default = 3.0.
+        clip_iterations : `int`, optional
+            Maximum number of rejection iterations.  Default = 5.
+        continuum_normalized : `bool`, optional
+            Scale the error by the continuum level.
+
+        Notes
+        -----
+        The continuum is the normalized convolution of the masked
+        spectrum, `conv(w y, k) / conv(w, k)`, with `w` the mask of
+        unrejected pixels.  The local noise is measured in the same
+        way from the squared residuals, and pixels that deviate by
+        more than `clip_sigma` are removed from the mask for the next
+        iteration.  Every convolution is done with an FFT, so the
+        cost is independent of the kernel width.
+        """
+        self._configContinuum(**kwargs)
+        logger = logging.getLogger(__name__)
+        logger.setLevel(self.verbose)
+
+        temp = np.asarray(self.y - self.lines, dtype=float)
+        finite = np.isfinite(temp)
+        data = np.where(finite, temp, 0.0)
+        kernel = self._kernel()
+        floor = 1e-6 * np.sum(kernel)
+        index = np.arange(len(data))
+
+        weight = finite.astype(float)
+        for iteration in range(self.clip_iterations + 1):
+            denominator = spS.fftconvolve(weight, kernel, mode='same')
+            valid = denominator > floor
+            if not np.any(valid):
+                raise RuntimeError("No unmasked pixels remain for the continuum fit.")
+            with np.errstate(divide='ignore', invalid='ignore'):
+                continuum = spS.fftconvolve(weight * data, kernel, mode='same') / denominator
+                continuum = np.interp(index, index[valid], continuum[valid])
+
+                residual = np.where(finite, data - continuum, 0.0)
+                variance = spS.fftconvolve(weight * residual**2, kernel, mode='same') / denominator
+                sigma = np.sqrt(np.clip(np.interp(index, index[valid], variance[valid]), 0.0, None))
+
+            mask = finite & (np.abs(residual) <= self.clip_sigma * sigma)
+            logger.debug("Iteration %d: %d pixels rejected" % (iteration, np.sum(~mask)))
+            if np.array_equal(mask, weight > 0):
+                break
+            weight = mask.astype(float)
+
+        self.continuum = continuum
+        if self.continuum_normalized is True:
+            # This should be correct for continuum normalized data.
+            self.error = sigma / continuum
+        else:
+            self.error = sigma
+
+    def fit_error(self, **kwargs):
+        logger = logging.getLogger(__name__)
+        logger.setLevel(self.verbose)
+        pass
@@ -18,7 +18,6 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 import logging
-import multiprocessing
 import numpy as np
 from robospect import spectra
 
@@ -34,7 +33,6 @@ class continuum_parallel_boxcar(spectra.spectrum):
 
         self.box_size = 40.0
         self.continuum_normalized = True
-        self.nParallel = 12
 
         super().__init__(*args, **kwargs)
         config = kwargs.get(self.modelPhase, dict())
@@ -45,8 +43,6 @@ class continuum_parallel_boxcar(spectra.spectrum):
             self.box_size = float(kwargs.get('box_size', 40.0))
         if 'continuum_normalized' in kwargs:
             self.continuum_normalized = kwargs.get('continuum_normalized', True)
-        if 'parallel' in kwargs:
-            self.nParallel = int(kwargs.get('parallel', 12))
 
     def fit_continuum(self, **kwargs):
         self._configContinuum(**kwargs)
@@ -54,28 +50,20 @@ class continuum_parallel_boxcar(spectra.spectrum):
         logger.setLevel(self.verbose)
 
         temp = self.y - self.lines
-        fitD = []
-        for idx, w in enumerate(self.x):
-            start = np.searchsorted(self.x, w - self.box_size / 2.0, side='left')
-            end = np.searchsorted(self.x, w + self.box_size / 2.0, side='right')
-            if start < 0:
-                start = 0
-            if end > len(self.x) - 1:
-                end = len(self.x) - 1
+        starts, ends = self.window_bounds(self.box_size)
+        starts = np.clip(starts, 0, None)
+        ends = np.clip(ends, None, len(self.x) - 1)
+        fitD = [np.array(temp[start:end]) for start, end in zip(starts, ends)]
 
-            fitD.append(np.array(temp[start:end]))
-
-        with multiprocessing.Manager() as manager:
-            with multiprocessing.Pool(self.nParallel) as pool:
-                R = pool.starmap_async(parval, zip(fitD))
-                for idx, r in enumerate(R.get()):
-                    v, n = r
-                    self.continuum[idx] = v
-                    if self.continuum_normalized is True:
-                        # This should be correct for continuum normalized data.
-                        self.error[idx] = n / v
-                    else:
-                        self.error[idx] = n
+        with self.pool('continuum') as pool:
+            for idx, r in enumerate(pool.map(parval, fitD)):
+                v, n = r
+                self.continuum[idx] = v
+                if self.continuum_normalized is True:
+                    # This should be correct for continuum normalized data.
+                    self.error[idx] = n / v
+                else:
+                    self.error[idx] = n
 
     def fit_error(self, **kwargs):
         logger = logging.getLogger(__name__)
@@ -45,7 +45,7 @@ class deblend_group(spectra.spectrum):
             self.profileName = kwargs.get('profileName', 'gauss')
         if 'deblendRadius' in kwargs:
             self.deblendRadius = float(kwargs.get('deblendRadius', 3.0))
-        self.profile = profileFromName(self.profileName)
+        self.profile = profileFromName(self.profileName, backend=self.backend)
 
     def fit_deblend(self, **kwargs):
         """Use scipy.optimize to fit a non-linear least squares model.
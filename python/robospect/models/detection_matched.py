@@ -0,0 +1,163 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import heapq
+import logging
+import numpy as np
+import scipy.signal as spS
+import robospect.spectra as spectra
+import robospect.lines as lines
+from robospect import kernels
+
+
+__all__ = ['detection_matched']
+
+
+class detection_matched(spectra.spectrum):
+    modelName = 'matched'
+    modelPhase = 'detection'
+
+    def __init__(self, *args, **kwargs):
+        self.modelName = 'matched'
+        self.modelPhase = 'detection'
+
+        self.threshold = 5.0
+        self.widths = [1.0, 2.0, 4.0, 8.0]
+        super().__init__(*args, **kwargs)
+        config = kwargs.get(self.modelPhase, dict())
+        self._configDetection(**config)
+
+    def _configDetection(self, **kwargs):
+        if 'threshold' in kwargs:
+            self.threshold = float(kwargs.get('threshold', 5.0))
+        if 'widths' in kwargs:
+            widths = kwargs.get('widths')
+            if isinstance(widths, str):
+                widths = widths.split(",")
+            self.widths = [float(w) for w in widths]
+
+    def matched_filter(self):
+        """Convolve the residual spectrum with the bank of Gaussian kernels.
+
+        Returns
+        -------
+        signal_to_noise : `np.ndarray`
+            Best matched filter S/N at each pixel.
+        amplitude : `np.ndarray`
+            Kernel amplitude estimate at the best scale.
+        scale : `np.ndarray` of `int`
+            Index into `self.widths` of the best scale.
+
+        Notes
+        -----
+        For a kernel `t` and inverse variance weights `w`, the filter
+        amplitude is `conv(w d, t) / conv(w, t^2)` and its S/N is
+        `conv(w d, t) / sqrt(conv(w, t^2))`.  Pixels without a valid
+        error receive zero weight.  Each scale costs one pair of FFT
+        convolutions.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = 1.0 / np.asarray(self.error, dtype=float)**2
+        weight[~np.isfinite(weight)] = 0.0
+        residual = np.asarray(self.y - self.continuum, dtype=float)
+        residual[~np.isfinite(residual)] = 0.0
+        weighted = weight * residual
+
+        signal_to_noise = np.zeros(len(residual))
+        amplitude = np.zeros(len(residual))
+        scale = np.zeros(len(residual), dtype=int)
+        for idx, sigma in enumerate(self.widths):
+            half_width = int(np.ceil(4.0 * sigma))
+            offsets = np.arange(-half_width, half_width + 1)
+            kernel = np.exp(-0.5 * (offsets / sigma)**2)
+
+            numerator = spS.fftconvolve(weighted, kernel, mode='same')
+            denominator = spS.fftconvolve(weight, kernel * kernel, mode='same')
+            # FFT round off can leave small negative values in empty regions.
+            valid = denominator > 1e-12 * np.max(denominator, initial=0.0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                SN = np.where(valid, numerator / np.sqrt(denominator), 0.0)
+                A = np.where(valid, numerator / denominator, 0.0)
+
+            better = np.abs(SN) > signal_to_noise
+            signal_to_noise[better] = np.abs(SN[better])
+            amplitude[better] = A[better]
+            scale[better] = idx
+        return signal_to_noise, amplitude, scale
+
+    def fit_detection(self, **kwargs):
+        """Use a matched filter bank to identify potential lines.
+
+        Parameters
+        ----------
+        threshold : `float`, optional
+            Matched filter S/N threshold for a pixel to be flagged as
+            part of a line.  Default = 5.0.
+        widths : `list` of `float` or `str`, optional
+            Gaussian kernel sigmas, in pixels.  A comma separated
+            string is accepted from the command line.  Default =
+            1,2,4,8.
+
+        Flags
+        -----
+        DETECTED :
+            Set to mark that this line was detected from the data
+
+        Notes
+        -----
+        The residual spectrum is filtered at each scale, and the best
+        S/N over all scales is used for peak finding.  Summing over
+        the kernel means weak broad lines reach the threshold, while
+        single noisy pixels are averaged down.  Each new line is
+        seeded with the center, width and amplitude of the best
+        matching kernel.  Candidates that fall within one kernel
+        sigma of an existing line are not added.
+        """
+        self._configDetection(**kwargs)
+        logger = logging.getLogger(__name__)
+        logger.setLevel(self.verbose)
+
+        signal_to_noise, amplitude, scale = self.matched_filter()
+        peaks, peak_values = kernels.peak_runs(signal_to_noise, self.threshold, self.backend)
+        widths = np.asarray(self.widths)[scale[peaks]]
+
+        known_peaks = np.sort(np.searchsorted(self.x, [l.x0 for l in self.L], side='left'))
+        known = np.zeros(len(peaks), dtype=bool)
+        if len(known_peaks) > 0:
+            position = np.searchsorted(known_peaks, peaks)
+            left = known_peaks[np.clip(position - 1, 0, len(known_peaks) - 1)]
+            right = known_peaks[np.clip(position, 0, len(known_peaks) - 1)]
+            nearest = np.minimum(np.abs(peaks - left), np.abs(peaks - right))
+            known = nearest <= np.maximum(widths, 1.0)
+
+        spacing = np.abs(np.gradient(self.x)) if len(self.x) > 1 else np.ones(len(self.x))
+        new_lines = []
+        for peak_idx, peak_val, width in zip(peaks[~known], peak_values[~known], widths[~known]):
+            sigma = width * spacing[peak_idx]
+            new_line = lines.line(x0=self.x[peak_idx],
+                                  comment=f"Found by model_detection_matched @ S/N={peak_val:.3f}",
+                                  Q=np.array([self.x[peak_idx], sigma, amplitude[peak_idx]]))
+            new_line.pQ = new_line.Q
+            new_line.flags.set("DETECTED")
+            new_lines.append(new_line)
+            logger.debug(f"Found: {new_line} @{peak_val:.3f}")
+
+        if len(self.L) > 1 and np.any(np.diff([l.x0 for l in self.L]) < 0):
+            self.L.sort(key=lines.sortLines)
+        self.L = list(heapq.merge(self.L, new_lines, key=lines.sortLines))
@@ -17,11 +17,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
+import heapq
 import logging
 import numpy as np
 import robospect.spectra as spectra
 import robospect.lines as lines
 import robospect.flags as flags
+from robospect import kernels
 
 
 __all__ = ['detection_naive']
@@ -45,7 +47,7 @@ class detection_naive(spectra.spectrum):
             self.threshold = float(kwargs.get('threshold', 3.0))
 
     def peak_index_from_wavelength(self, wavelength, SN, search_width=5):
-        index_guess = np.searchsorted(self.x, wavelength, side='left')
+        index_guess = self.index_from_wavelength(wavelength, side='left')
         testArray = SN[index_guess - search_width:index_guess + search_width]
         if len(testArray) <= 0:
             return index_guess
@@ -75,9 +77,13 @@ class detection_naive(spectra.spectrum):
 
         Notes
         -----
-        Iterate over the S/N array, identify pixels that are above the
-        detection threshold, and make sure they are local maxima.
-
+        Label the contiguous runs of pixels that are above the
+        detection threshold, and take the local maximum of each run as
+        the candidate line position.  Runs are found from the edges of
+        the threshold mask, and the maxima are found with `reduceat`,
+        so no per-pixel python loop is required.  Candidates that
+        coincide with an already known line are rejected by searching
+        a sorted array of the known peak indices.
         """
         self._configDetection(**kwargs)
         logger = logging.getLogger(__name__)
@@ -85,32 +91,27 @@ class detection_naive(spectra.spectrum):
 
         with np.errstate(divide='ignore', invalid='ignore'):
             signal_to_noise = abs((self.y - self.continuum)/self.error)
-        known_peaks = [self.peak_index_from_wavelength(l.x0, signal_to_noise) for l in self.L]
-
-        in_line = False
-        peak_idx = -1
-        peak_val = -99
-
-        for idx, SN in enumerate(signal_to_noise):
-            if in_line is False and SN > self.threshold:
-                in_line = True
-                peak_idx = idx
-                peak_val = SN
-            elif in_line is True and SN > peak_val:
-                peak_idx = idx
-                peak_val = SN
-            elif in_line is True and SN < self.threshold:
-                if peak_idx not in known_peaks:
-                    new_line = lines.line(x0=self.x[peak_idx],
-                                          comment=f"Found by model_detection_naive @ S/N={peak_val:.3f}")
-                    new_line.flags.set("DETECTED")
-                    self.L.append(new_line)
-                    known_peaks.append(peak_idx)
-                    logger.debug(f"Found: {new_line} @{peak_val:.3f}")
-                in_line = False
-                peak_idx = -1
-                peak_val = -99
-            else:
-                logger.debug("Edge case: %d %f %d %d %f" % (idx, SN, in_line, peak_idx, peak_val))
-                pass
-        self.L.sort(key=lines.sortLines)
+        known_peaks = np.unique([self.peak_index_from_wavelength(l.x0, signal_to_noise)
+                                 for l in self.L]).astype(int)
+
+        peaks, peak_values = kernels.peak_runs(signal_to_noise, self.threshold, self.backend)
+
+        position = np.searchsorted(known_peaks, peaks)
+        known = np.zeros(len(peaks), dtype=bool)
+        inside = position < len(known_peaks)
+        known[inside] = known_peaks[position[inside]] == peaks[inside]
+
+        new_lines = []
+        for peak_idx, peak_val in zip(peaks[~known], peak_values[~known]):
+            new_line = lines.line(x0=self.x[peak_idx],
+                                  comment=f"Found by model_detection_naive @ S/N={peak_val:.3f}")
+            new_line.flags.set("DETECTED")
+            new_lines.append(new_line)
+            logger.debug(f"Found: {new_line} @{peak_val:.3f}")
+
+        # The catalog is kept sorted, so the new lines (which are
+        # already in wavelength order) only need to be merged in.
+        if len(self.L) > 1 and np.any(np.diff([l.x0 for l in self.L]) < 0):
+            self.L.sort(key=lines.sortLines)
+        self.L = list(heapq.merge(self.L, new_lines, key=lines.sortLines))
+
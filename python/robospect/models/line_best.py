@@ -19,7 +19,6 @@
 #
 import itertools
 import logging
-import multiprocessing
 import scipy.optimize as spO
 import numpy as np
 from robospect import spectra
@@ -36,7 +35,6 @@ class line_best(spectra.spectrum):
         self.modelPhase = 'line'
 
         self.profileName = 'gauss'
-        self.nParallel = 12
 
         super().__init__(*args, **kwargs)
         config = kwargs.get(self.modelPhase, dict())
@@ -45,11 +43,7 @@ class line_best(spectra.spectrum):
     def _configLine(self, **kwargs):
         if 'profileName' in kwargs:
             self.profileName = kwargs.get('profileName', 'gauss')
-        if 'nProc' in kwargs:
-            self.nParallel = int(kwargs.get('nProc', 12))
-        if 'parallel' in kwargs:
-            self.nParallel = int(kwargs.get('parallel', 12))
-        self.profile = profileFromName(self.profileName)
+        self.profile = profileFromName(self.profileName, backend=self.backend)
 
     def _fit_N_simul(self, X, Q):
         F = np.zeros_like(X)
@@ -110,33 +104,32 @@ class line_best(spectra.spectrum):
                 line.flags.set("FIT_BOUND")
                 continue
 
-            start = np.searchsorted(self.x, line.Q[0] - 5.0 * abs(line.Q[1]), side='left')
-            end   = np.searchsorted(self.x, line.Q[0] + 5.0 * abs(line.Q[1]), side='right')
+            start = self.index_from_wavelength(line.Q[0] - 5.0 * abs(line.Q[1]), side='left')
+            end   = self.index_from_wavelength(line.Q[0] + 5.0 * abs(line.Q[1]), side='right')
 
             while (end - start < 5):
                 end = end + 1
                 start = start - 1
 
-            vecQ.append(np.array(line.Q))
+            vecQ.append(self.profile.initial(line.Q))
             vecT.append(np.array(self.x[start:end]))
             vecY.append(np.array(self.y[start:end] - self.continuum[start:end]))
             vecE.append(np.array(self.error[start:end]))
 
-        with multiprocessing.Manager() as manager:
-            with multiprocessing.Pool(self.nParallel) as pool:
-                R = pool.starmap_async(indep_fit_one, zip(vecQ, vecT, vecY, vecE,
-                                                          itertools.repeat(self.profile.fO)))
-
-                for r, l in zip(R.get(), self.L):
-                    flag, Q, dQ, chi = r
-                    if flag == "NONE":
-                        l.flags.set(flag)
-                        l.Q = Q
-                        l.dQ = dQ
-                        l.chi = chi
-                    else:
-                        l.flags.set(flag)
-                    logger.debug(f"Fit: {l.chi:.3f} {l}")
+        with self.pool('line') as pool:
+            R = pool.starmap(indep_fit_one, zip(vecQ, vecT, vecY, vecE,
+                                                itertools.repeat(self.profile.fO)))
+
+            for r, l in zip(R, self.L):
+                flag, Q, dQ, chi = r
+                if flag == "NONE":
+                    l.flags.set(flag)
+                    l.Q = Q
+                    l.dQ = dQ
+                    l.chi = chi
+                else:
+                    l.flags.set(flag)
+                logger.debug(f"Fit: {l.chi:.3f} {l}")
 
 
 def indep_fit_one(Q, T, Y, E, fO):
@@ -23,6 +23,7 @@ import numpy as np
 from robospect import spectra
 from robospect import lines
 from robospect import models
+from robospect import kernels
 
 __all__ = ['line_gauss_guess']
 
@@ -57,23 +58,13 @@ class line_gauss_guess(spectra.spectrum):
             #            raise RuntimeError("line_gauss_guess.centroid: division by zero")
         return V/W
 
-    def _interpY(self, X, Y, index, value, side='left'):
-        if side == 'left':
-            dy = Y[index] - Y[index - 1]
-            dx = X[index] - X[index - 1]
-        elif side == 'right':
-            dy = Y[index] - Y[index - 1]
-            dx = X[index] - X[index - 1]
-
-        return(dx / dy * (value - Y[index - 1]) + X[index - 1])
-
     def fit_initial(self, **kwargs):
         self._configInitial(**kwargs)
         logger = logging.getLogger(__name__)
         logger.setLevel(self.verbose)
 
         self.lines = np.copy(self.continuum)
-        P = models.gaussian()
+        P = models.gaussian(backend=self.backend)
         temp = (self.y - self.continuum)
 
         for line in self.L:
@@ -85,12 +76,12 @@ class line_gauss_guess(spectra.spectrum):
             if line.x0 < self.min() or line.x0 > self.max():
                 continue
 
-            center= np.searchsorted(self.x, line.x0, side='left')
+            center= self.index_from_wavelength(line.x0, side='left')
             if center < 0 or center >= len(self.x):
                 continue
 
-            start = np.searchsorted(self.x, line.x0 - self.range, side='left')
-            end   = np.searchsorted(self.x, line.x0 + self.range, side='right')
+            start = self.index_from_wavelength(line.x0 - self.range, side='left')
+            end   = self.index_from_wavelength(line.x0 + self.range, side='right')
             logger.debug("Centroid search: %d %d => %f %f" % (start, end, self.x[start], self.x[end]))
 
             # mean
@@ -109,25 +100,8 @@ class line_gauss_guess(spectra.spectrum):
 
             ## This is truncating the two sides unevenly, I think,
             ## which to sigma differences, which are the issue.
-            hwhm1, hwqm1, hw3qm1 = (0.0, 0.0, 0.0)
-            for idx in range(center, start, -1):
-                if hw3qm1 == 0.0 and abs(temp[idx - 1] / F) < 0.75:
-                    hw3qm1 = self._interpY(self.x, temp, idx, 0.75 * F)
-                if hwhm1 == 0.0 and abs(temp[idx - 1] / F) < 0.5:
-                    hwhm1 = self._interpY(self.x, temp, idx, 0.5 * F)
-                if hwqm1 == 0.0 and abs(temp[idx - 1] / F) < 0.25:
-                    hwqm1 = self._interpY(self.x, temp, idx, 0.5 * F)
-                    break
-
-            hwhm2, hwqm2, hw3qm2 = (0.0, 0.0, 0.0)
-            for idx in range(center , end + 1, 1):
-                if hw3qm2 == 0.0 and abs(temp[idx + 1] / F) < 0.75:
-                    hw3qm2 = self._interpY(self.x, temp, idx, 0.75 * F, side='right')
-                if hwhm2 == 0.0 and abs(temp[idx + 1] / F) < 0.5:
-                    hwhm2 = self._interpY(self.x, temp, idx, 0.5 * F, side='right')
-                if hwqm2 == 0.0 and abs(temp[idx + 1] / F) < 0.25:
-                    hwqm2 = self._interpY(self.x, temp, idx, 0.5 * F, side='right')
-                    break
+            hw3qm1, hwhm1, hwqm1, hw3qm2, hwhm2, hwqm2 = kernels.half_widths(self.x, temp, center,
+                                                                            start, end, F, self.backend)
 
             hwhm1 = abs(hwhm1 - m)
             hwhm2 = abs(hwhm2 - m)
@@ -184,7 +158,6 @@ class line_gauss_guess(spectra.spectrum):
             np.append(line.Q, eta)
 
             line.pQ = line.Q
-            for dx in range(start, end):
-                self.lines[dx] = self.lines[dx] - P.eval(self.x[dx], line.Q)
+            self.lines[start:end] = self.lines[start:end] - P.eval(self.x[start:end], line.Q)
             logger.debug(f"End: {line}")
 
@@ -17,11 +17,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
-import itertools
 import logging
 import multiprocessing
+import os
+import threading
+import time
 import scipy.optimize as spO
 import numpy as np
+from robospect import executors
 from robospect import spectra
 from robospect.models.profile_shapes import profileFromName
 
@@ -36,7 +39,10 @@ class line_mp_nlls(spectra.spectrum):
         self.modelPhase = 'line'
 
         self.profileName = 'gauss'
-        self.nParallel = 12
+        self.maxfev = None
+        self.timeout = None
+        self.fallback = 'none'
+        self.utilization = []
 
         super().__init__(*args, **kwargs)
         config = kwargs.get(self.modelPhase, dict())
@@ -45,11 +51,15 @@ class line_mp_nlls(spectra.spectrum):
     def _configLine(self, **kwargs):
         if 'profileName' in kwargs:
             self.profileName = kwargs.get('profileName', 'gauss')
-        if 'nProc' in kwargs:
-            self.nParallel = int(kwargs.get('nProc', 12))
-        if 'parallel' in kwargs:
-            self.nParallel = int(kwargs.get('parallel', 12))
-        self.profile = profileFromName(self.profileName)
+        if 'maxfev' in kwargs:
+            self.maxfev = int(kwargs.get('maxfev')) if kwargs.get('maxfev') is not None else None
+        if 'timeout' in kwargs:
+            self.timeout = float(kwargs.get('timeout')) if kwargs.get('timeout') is not None else None
+        if 'fallback' in kwargs:
+            self.fallback = kwargs.get('fallback', 'none')
+            if self.fallback not in ('none', 'fixed_mean'):
+                raise RuntimeError(f"No such fallback: {self.fallback}")
+        self.profile = profileFromName(self.profileName, backend=self.backend)
 
     def _fit_one(self, Q, T, Y, E):
         try:
@@ -69,12 +79,26 @@ class line_mp_nlls(spectra.spectrum):
 
         Parameters
         ----------
+        maxfev : `int`, optional
+            Maximum number of function evaluations for each line.
+            Defaults to the scipy default, 200 (N + 1) for N
+            parameters.
+        timeout : `float`, optional
+            Maximum time to spend fitting each line, in seconds.
+        fallback : `str`, optional
+            Model to refit lines that exceed their budget with.
+            `fixed_mean` holds the line center at its initial value;
+            `none` (the default) keeps the initial estimate.  The
+            refit is given the full `maxfev` and `timeout` again, so
+            a line that falls back may take up to twice the budget.
 
         Returns
         -------
 
         Raises
         ------
+        RuntimeError :
+            Raised if the fallback model is not known.
 
         Flags
         -----
@@ -82,63 +106,252 @@ class line_mp_nlls(spectra.spectrum):
             Set if the line to measure falls outside the bounds of the spectrum.
         FIT_FAIL :
             Set if the curve fit code raises an error that is ignored.
+        FIT_BUDGET :
+            Set if the fit exceeded `maxfev` or `timeout`.
+
+        Notes
+        -----
+        The fits are collected as they finish, so one slow line does
+        not delay the others.  The timeout is checked on every function
+        evaluation.  If no fit is returned for twice the time the
+        pending fits are allowed, the pool is stopped and the remaining
+        lines are flagged FIT_BUDGET.  This guard needs a separate
+        worker, and does not apply when the fits run serially, in this
+        process; only the timeout on each function evaluation does.
+
+        The cost of each fit is estimated from the width of its window
+        and the number of function evaluations of its previous fit, and
+        the most expensive fits are started first.  A fit stopped by
+        the budget counts the evaluations it used.  The fraction of the
+        time each worker spent fitting is stored in `utilization`, most
+        used first, with workers that were given no fits at 0.
         """
         self._configLine(**kwargs)
         logger = logging.getLogger(__name__)
         logger.setLevel(self.verbose)
 
-        vecQ = []
-        vecT = []
-        vecY = []
-        vecE = []
-        for line in self.L:
+        tasks = []
+        for index, line in enumerate(self.L):
             line.flags.reset(flagList=["FIT_BOUND", "FIT_FAIL"])
+            line.flags.unset("FIT_BUDGET")
 
             if line.x0 < self.min() or line.x0 > self.max():
                 line.flags.set("FIT_BOUND")
                 continue
 
-            start = np.searchsorted(self.x, line.Q[0] - 5.0 * abs(line.Q[1]), side='left')
-            end   = np.searchsorted(self.x, line.Q[0] + 5.0 * abs(line.Q[1]), side='right')
+            start = self.index_from_wavelength(line.Q[0] - 5.0 * abs(line.Q[1]), side='left')
+            end   = self.index_from_wavelength(line.Q[0] + 5.0 * abs(line.Q[1]), side='right')
 
             while (end - start < 5):
                 end = end + 1
                 start = start - 1
 
-            vecQ.append(np.array(line.Q))
-            vecT.append(np.array(self.x[start:end]))
-            vecY.append(np.array(self.y[start:end] - self.continuum[start:end]))
-            vecE.append(np.array(self.error[start:end]))
+            tasks.append((index, self.profile.initial(line.Q),
+                          np.array(self.x[start:end]),
+                          np.array(self.y[start:end] - self.continuum[start:end]),
+                          np.array(self.error[start:end]),
+                          self.profile.fO, self.maxfev, self.timeout, self.fallback))
+        if len(tasks) == 0:
+            return
 
-        with multiprocessing.Manager() as manager:
-            with multiprocessing.Pool(self.nParallel) as pool:
-                R = pool.starmap_async(indep_fit_one, zip(vecQ, vecT, vecY, vecE,
-                                                          itertools.repeat(self.profile.fO)))
+        workers = self.pool_workers('line')
+        chunks = _schedule(tasks, [self._cost(self.L[task[0]], len(task[2])) for task in tasks],
+                           workers)
+        wait = None
+        if self.timeout is not None:
+            longest = max(len(chunk) for chunk in chunks)
+            wait = 2.0 * longest * self.timeout * (2 if self.fallback != 'none' else 1) + 5.0
 
-                for r, l in zip(R.get(), self.L):
-                    flag, Q, dQ, chi = r
-                    if flag == "NONE":
-                        l.flags.set(flag)
-                        l.Q = Q
-                        l.dQ = dQ
-                        l.chi = chi
-                    else:
+        done = set()
+        busy = dict()
+        start = time.perf_counter()
+        with self.pool('line') as pool:
+            size = 1 if isinstance(pool, executors.SerialPool) else workers
+            results = pool.imap_unordered(_fit_chunk, chunks)
+            try:
+                for chunk in chunks:
+                    worker, elapsed, fits = results.next(wait)
+                    busy[worker] = busy.get(worker, 0.0) + elapsed
+                    for index, flag, Q, dQ, chi, nfev in fits:
+                        done.add(index)
+                        l = self.L[index]
                         l.flags.set(flag)
-                    logger.debug(f"Fit: {l.chi:.3f} {l}")
+                        if Q is not None:
+                            l.Q = Q
+                            l.dQ = dQ
+                            l.chi = chi
+                        l.nfev = nfev
+                        logger.debug(f"Fit: {l.chi:.3f} {l}")
+            except multiprocessing.TimeoutError:
+                pool.terminate()
+                logger.warning(f"Line fits stalled; {len(tasks) - len(done)} lines not fit.")
+                # The lines left ran at least as long as any that finished.
+                stalled = max([self.L[index].nfev for index in done] +
+                              [self.maxfev or 0, _DEFAULT_NFEV])
+                for task in tasks:
+                    if task[0] not in done:
+                        self.L[task[0]].flags.set("FIT_BUDGET")
+                        self.L[task[0]].nfev = stalled
+        wall = time.perf_counter() - start
+
+        busy = sorted(busy.values(), reverse=True)
+        busy += [0.0] * (size - len(busy))
+        self.utilization = [t / wall for t in busy] if wall > 0 else []
+        logger.info(f"Fit {len(tasks)} lines in {len(chunks)} chunks, {wall:.3f}s: worker utilization " +
+                    " ".join(f"{u:.2f}" for u in self.utilization))
+
+    def _cost(self, line, width):
+        """Estimate the relative cost of fitting a line.
+
+        Parameters
+        ----------
+        line : `robospect.lines.line`
+            The line to fit.  `nfev` holds the number of function
+            evaluations of its previous fit, if any.
+        width : `int`
+            Number of pixels in the fit window.
+
+        Returns
+        -------
+        cost : `float`
+            Expected cost, in pixel evaluations.
+        """
+        nfev = line.nfev if line.nfev > 0 else _DEFAULT_NFEV
+        return float(width * nfev)
+
+
+# Expected function evaluations for a line without a previous fit.
+_DEFAULT_NFEV = 20
 
 
+class _Budget(Exception):
+    pass
 
-def indep_fit_one(Q, T, Y, E, fO):
+
+class _Deadline():
+    """Wrap a model function to stop the fit at a deadline."""
+    def __init__(self, fO, timeout):
+        self.fO = fO
+        self.deadline = time.perf_counter() + timeout
+        self.nfev = 0
+
+    def __call__(self, *args):
+        self.nfev += 1
+        if time.perf_counter() > self.deadline:
+            raise _Budget()
+        return self.fO(*args)
+
+
+def indep_fit_one(Q, T, Y, E, fO, maxfev=None, timeout=None):
+    """Fit one line.
+
+    Returns
+    -------
+    flag : `str`
+        `NONE` on success, `FIT_BUDGET` if `maxfev` or `timeout` was
+        exceeded, and `FIT_FAIL` otherwise.
+    Q, dQ : `np.ndarray`
+        Fit parameters and their uncertainties.
+    chi : `float`
+        Trace of the covariance matrix.
+    nfev : `int`
+        Number of function evaluations, including those of a fit
+        stopped by the budget, or -1 if not known.
+    """
+    f = _Deadline(fO, timeout) if timeout is not None else fO
+    options = dict() if maxfev is None else {'maxfev': maxfev}
     try:
-        result = spO.curve_fit(fO, np.array(T), np.array(Y),
+        result = spO.curve_fit(f, np.array(T), np.array(Y),
                                p0=np.array(Q),
                                sigma=np.array(E), absolute_sigma=True,
-                               check_finite=True, method='lm')
+                               check_finite=True, method='lm', full_output=True,
+                               **options)
         flag = "NONE"
-        return flag, result[0], np.sqrt(np.diagonal(result[1])), np.trace(result[1])
-    except (RuntimeError, TypeError) as e:
-        print(e)
-        flag = "FIT_FAIL"
-        return flag, Q, 0.1 * Q, 10000.0
+        return flag, result[0], np.sqrt(np.diagonal(result[1])), np.trace(result[1]), result[2]['nfev']
+    except _Budget:
+        return "FIT_BUDGET", Q, 0.1 * Q, 10000.0, f.nfev
+    except RuntimeError as e:
+        if 'maxfev' in str(e):
+            return "FIT_BUDGET", Q, 0.1 * Q, 10000.0, maxfev if maxfev is not None else -1
+        return "FIT_FAIL", Q, 0.1 * Q, 10000.0, -1
+    except TypeError:
+        return "FIT_FAIL", Q, 0.1 * Q, 10000.0, -1
+
+
+def _schedule(tasks, costs, nParallel):
+    """Order and group line fits to balance the load on the workers.
+
+    Parameters
+    ----------
+    tasks : `list`
+        The fits to do.
+    costs : `list` of `float`
+        The estimated cost of each fit.
+    nParallel : `int`
+        Number of worker processes.
+
+    Returns
+    -------
+    chunks : `list` of `list`
+        Groups of fits, most expensive first.
+
+    Notes
+    -----
+    The fits are sorted by decreasing cost (longest processing time
+    first), and consecutive fits are grouped until a chunk holds
+    1/(4 nParallel) of the total cost.  Expensive fits are therefore
+    sent alone and early, while the many cheap fits at the end are
+    batched to limit the dispatch overhead, and are small enough to
+    fill in the gaps left by the others.
+    """
+    order = sorted(range(len(tasks)), key=lambda i: costs[i], reverse=True)
+    target = sum(costs) / (4 * nParallel)
+
+    chunks = []
+    chunk = []
+    total = 0.0
+    for i in order:
+        chunk.append(tasks[i])
+        total += costs[i]
+        if total >= target:
+            chunks.append(chunk)
+            chunk = []
+            total = 0.0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _fit_chunk(tasks):
+    """Fit a list of lines, refitting with the fallback model if over budget.
+
+    Returns
+    -------
+    worker : `tuple`
+        Process and thread that did the fits.
+    elapsed : `float`
+        Time spent fitting, in seconds.
+    results : `list`
+        The result of each fit.
+    """
+    start = time.perf_counter()
+    results = [_fit_task(*task) for task in tasks]
+    return (os.getpid(), threading.get_ident()), time.perf_counter() - start, results
 
 
+def _fit_task(index, Q, T, Y, E, fO, maxfev, timeout, fallback):
+    flag, fitQ, dQ, chi, nfev = indep_fit_one(Q, T, Y, E, fO, maxfev, timeout)
+    if flag == "FIT_FAIL":
+        fitQ = None
+    elif flag == "FIT_BUDGET":
+        fitQ = None
+        if fallback == 'fixed_mean':
+            mean = Q[0]
+            fixed = lambda x, *q: fO(x, mean, *q)
+            subflag, subQ, subdQ, chi, subnfev = indep_fit_one(Q[1:], T, Y, E, fixed,
+                                                               maxfev, timeout)
+            if subflag == "NONE":
+                fitQ = np.concatenate(([mean], subQ))
+                dQ = np.concatenate(([0.0], subdQ))
+            nfev += max(subnfev, 0)
+    return index, flag, fitQ, dQ, chi, nfev
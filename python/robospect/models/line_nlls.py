@@ -42,7 +42,7 @@ class line_nlls(spectra.spectrum):
     def _configLine(self, **kwargs):
         if 'profileName' in kwargs:
             self.profileName = kwargs.get('profileName', 'gauss')
-        self.profile = profileFromName(self.profileName)
+        self.profile = profileFromName(self.profileName, backend=self.backend)
 
     def fit_lines(self, **kwargs):
         """Use scipy.optimize to fit a non-linear least squares model.
@@ -74,8 +74,8 @@ class line_nlls(spectra.spectrum):
                 line.flags.set("FIT_BOUND")
                 continue
 
-            start = np.searchsorted(self.x, line.Q[0] - 5.0 * abs(line.Q[1]), side='left')
-            end   = np.searchsorted(self.x, line.Q[0] + 5.0 * abs(line.Q[1]), side='right')
+            start = self.index_from_wavelength(line.Q[0] - 5.0 * abs(line.Q[1]), side='left')
+            end   = self.index_from_wavelength(line.Q[0] + 5.0 * abs(line.Q[1]), side='right')
 
             while (end - start < 5):
                 end = end + 1
@@ -87,7 +87,7 @@ class line_nlls(spectra.spectrum):
 
             try :
                 optimizeResult = spO.curve_fit(self.profile.fO, np.array(T), np.array(Y),
-                                               p0=np.array(line.Q),
+                                               p0=self.profile.initial(line.Q),
                                                sigma=np.array(E), absolute_sigma=True,
                                                check_finite=True, method='lm')
                 #                              jac=self.profile.dfO)
@@ -20,6 +20,7 @@
 import logging
 import numpy as np
 import robospect.spectra as spectra
+from robospect import kernels
 
 __all__ = ['noise_boxcar']
 
@@ -46,9 +47,6 @@ class noise_boxcar(spectra.spectrum):
         logger.setLevel(self.verbose)
 
         temp = abs(self.y - self.lines - self.continuum)
-        for idx, w in enumerate(self.x):
-            start = np.searchsorted(self.x, w - self.box_size / 2.0, side='left')
-            end = np.searchsorted(self.x, w + self.box_size / 2.0, side='right')
+        start, end = self.window_bounds(self.box_size)
 
-            noise = temp[start:end]
-            self.error[idx] = 1.4826 * np.median(noise)
+        self.error = 1.4826 * kernels.window_median(temp, start, end, self.backend)
@@ -20,16 +20,20 @@
 
 import numpy as np
 import scipy as sp
+from robospect import kernels
 
-__all__ = ['profileFromName', 'profile', 'gaussian', 'voigt', 'lorentzian', 'planck', 'skewgauss']
+__all__ = ['profileFromName', 'profile', 'gaussian', 'voigt', 'humlicek', 'humlicek_w4',
+           'lorentzian', 'planck', 'skewgauss']
 
-def profileFromName(name):
+def profileFromName(name, backend=None):
     r"""Convert name of profile to a profile class.
 
     Parameters
     ----------
     name : `str`
         name of profile to select
+    backend : `str`, optional
+        Kernel backend for the profiles that use one.
 
     Returns
     -------
@@ -46,9 +50,11 @@ def profileFromName(name):
     There's probably a cleaner way to do this.
     """
     if name == 'gauss':
-        return gaussian()
+        return gaussian(backend=backend)
     elif name == 'voigt':
         return voigt()
+    elif name == 'humlicek':
+        return humlicek()
     elif name == 'lorentzian':
         return lorentzian()
     elif name == 'planck':
@@ -78,18 +84,25 @@ class profile():
     def eval(self, x, Q):
         pass
 
+    def initial(self, Q):
+        r"""Pad a parameter vector with zeros to the number of profile parameters.
+
+        This allows the three parameter initial guesses to be used as
+        the starting point for profiles with additional parameters.
+        """
+        Q = np.array(Q, dtype=float)
+        return np.concatenate((Q, np.zeros(max(getattr(self, 'Nparm', len(Q)) - len(Q), 0))))
+
 class gaussian(profile):
     def __init__(self, **kwargs):
         self.Nparm = 3
+        self.backend = kwargs.get('backend', None)
 
     def f(self, x, Q):
         if len(Q) == 0:
             return 0.0
         (m, s, A) = Q
-        z = (x - m) / s
-        dfdA = np.exp(-0.5 * z*z)
-        f = A * dfdA
-        return f
+        return kernels.gaussian(x, m, s, A, self.backend)
 
     def df(self, x, Q):
         if len(Q) == 0:
@@ -129,68 +142,140 @@ class gaussian(profile):
 # https://en.wikipedia.org/wiki/Voigt_profile
 # https://docs.scipy.org/doc/scipy/reference/generated/scipy.special.wofz.html#scipy.special.wofz
 class voigt(profile):
+    r"""Voigt profile, evaluated with the exact Faddeeva function.
+
+    Notes
+    -----
+    The parameters are Q = (m, s, A, eta), with `s` the gaussian
+    sigma and `eta` the lorentzian half width.  With
+    z = ((x - m) + i |eta|) / (s sqrt(2)), the profile is
+    f = A Re[w(z)], which is normalized so that eta = 0 reproduces
+    the `gaussian` profile exactly.  A three parameter Q is treated
+    as having eta = 0.
+
+    The derivatives use dw/dz = -2 z w(z) + 2 i / sqrt(pi), so no
+    additional Faddeeva evaluations are required.
+    """
     def __init__(self, **kwargs):
         self.Nparm = 4
 
-    def f(self, x, Q):
-        (m, s, A, eta) = Q
-        zR = (x - m) / s
-        zI = eta / s
-        z = np.sqrt(0.5) * (zR + zI*1j)
+    def _faddeeva(self, z):
+        import scipy.special as spSpecial
+        return spSpecial.wofz(z)
 
-        f = A * (sp.wofz(z).real)/(s * np.sqrt(2.0 * sp.pi))
-        return f
+    def _z(self, x, Q):
+        if len(Q) == 3:
+            (m, s, A), eta = Q, 0.0
+        else:
+            (m, s, A, eta) = Q
+        z = ((x - m) + 1j * np.abs(eta)) / (s * np.sqrt(2.0))
+        return z, s, A, eta
+
+    def f(self, x, Q):
+        if len(Q) == 0:
+            return 0.0
+        z, s, A, eta = self._z(x, Q)
+        return A * self._faddeeva(z).real
 
     def df(self, x, Q):
-        r"""
-        Notes
-        -----
-        zR = (x - m) / s
-        zI = eta / s
-        z = np.sqrt(0.5) * (zR + zI*I)
-
-        dz/dm = -np.sqrt(0.5) / s
-        dz/ds = -np.sqrt(0.5) / s^2 ( (x-m) + eta I)
-        dz/deta = np.sqrt(0.5) I / s
-
-        f = W(z) / ks
-        df/dm = 1/ks * dW/dz * dzdm
-        df/ds = 1/k * (dW/dz * dzds * s - W(z)) / s^2
-        dfdeta = 1/ks * dW/dz * dzdeta
-
-        W = np.exp(-z^2) * erfc(-i*z)
-        dW/dz = d(np.exp)/dz * erfc(-i*z) + np.exp(-z^2) * d(erfc)/dz
-        dnp.expdz = -2 * z * np.exp(-z^2)
-        derfdz = 2i / pi * np.exp(-z^2)
-
-        dW/dz = -2 * z * W(z) + 2 * i / pi * np.exp(-z^2) * np.exp(-z^2)
-        """
-        (m, s, A, eta) = Q
-        zR = (x - m) / s
-        zI = eta / s
-        z = np.sqrt(0.5) * (zR + zI*1j)
+        (f, dfdm, dfds, dfdA, dfdeta) = self.fdf(x, Q)
+        return (dfdm, dfds, dfdA, dfdeta)
+
+    def fdf(self, x, Q):
+        z, s, A, eta = self._z(x, Q)
+        W = self._faddeeva(z)
+        dWdz = -2.0 * z * W + 2.0j / np.sqrt(np.pi)
+
+        dfdA = W.real
+        f = A * dfdA
+        dfdm = -A * dWdz.real / (s * np.sqrt(2.0))
+        dfds = -A * (dWdz * z).real / s
+        dfdeta = -A * dWdz.imag / (s * np.sqrt(2.0)) * (1.0 if eta >= 0 else -1.0)
+        return (f, dfdm, dfds, dfdA, dfdeta)
 
-        dfdA = (sp.wofz(z).real)/(s * np.sqrt(2.0 * sp.pi))
-        dWdz = -2 * (z * sp.wofz(z) +
-                     1j / sp.pi * np.exp(-2 * z**2))
-        dzdm = -np.sqrt(0.5) / s
-        dzds = -z / s
-        dzdeta = np.sqrt(0.5) * 1j / s
+    def fO(self, x, Q0, Q1, Q2, Q3):
+        Q = np.array([Q0, Q1, Q2, Q3])
+        return np.array(self.f(x, Q))
 
-        dfdm = A/(s * np.sqrt(2.0) * sp.pi) * dWdz.real * dzdm
-        dfds = -A/(s * np.sqrt(2.0) * sp.pi) * (dWdz.real * z + sp.wofz(z).real) / s
-        dfdeta = A/(s * np.sqrt(2.0) * sp.pi) * dWdz.imag / s * -np.sqrt(0.5)
+    def dfO(self, x, Q0, Q1, Q2, Q3):
+        Q = np.array([Q0, Q1, Q2, Q3])
+        return np.array(self.df(x, Q))
 
-        return (dfdm, dfds, dfdA, dfdeta)
+    def eval(self, x, Q):
+        return self.f(x, Q)
 
-    def fdf(self, x, Q):
-        (m, s, A, eta) = Q
-        zR = (x - m) / s
-        zI = eta / s
-        z = np.sqrt(0.5) * (zR + zI*1j)
 
-        f = A * (sp.wofz(z).real)/(s * np.sqrt(2.0 * sp.pi))
-        return (f, 0, 0, 0)
+class humlicek(voigt):
+    r"""Voigt profile, evaluated with the Humlicek (1982) W4 approximation.
+
+    Notes
+    -----
+    This uses the same parameters and normalization as `voigt`, but
+    replaces `scipy.special.wofz` with the four region rational
+    approximation of Humlicek (1982, JQSRT, 27, 437).  Over the upper
+    half plane |w4 - w| / |w| < 1e-4, which bounds the error of the
+    profile to 1e-4 of the line amplitude.  The derivatives use the
+    exact relation for dw/dz, and so carry the same error.  On 4e5
+    points, W4 takes 0.5-0.6 of the time of `scipy.special.wofz`, both
+    in the line cores and in the wings, and `humlicek.fdf` about half
+    the time of `voigt.fdf`.  `tests/benchmark_humlicek.py` repeats
+    these timings, which depend on the machine.
+    """
+    def _faddeeva(self, z):
+        return humlicek_w4(z)
+
+
+def humlicek_w4(z):
+    r"""Evaluate the Faddeeva function with the Humlicek W4 approximation.
+
+    Parameters
+    ----------
+    z : `np.ndarray` of `complex`
+        Points to evaluate, with Im(z) >= 0.
+
+    Returns
+    -------
+    w : `np.ndarray` of `complex`
+        Approximation to w(z) = exp(-z^2) erfc(-iz).
+
+    Notes
+    -----
+    Each point is assigned to one of four regions by
+    s = |Re(z)| + Im(z), and the rational approximation for that
+    region is evaluated only on those points.
+    """
+    z = np.asarray(z, dtype=complex)
+    shape = z.shape
+    z = z.ravel()
+    x = z.real
+    y = z.imag
+    t = y - 1j * x
+    s = np.abs(x) + y
+    w = np.empty_like(z)
+
+    region1 = s >= 15.0
+    region2 = ~region1 & (s >= 5.5)
+    region3 = ~region1 & ~region2 & (y >= 0.195 * np.abs(x) - 0.176)
+    region4 = ~region1 & ~region2 & ~region3
+
+    T = t[region1]
+    w[region1] = T * 0.5641896 / (0.5 + T * T)
+
+    T = t[region2]
+    U = T * T
+    w[region2] = T * (1.410474 + U * 0.5641896) / (0.75 + U * (3.0 + U))
+
+    T = t[region3]
+    w[region3] = ((16.4955 + T * (20.20933 + T * (11.96482 + T * (3.778987 + T * 0.5642236)))) /
+                  (16.4955 + T * (38.82363 + T * (39.27121 + T * (21.69274 + T * (6.699398 + T))))))
+
+    T = t[region4]
+    U = T * T
+    w[region4] = (np.exp(U) - T * (36183.31 - U * (3321.9905 - U * (1540.787 - U * (
+        219.0313 - U * (35.76683 - U * (1.320522 - U * 0.56419)))))) /
+                  (32066.6 - U * (24322.84 - U * (9022.228 - U * (2186.181 - U * (
+                      364.2191 - U * (61.57037 - U * (1.841439 - U))))))))
+    return w.reshape(shape)
 
 class skewgauss(profile):
     def __init__(self, **kwargs):
@@ -0,0 +1,248 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import logging
+import numpy as np
+import scipy.signal as spS
+from robospect import spectra
+
+__all__ = ['repair_rv']
+
+SPEED_OF_LIGHT = 299792.458
+
+class repair_rv(spectra.spectrum):
+    modelName = 'rv'
+    modelPhase = 'repair'
+
+    def __init__(self, *args, **kwargs):
+        self.modelName = 'rv'
+        self.modelPhase = 'repair'
+
+        self.velocity = 0.0
+        self.measure = True
+        self.velocity_range = 500.0
+        self.velocity_step = None
+        self.template_sigma = None
+
+        self.velocity_applied = 0.0
+        self.velocity_peak = 0.0
+        super().__init__(*args, **kwargs)
+        config = self.phase_config(repair_rv, kwargs)
+        self._configRepair(**config)
+
+    def _configRepair(self, **kwargs):
+        if 'velocity' in kwargs:
+            self.velocity = float(kwargs.get('velocity', 0.0))
+            # A supplied velocity is used as-is unless asked otherwise.
+            self.measure = False
+        if 'measure' in kwargs:
+            self.measure = kwargs.get('measure') not in (False, 'False', 'false', '0', 0)
+        if 'velocity_range' in kwargs:
+            self.velocity_range = float(kwargs.get('velocity_range', 500.0))
+        if 'velocity_step' in kwargs:
+            self.velocity_step = float(kwargs.get('velocity_step'))
+        if 'template_sigma' in kwargs:
+            self.template_sigma = float(kwargs.get('template_sigma'))
+
+    def _log_grid(self):
+        """Construct the uniform log(wavelength) grid for the correlation.
+
+        Returns
+        -------
+        u : `np.ndarray`
+            Uniformly spaced values of log(wavelength).
+        step : `float`
+            Spacing of the grid, in log(wavelength).
+        """
+        x = np.asarray(self.x, dtype=float)
+        if self.velocity_step is not None:
+            step = self.velocity_step / SPEED_OF_LIGHT
+        else:
+            step = np.median(np.diff(np.log(x)))
+        N = int(np.floor((np.log(x[-1]) - np.log(x[0])) / step)) + 1
+        return np.log(x[0]) + step * np.arange(N), step
+
+    def _template(self, u, step, centers):
+        """Construct the absorption template from a list of line centers.
+
+        Parameters
+        ----------
+        u : `np.ndarray`
+            Uniform log(wavelength) grid.
+        step : `float`
+            Spacing of the grid.
+        centers : `np.ndarray`
+            Line centers, in log(wavelength).
+
+        Returns
+        -------
+        template : `np.ndarray`
+            Sum of unit depth gaussians placed at the line centers.
+
+        Notes
+        -----
+        Each line is deposited onto its two neighbouring grid points
+        with linear weights, and the result is convolved with the
+        gaussian line shape, so the cost does not depend on the
+        number of lines.
+        """
+        position = (centers - u[0]) / step
+        position = position[(position >= 0) & (position <= len(u) - 1)]
+        lower = np.floor(position).astype(int)
+        fraction = position - lower
+        upper = np.minimum(lower + 1, len(u) - 1)
+
+        deltas = np.zeros(len(u))
+        np.add.at(deltas, lower, 1.0 - fraction)
+        np.add.at(deltas, upper, fraction)
+
+        if self.template_sigma is not None:
+            sigma = max(self.template_sigma / SPEED_OF_LIGHT / step, 0.5)
+        else:
+            sigma = 2.0
+        half_width = int(np.ceil(4.0 * sigma))
+        offsets = np.arange(-half_width, half_width + 1)
+        kernel = np.exp(-0.5 * (offsets / sigma)**2)
+        return spS.fftconvolve(deltas, kernel, mode='same')
+
+    def measure_velocity(self):
+        """Measure the velocity offset between the spectrum and the line list.
+
+        Returns
+        -------
+        velocity : `float`
+            Velocity (in km/s) that the line list must be shifted by
+            to match the spectrum.  This is relative to the current
+            line centers.
+        peak : `float`
+            Normalized cross-correlation coefficient at the peak.
+
+        Notes
+        -----
+        The absorption depth `1 - y/continuum` is resampled onto a
+        uniform log(wavelength) grid, where a Doppler shift is a
+        constant offset.  The line list template is built on the same
+        grid, the two are cross-correlated with an FFT, and a parabola
+        is fit to the three samples around the correlation maximum
+        inside +/- `velocity_range`.  Detected lines are excluded from
+        the template, as they are already at their observed position.
+        """
+        u, step = self._log_grid()
+        centers = np.array([l.x0 for l in self.L if not l.flags.test("DETECTED")],
+                           dtype=float)
+        centers = centers[centers > 0]
+        if len(u) < 3 or len(centers) == 0:
+            return 0.0, 0.0
+
+        x = np.asarray(self.x, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            depth = 1.0 - np.asarray(self.y, dtype=float) / self.continuum
+        valid = np.isfinite(depth)
+        if not np.any(valid):
+            return 0.0, 0.0
+        data = np.interp(u, np.log(x[valid]), depth[valid])
+        template = self._template(u, step, np.log(centers))
+
+        data = data - np.mean(data)
+        template = template - np.mean(template)
+        norm = np.sqrt(np.sum(data**2) * np.sum(template**2))
+        if norm == 0.0:
+            return 0.0, 0.0
+
+        # correlation[k] = sum(data[i + k] * template[i]), with
+        # negative lags wrapped to the end of the padded array.
+        size = 2 * len(u)
+        correlation = np.fft.irfft(np.fft.rfft(data, size) * np.conj(np.fft.rfft(template, size)),
+                                   size) / norm
+        max_lag = min(int(np.ceil(self.velocity_range / SPEED_OF_LIGHT / step)), len(u) - 2)
+        lags = np.arange(-max_lag, max_lag + 1)
+        values = correlation[lags]
+
+        peak = int(np.argmax(values))
+        offset = 0.0
+        if 0 < peak < len(values) - 1:
+            left, center, right = values[peak - 1:peak + 2]
+            curvature = left - 2.0 * center + right
+            if curvature < 0.0:
+                offset = 0.5 * (left - right) / curvature
+        lag = lags[peak] + offset
+        return SPEED_OF_LIGHT * np.expm1(lag * step), values[peak]
+
+    def shift_lines(self, velocity):
+        """Doppler shift the catalog line centers.
+
+        Parameters
+        ----------
+        velocity : `float`
+            Velocity (in km/s) to shift the line centers by.
+        """
+        supplied = [l for l in self.L if not l.flags.test("DETECTED")]
+        if velocity == 0.0 or len(supplied) == 0:
+            return
+        x0 = np.array([l.x0 for l in supplied], dtype=float) * (1.0 + velocity / SPEED_OF_LIGHT)
+        for line, center in zip(supplied, x0):
+            line.x0 = center
+        self.velocity_applied = ((1.0 + self.velocity_applied / SPEED_OF_LIGHT) *
+                                 (1.0 + velocity / SPEED_OF_LIGHT) - 1.0) * SPEED_OF_LIGHT
+
+    def fit_repair(self, **kwargs):
+        """Correct the line list for the radial velocity of the spectrum.
+
+        Parameters
+        ----------
+        velocity : `float`, optional
+            Known radial velocity, in km/s.  If this is set, it is
+            applied directly unless `measure` is also set.
+        measure : `bool`, optional
+            Measure the velocity by cross-correlation.  Default = True
+            unless a velocity is supplied.
+        velocity_range : `float`, optional
+            Largest velocity (in km/s) to search.  Default = 500.0.
+        velocity_step : `float`, optional
+            Velocity resolution of the log(wavelength) grid, in km/s.
+            Default is the native pixel spacing.
+        template_sigma : `float`, optional
+            Width of the template lines, in km/s.  Default is two
+            grid points.
+
+        Notes
+        -----
+        The shift is tracked in `velocity_applied`, so repeated calls
+        only apply the residual offset.  When measuring, each call
+        measures the residual against the already shifted list, and
+        the total is stored in `velocity`.
+        """
+        self._configRepair(**kwargs)
+        logger = logging.getLogger(__name__)
+        logger.setLevel(self.verbose)
+
+        if len(self.L) == 0 or len(self.x) < 3:
+            return
+
+        if self.measure is True:
+            residual, self.velocity_peak = self.measure_velocity()
+            self.shift_lines(residual)
+            self.velocity = self.velocity_applied
+            logger.info("Measured radial velocity: %.3f km/s (residual %.3f, peak %.3f)" %
+                        (self.velocity, residual, self.velocity_peak))
+        else:
+            residual = ((1.0 + self.velocity / SPEED_OF_LIGHT) /
+                        (1.0 + self.velocity_applied / SPEED_OF_LIGHT) - 1.0) * SPEED_OF_LIGHT
+            self.shift_lines(residual)
+            logger.info("Applied radial velocity: %.3f km/s" % (self.velocity_applied))
@@ -0,0 +1,235 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import logging
+import numpy as np
+from robospect import spectra
+
+__all__ = ['repair_wavelength']
+
+class repair_wavelength(spectra.spectrum):
+    modelName = 'wavelength'
+    modelPhase = 'repair'
+
+    def __init__(self, *args, **kwargs):
+        self.modelName = 'wavelength'
+        self.modelPhase = 'repair'
+
+        self.segments = 1
+        self.apply_to = 'spectrum'
+        self.clip_sigma = 3.0
+        self.reweight_iterations = 10
+        self.min_lines = 5
+
+        self.wavelength_knots = np.array([])
+        self.wavelength_coefficients = np.array([])
+        self.wavelength_rms = 0.0
+        self._origin = 0.0
+        self._scale = 1.0
+        super().__init__(*args, **kwargs)
+        config = self.phase_config(repair_wavelength, kwargs)
+        self._configRepair(**config)
+
+    def _configRepair(self, **kwargs):
+        if 'segments' in kwargs:
+            self.segments = int(kwargs.get('segments', 1))
+        if 'apply_to' in kwargs:
+            self.apply_to = kwargs.get('apply_to', 'spectrum')
+            if self.apply_to not in ('spectrum', 'lines'):
+                raise RuntimeError(f"Unknown wavelength correction target: {self.apply_to}")
+        if 'clip_sigma' in kwargs:
+            self.clip_sigma = float(kwargs.get('clip_sigma', 3.0))
+        if 'reweight_iterations' in kwargs:
+            self.reweight_iterations = int(kwargs.get('reweight_iterations', 10))
+        if 'min_lines' in kwargs:
+            self.min_lines = int(kwargs.get('min_lines', 5))
+
+    def _basis(self, x):
+        """Evaluate the piecewise-linear basis.
+
+        Parameters
+        ----------
+        x : `np.ndarray`
+            Wavelengths to evaluate the basis at.
+
+        Returns
+        -------
+        basis : `np.ndarray`, (N, 2 + Nknots)
+            Constant, linear, and hinge terms `max(x - knot, 0)`.
+
+        Notes
+        -----
+        Wavelengths are scaled to the span of the knots, so the
+        columns are of similar size.
+        """
+        t = (np.asarray(x, dtype=float) - self._origin) / self._scale
+        knots = (self.wavelength_knots - self._origin) / self._scale
+        return np.column_stack([np.ones_like(t), t] +
+                               [np.clip(t - k, 0.0, None) for k in knots])
+
+    def offset(self, x):
+        """Evaluate the fitted wavelength offset.
+
+        Parameters
+        ----------
+        x : `np.ndarray`
+            Wavelengths to evaluate the offset at.
+
+        Returns
+        -------
+        offset : `np.ndarray`
+            Observed minus catalog wavelength at `x`.
+        """
+        if len(self.wavelength_coefficients) == 0:
+            return np.zeros_like(np.asarray(x, dtype=float))
+        return self._basis(x) @ self.wavelength_coefficients
+
+    def fit_offsets(self, x0, delta):
+        """Fit a robust piecewise-linear model to the line offsets.
+
+        Parameters
+        ----------
+        x0 : `np.ndarray`
+            Catalog wavelengths of the lines.
+        delta : `np.ndarray`
+            Fitted minus catalog wavelengths of the lines.
+
+        Returns
+        -------
+        used : `np.ndarray` of `bool`
+            Lines that were not rejected in the final iteration.
+
+        Notes
+        -----
+        The knots break the range of `x0` into `segments` pieces
+        holding equal numbers of lines.  The fit is iteratively
+        reweighted least squares with Tukey biweights, using a MAD
+        estimate of the scatter, so that misidentified lines and
+        failed fits do not pull the solution.
+        """
+        self._origin = np.min(x0)
+        self._scale = max(np.max(x0) - self._origin, 1e-6)
+        if self.segments > 1:
+            self.wavelength_knots = np.quantile(x0, np.arange(1, self.segments) / self.segments)
+        else:
+            self.wavelength_knots = np.array([])
+
+        A = self._basis(x0)
+        weight = np.ones_like(delta)
+        for iteration in range(self.reweight_iterations):
+            root = np.sqrt(weight)
+            coefficients = np.linalg.lstsq(A * root[:, None], delta * root, rcond=None)[0]
+            residual = delta - A @ coefficients
+
+            scale = 1.4826 * np.median(np.abs(residual[weight > 0])) if np.any(weight > 0) else 0.0
+            if scale <= 0.0:
+                break
+            u = residual / (self.clip_sigma * scale)
+            new_weight = np.where(np.abs(u) < 1.0, (1.0 - u**2)**2, 0.0)
+            if np.allclose(new_weight, weight, atol=1e-6):
+                break
+            weight = new_weight
+
+        self.wavelength_coefficients = coefficients
+        used = weight > 0
+        self.wavelength_rms = np.sqrt(np.mean(residual[used]**2)) if np.any(used) else 0.0
+        return used
+
+    def fit_repair(self, **kwargs):
+        """Correct the wavelength solution from the fitted line centers.
+
+        Parameters
+        ----------
+        segments : `int`, optional
+            Number of linear segments in the correction.  Default = 1,
+            a linear wavelength offset.
+        apply_to : `str`, optional
+            Apply the correction to the `spectrum` wavelengths, or to
+            the supplied `lines`.  Default = `spectrum`.
+        clip_sigma : `float`, optional
+            Biweight rejection threshold, in units of the robust
+            scatter.  Default = 3.0.
+        reweight_iterations : `int`, optional
+            Maximum number of reweighting iterations.  Default = 10.
+        min_lines : `int`, optional
+            Minimum number of lines required per fit parameter.
+            Default = 5.
+
+        Flags
+        -----
+        WAVELENGTH_FIT :
+            Set for each line used in the wavelength solution.
+
+        Notes
+        -----
+        Only supplied lines with a successful fit are used.  When
+        the spectrum is corrected, `self.x` is replaced by a new
+        array, so the wavelength grid is measured again on the next
+        lookup.  The correction is skipped if it would reverse the
+        order of any pair of pixels.
+        """
+        self._configRepair(**kwargs)
+        logger = logging.getLogger(__name__)
+        logger.setLevel(self.verbose)
+
+        bad = ('FIT_FAIL', 'FIT_CHISQ', 'FIT_DELTA', 'FIT_BOUND', 'FIT_BUDGET')
+        candidates = [l for l in self.L
+                      if not l.flags.test("DETECTED") and len(l.Q) > 0 and
+                      not any(l.flags.test(b) for b in bad)]
+        x0 = np.array([l.x0 for l in candidates], dtype=float)
+        delta = np.array([l.Q[0] for l in candidates], dtype=float) - x0
+        finite = np.isfinite(delta)
+        x0 = x0[finite]
+        delta = delta[finite]
+        candidates = [l for l, f in zip(candidates, finite) if f]
+
+        Nparam = self.segments + 1
+        if len(x0) < self.min_lines * Nparam:
+            logger.info("Too few lines for wavelength solution: %d < %d" %
+                        (len(x0), self.min_lines * Nparam))
+            return
+
+        used = self.fit_offsets(x0, delta)
+        for line, u in zip(candidates, used):
+            if u:
+                line.flags.set("WAVELENGTH_FIT")
+        logger.info("Wavelength solution: %d/%d lines, rms %g, coefficients %s" %
+                    (np.sum(used), len(used), self.wavelength_rms, self.wavelength_coefficients))
+
+        if self.apply_to == 'spectrum':
+            x = np.asarray(self.x, dtype=float)
+            corrected = x - self.offset(x)
+            if np.any((np.diff(corrected) <= 0) & (np.diff(x) > 0)):
+                logger.warning("Wavelength correction is not monotonic.  Not applied.")
+                return
+            self.x = corrected
+
+            # Keep the fitted centers in the corrected frame.
+            fitted = [l for l in self.L if len(l.Q) > 0]
+            centers = np.array([l.Q[0] for l in fitted], dtype=float)
+            centers = centers - self.offset(centers)
+            for line, center in zip(fitted, centers):
+                line.Q = np.array(line.Q, dtype=float)
+                line.Q[0] = center
+        else:
+            supplied = [l for l in self.L if not l.flags.test("DETECTED")]
+            x0 = np.array([l.x0 for l in supplied], dtype=float)
+            x0 = x0 + self.offset(x0)
+            for line, center in zip(supplied, x0):
+                line.x0 = center
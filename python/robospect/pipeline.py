@@ -0,0 +1,261 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import logging
+import os
+import queue
+import threading
+import time
+
+from robospect import executors
+
+__all__ = ['Pipeline', 'StageStats']
+
+_DONE = object()
+
+
+class StageStats():
+    r"""Throughput accounting for one pipeline stage.
+
+    Parameters
+    ----------
+    name : `str`
+        Name of the stage.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.wait = 0.0
+        self.workers = 1
+        self._lock = threading.Lock()
+
+    def add(self, busy, wait, failed=False):
+        with self._lock:
+            self.count += 1
+            self.busy += busy
+            self.wait += wait
+            if failed:
+                self.failed += 1
+
+    def report(self, elapsed):
+        """Summarize the stage.
+
+        Parameters
+        ----------
+        elapsed : `float`
+            Wall clock time of the whole run.
+
+        Returns
+        -------
+        summary : `str`
+            Items processed, throughput, and the fraction of the run
+            the stage workers were busy.
+        """
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        utilization = self.busy / (elapsed * self.workers) if elapsed > 0 else 0.0
+        return (f"{self.name}: {self.count} spectra ({self.failed} failed), "
+                f"{rate:.3f}/s, busy {self.busy:.2f}s ({100.0 * utilization:.1f}%), "
+                f"waiting {self.wait:.2f}s")
+
+
+class Pipeline():
+    r"""Streaming driver that overlaps reading, fitting, and writing.
+
+    Parameters
+    ----------
+    config : `robospect.config.Config`
+        Configuration used to read, fit, and write each spectrum.
+    read_depth : `int`, optional
+        Number of parsed spectra that may wait for a fit worker.
+    write_depth : `int`, optional
+        Number of fit spectra that may wait for the writer.
+    fit_workers : `int`, optional
+        Number of fitting threads.
+
+    Notes
+    -----
+    A reader thread parses spectra with `Config.read_spectrum` into a
+    bounded queue, the fit workers take spectra from it and call
+    `fit`, and a writer thread passes the results to
+    `Config.write_results`.  The bounded queues keep the reader from
+    running arbitrarily far ahead of the fits, so memory use is set by
+    the queue depths.  A spectrum that fails in any stage is logged
+    and skipped.
+
+    Unless `-F executor` is given, the fit phases use threads rather
+    than processes, and the `workers` are shared between the fit
+    workers, so that the fit threads do not each start a pool the
+    size of the machine.
+    """
+    def __init__(self, config, read_depth=2, write_depth=2, fit_workers=1):
+        self.config = config
+        self.read_depth = int(read_depth)
+        self.write_depth = int(write_depth)
+        self.fit_workers = max(int(fit_workers), 1)
+        self.log = logging.getLogger("robospect.pipeline")
+
+        self.executor = config.arg_dict['fitting'].get('executor', 'thread')
+        workers = config.workers if config.workers > 0 else executors.default_workers()
+        self.workers = max(workers // self.fit_workers, 1)
+
+        self.stats = dict()
+        self.failures = []
+        self._failure_lock = threading.Lock()
+
+    @staticmethod
+    def path_base(path_base, spectrum_file):
+        """Construct the output path base for one of several spectra.
+
+        Parameters
+        ----------
+        path_base : `str` or None
+            Output path base from the configuration.
+        spectrum_file : `str`
+            Input spectrum filename.
+
+        Returns
+        -------
+        path_base : `str` or None
+            `path_base` followed by the spectrum filename without its
+            extension, so a directory ending in a separator places the
+            outputs in that directory.
+        """
+        if path_base is None:
+            return None
+        stem = os.path.splitext(os.path.basename(spectrum_file))[0]
+        return f"{path_base}{stem}"
+
+    def _fail(self, stage, spectrum_file, error):
+        self.log.error(f"{stage} failed for {spectrum_file}: {error!r}")
+        with self._failure_lock:
+            self.failures.append((stage, spectrum_file, error))
+
+    def _read(self, jobs, read_queue):
+        stats = self.stats['read']
+        try:
+            for index, spectrum_file, path_base in jobs:
+                start = time.perf_counter()
+                failed = False
+                try:
+                    spectrum = self.config.read_spectrum(spectrum_file)
+                except Exception as e:
+                    failed = True
+                    self._fail('read', spectrum_file, e)
+                busy = time.perf_counter() - start
+                if not failed:
+                    read_queue.put((index, spectrum_file, path_base, spectrum))
+                stats.add(busy, time.perf_counter() - start - busy, failed)
+        finally:
+            for worker in range(self.fit_workers):
+                read_queue.put(_DONE)
+
+    def _fit(self, read_queue, write_queue):
+        stats = self.stats['fit']
+        while True:
+            start = time.perf_counter()
+            item = read_queue.get()
+            if item is _DONE:
+                break
+            index, spectrum_file, path_base, spectrum = item
+            ready = time.perf_counter()
+            failed = False
+            spectrum.executor = self.executor
+            spectrum.workers = self.workers
+            spectrum.phase_workers = {phase: max(n // self.fit_workers, 1)
+                                      for phase, n in spectrum.phase_workers.items() if n > 0}
+            try:
+                self.config.fit_spectrum(spectrum)
+            except Exception as e:
+                failed = True
+                self._fail('fit', spectrum_file, e)
+            done = time.perf_counter()
+            if not failed:
+                write_queue.put((index, spectrum_file, path_base, spectrum))
+            stats.add(done - ready, (ready - start) + (time.perf_counter() - done), failed)
+        write_queue.put(_DONE)
+
+    def _write(self, write_queue):
+        stats = self.stats['write']
+        remaining = self.fit_workers
+        while remaining > 0:
+            start = time.perf_counter()
+            item = write_queue.get()
+            if item is _DONE:
+                remaining -= 1
+                continue
+            index, spectrum_file, path_base, spectrum = item
+            ready = time.perf_counter()
+            failed = False
+            try:
+                self.config.write_results(spectrum, path_base=path_base)
+            except Exception as e:
+                failed = True
+                self._fail('write', spectrum_file, e)
+            stats.add(time.perf_counter() - ready, ready - start, failed)
+
+    def run(self, spectrum_files, path_bases=None):
+        """Fit a sequence of spectra.
+
+        Parameters
+        ----------
+        spectrum_files : iterable of `str`
+            Spectra to fit.  This is consumed by the reader thread, so
+            it may be a generator.
+        path_bases : iterable of `str`, optional
+            Output path base for each spectrum.  By default this is
+            constructed with `Pipeline.path_base`.
+
+        Returns
+        -------
+        stats : `dict` of `StageStats`
+            Throughput of the read, fit, and write stages.
+        """
+        if path_bases is None:
+            jobs = ((index, f, self.path_base(self.config.path_base, f))
+                    for index, f in enumerate(spectrum_files))
+        else:
+            jobs = ((index, f, p) for index, (f, p) in enumerate(zip(spectrum_files, path_bases)))
+
+        self.stats = {name: StageStats(name) for name in ('read', 'fit', 'write')}
+        self.stats['fit'].workers = self.fit_workers
+        self.failures = []
+
+        read_queue = queue.Queue(maxsize=max(self.read_depth, 1))
+        write_queue = queue.Queue(maxsize=max(self.write_depth, 1))
+        threads = [threading.Thread(target=self._read, args=(jobs, read_queue),
+                                    name="robospect-read")]
+        threads += [threading.Thread(target=self._fit, args=(read_queue, write_queue),
+                                     name=f"robospect-fit-{worker}")
+                    for worker in range(self.fit_workers)]
+        threads.append(threading.Thread(target=self._write, args=(write_queue, ),
+                                        name="robospect-write"))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        self.log.info(f"pipeline: {elapsed:.2f}s")
+        for stage in self.stats.values():
+            self.log.info(stage.report(elapsed))
+        return self.stats
@@ -0,0 +1,241 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import importlib
+import logging
+
+__all__ = ['register', 'get_model', 'list_models', 'compose']
+
+# Other packages can provide models with an entry point in this group,
+# named "phase.modelName", that points to the model class:
+#
+#     [options.entry_points]
+#     robospect.models =
+#         continuum.mine = mypackage.continuum:continuum_mine
+ENTRY_POINT_GROUP = 'robospect.models'
+
+# The models provided by robospect.  Entries are import paths, so no
+# model module is imported until that model is used.  ('line', 'pre')
+# is kept for configurations that predate the initial phase.
+BUILTIN_MODELS = {('repair', 'rv'): 'robospect.models.repair_rv:repair_rv',
+                  ('repair', 'wavelength'): 'robospect.models.repair_wavelength:repair_wavelength',
+                  ('detection', 'naive'): 'robospect.models.detection_naive:detection_naive',
+                  ('detection', 'matched'): 'robospect.models.detection_matched:detection_matched',
+                  ('detection', 'null'): 'robospect.models.all_null:detection_null',
+                  ('noise', 'boxcar'): 'robospect.models.noise_boxcar:noise_boxcar',
+                  ('noise', 'null'): 'robospect.models.all_null:error_null',
+                  ('continuum', 'boxcar'): 'robospect.models.continuum_boxcar:continuum_boxcar',
+                  ('continuum', 'parbox'): 'robospect.models.continuum_parallel_boxcar:continuum_parallel_boxcar',
+                  ('continuum', 'fusedbox'): 'robospect.models.continuum_fused_boxcar:continuum_fused_boxcar',
+                  ('continuum', 'kcs'): 'robospect.models.continuum_kcs:continuum_kcs',
+                  ('continuum', 'bspline'): 'robospect.models.continuum_bspline:continuum_bspline',
+                  ('continuum', 'null'): 'robospect.models.all_null:continuum_null',
+                  ('initial', 'pre'): 'robospect.models.line_gauss_guess:line_gauss_guess',
+                  ('initial', 'null'): 'robospect.models.all_null:initial_null',
+                  ('line', 'pre'): 'robospect.models.line_gauss_guess:line_gauss_guess',
+                  ('line', 'nlls'): 'robospect.models.line_nlls:line_nlls',
+                  ('line', 'mp_nlls'): 'robospect.models.line_mp_nlls:line_mp_nlls',
+                  ('line', 'best'): 'robospect.models.line_best:line_best',
+                  ('line', 'null'): 'robospect.models.all_null:line_null',
+                  ('deblend', 'group'): 'robospect.models.deblend_group:deblend_group',
+                  }
+
+_models = dict(BUILTIN_MODELS)
+_entry_points_loaded = False
+_spectra_classes = dict()
+
+
+def _import(path):
+    """Import an object from a "module:qualname" path."""
+    moduleName, _, qualName = path.partition(':')
+    obj = importlib.import_module(moduleName)
+    for attr in qualName.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def _path(obj):
+    """Construct the "module:qualname" path of a class."""
+    return f"{obj.__module__}:{obj.__qualname__}"
+
+
+def _load_entry_points():
+    """Add the models advertised by installed packages.
+
+    Notes
+    -----
+    The package metadata is only read the first time a model is not
+    found in the registry, so the default configuration does not
+    depend on the number of installed packages.  Entry points do not
+    replace models that are already registered.
+    """
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+
+    log = logging.getLogger("robospect.registry")
+    try:
+        import importlib.metadata as metadata
+    except ImportError:
+        return
+    entryPoints = metadata.entry_points()
+    if hasattr(entryPoints, 'select'):
+        entryPoints = entryPoints.select(group=ENTRY_POINT_GROUP)
+    else:
+        entryPoints = entryPoints.get(ENTRY_POINT_GROUP, [])
+
+    for entryPoint in entryPoints:
+        phase, _, name = entryPoint.name.partition('.')
+        if not name:
+            log.warning(f"Ignoring model entry point {entryPoint.name}: expected phase.modelName")
+            continue
+        _models.setdefault((phase, name), entryPoint.value)
+        log.debug(f"entry point: phase: {phase} name: {name} -> {entryPoint.value}")
+
+
+def register(phase, name, model):
+    """Register a model.
+
+    Parameters
+    ----------
+    phase : `str`
+        Fitting phase of the model.
+    name : `str`
+        Name used to select the model.
+    model : `type` or `str`
+        The model class, or its "module:class" import path.
+    """
+    _models[(phase, name)] = model
+
+
+def get_model(phase, name):
+    """Find a model class by phase and name.
+
+    Parameters
+    ----------
+    phase : `str`
+        Fitting phase of the model.
+    name : `str`
+        Name of the model.
+
+    Returns
+    -------
+    model : `type`
+        The model class.  Its module is imported on first use.
+
+    Raises
+    ------
+    RuntimeError :
+        Raised if no such model is known.
+    """
+    key = (phase, name)
+    if key not in _models:
+        _load_entry_points()
+    try:
+        model = _models[key]
+    except KeyError:
+        raise RuntimeError(f"Unknown {phase} model: {name}")
+    if isinstance(model, str):
+        model = _import(model)
+        _models[key] = model
+    return model
+
+
+def list_models(phase=None):
+    """List the known models.
+
+    Parameters
+    ----------
+    phase : `str`, optional
+        Only list the models for this phase.
+
+    Returns
+    -------
+    models : `list` of `tuple`
+        Sorted (phase, modelName) pairs.  No model is imported.
+    """
+    _load_entry_points()
+    return sorted(key for key in _models if phase is None or key[0] == phase)
+
+
+def compose(models):
+    """Construct the spectrum class that implements the selected models.
+
+    Parameters
+    ----------
+    models : `tuple` of `type`
+        Model classes, in method resolution order.  `spectra.spectrum`
+        is appended if it is not present.
+
+    Returns
+    -------
+    Spectra : `type`
+        The composed class.  The same class is returned for every call
+        with the same models.
+
+    Notes
+    -----
+    Instances pickle by the import paths of their models, so they can
+    be sent to worker processes, which compose the class again.
+    """
+    from robospect import spectra
+
+    models = tuple(models)
+    if spectra.spectrum not in models:
+        models = models + (spectra.spectrum,)
+    if models in _spectra_classes:
+        return _spectra_classes[models]
+
+    paths = tuple(_path(m) for m in models)
+
+    class Spectra(*models):
+        def __init__(self, *args, **kwargs):
+            if "verbose" in kwargs.keys():
+                self.verbose = kwargs["verbose"]
+                self.log = logging.getLogger("robospect.spectra")
+                self.log.setLevel(self.verbose)
+            super().__init__(*args, **kwargs)
+
+        def __reduce__(self):
+            return (_rebuild, (paths, self.__dict__))
+
+        def copy_data(self, spectrum):
+            self.x = spectrum.x
+            self.y = spectrum.y
+            self.e0 = spectrum.e0
+            self.comment = spectrum.comment
+
+            self.continuum = spectrum.continuum
+            self.lines = spectrum.lines
+            self.alternate = spectrum.alternate
+            self.error = spectrum.error
+            self.L = spectrum.L
+            self.filename = spectrum.filename
+
+    _spectra_classes[models] = Spectra
+    return Spectra
+
+
+def _rebuild(paths, state):
+    """Unpickle a composed spectrum."""
+    Spectra = compose(_import(p) for p in paths)
+    spectrum = Spectra.__new__(Spectra)
+    spectrum.__dict__.update(state)
+    return spectrum
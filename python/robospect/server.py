@@ -0,0 +1,392 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import time
+
+import numpy as np
+
+from robospect.executors import default_workers
+
+__all__ = ['Server', 'Client', 'serve', 'fit_request']
+
+# Per-process state of the fitting workers.
+_worker = {'args': [], 'configs': dict()}
+
+
+def parse_address(address):
+    """Interpret a server address.
+
+    Parameters
+    ----------
+    address : `str` or `int`
+        A TCP port, "host:port", or the path of a unix socket.
+
+    Returns
+    -------
+    address : `tuple`
+        ('tcp', host, port) or ('unix', path).
+    """
+    address = str(address)
+    if address.isdigit():
+        return ('tcp', '127.0.0.1', int(address))
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and os.sep not in host:
+        return ('tcp', host, int(port))
+    return ('unix', address)
+
+
+def _line_to_dict(line):
+    return {'x0': float(line.x0),
+            'Q': [float(q) for q in line.Q],
+            'dQ': [float(q) for q in line.dQ],
+            'pQ': [float(q) for q in line.pQ],
+            'chi': float(line.chi),
+            'R': float(line.R),
+            'Niter': int(line.Niter),
+            'nfev': int(line.nfev),
+            'flags': int(line.flags.value),
+            'blend': int(line.blend),
+            'comment': line.comment}
+
+
+def _config(args):
+    """Construct, or reuse, the configuration for a set of arguments."""
+    from robospect import config
+    from robospect import registry
+
+    key = tuple(_worker['args']) + tuple(args)
+    if key not in _worker['configs']:
+        C = config.Config(list(key))
+        # The worker pool already provides the parallelism, so do not
+        # start a second pool for each fit.
+        if C.arg_dict['line'].get('name', None) is None:
+            C.line_model = registry.get_model('line', 'nlls')
+        _worker['configs'][key] = C
+    return _worker['configs'][key]
+
+
+def _line_list(C, S, source):
+    """Read the lines to fit, from a line list file or a list of wavelengths."""
+    from robospect import lines
+
+    if source is None:
+        return []
+    if not isinstance(source, str):
+        return [lines.line(float(x0)) for x0 in source]
+    return C.read_line_list(S, source)
+
+
+def fit_request(request):
+    """Fit the spectrum described by a request.
+
+    Parameters
+    ----------
+    request : `dict`
+        `spectrum` is either a filename, or a dict with `x`, `y` and
+        optionally `error` arrays.  `args` is a list of command line
+        options, added to those the server was started with.
+        `line_list` is a filename or a list of wavelengths, and
+        overrides any --line_list option.  If `return_spectrum` is
+        true, the model arrays are also returned.
+
+    Returns
+    -------
+    response : `dict`
+        `lines` holds the fit line catalog.  `status` is `error`, with
+        a message in `error`, if the fit could not be done.
+    """
+    from robospect import io
+
+    start = time.perf_counter()
+    response = {'id': request.get('id', None)}
+    try:
+        C = _config(request.get('args', []))
+        S = C.construct_spectra_class(None, **C.arg_dict)
+
+        source = request.get('spectrum', None)
+        if isinstance(source, str):
+            S = io.read_ascii_spectrum(source, spectrum=S)
+        elif isinstance(source, dict):
+            S.x = np.asarray(source['x'], dtype=float)
+            S.y = np.asarray(source['y'], dtype=float)
+            if 'error' in source:
+                S.e0 = np.asarray(source['error'], dtype=float)
+            S.filename = source.get('name', '')
+            S.continuum = np.ones(len(S.x))
+            S.lines = np.zeros(len(S.x))
+            S.alternate = np.zeros(len(S.x))
+            S.error = np.zeros(len(S.x))
+            S.set_grid()
+        else:
+            raise RuntimeError("No spectrum supplied.")
+        S.L = _line_list(C, S, request.get('line_list', C.line_list))
+
+        C.fit_spectrum(S)
+
+        response['status'] = 'ok'
+        response['lines'] = [_line_to_dict(l) for l in S.L]
+        if request.get('return_spectrum', False):
+            response['spectrum'] = {k: np.asarray(getattr(S, k), dtype=float).tolist()
+                                    for k in ('x', 'y', 'continuum', 'lines', 'error')}
+    except Exception as e:
+        response['status'] = 'error'
+        response['error'] = f"{type(e).__name__}: {e}"
+    response['elapsed'] = time.perf_counter() - start
+    response['pid'] = os.getpid()
+    return response
+
+
+def _initialize(args):
+    """Warm a worker: import the models and fit a small spectrum."""
+    _worker['args'] = list(args)
+    logging.getLogger("robospect").setLevel(logging.WARNING)
+
+    x = np.linspace(5000.0, 5010.0, 501)
+    y = 1.0 - 0.3 * np.exp(-0.5 * ((x - 5005.0) / 0.05)**2)
+    fit_request({'spectrum': {'x': x, 'y': y}, 'line_list': [5005.0]})
+
+
+def _ping():
+    return os.getpid()
+
+
+class Server():
+    r"""Fitting service that keeps configured worker processes warm.
+
+    Parameters
+    ----------
+    address : `str` or `int`
+        A TCP port, "host:port", or the path of a unix socket.
+    args : `list` of `str`, optional
+        Command line options applied to every request.
+    workers : `int`, optional
+        Number of fitting processes.  Defaults to the number of
+        processors available.
+
+    Notes
+    -----
+    The protocol is one JSON object per line in each direction.  Each
+    request is handed to the process pool as it arrives, so several
+    requests on one connection are fit concurrently, and the replies
+    carry the request `id` as they may return out of order.  A request
+    with "op": "ping" returns the pool size without fitting.  The
+    workers cache the `Config` for each set of options, along with the
+    composed spectrum class and the parsed line list.  Unless the
+    options select a line model, the serial `nlls` model is used, as
+    the pool already fits several spectra at once.
+    """
+    def __init__(self, address, args=None, workers=None):
+        self.address = parse_address(address)
+        self.args = list(args) if args is not None else []
+        self.workers = int(workers) if workers is not None else default_workers()
+        self.log = logging.getLogger("robospect.server")
+        self.pool = None
+        self.requests = 0
+
+    def start_pool(self):
+        """Start and warm the worker processes."""
+        import concurrent.futures
+        import multiprocessing
+
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_initialize, initargs=(self.args, ))
+        pids = set(f.result() for f in [self.pool.submit(_ping) for _ in range(self.workers)])
+        self.log.info(f"{len(pids)} workers ready")
+
+    async def _respond(self, request, writer, lock):
+        loop = asyncio.get_running_loop()
+        if request.get('op', 'fit') == 'ping':
+            response = {'id': request.get('id', None), 'status': 'ok', 'workers': self.workers}
+        else:
+            response = await loop.run_in_executor(self.pool, fit_request, request)
+            self.requests += 1
+        async with lock:
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+
+    async def _handle(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                data = await reader.readline()
+                if not data:
+                    break
+                try:
+                    request = json.loads(data)
+                except ValueError as e:
+                    request = None
+                    async with lock:
+                        writer.write(json.dumps({'status': 'error',
+                                                 'error': f"Bad request: {e}"}).encode() + b"\n")
+                        await writer.drain()
+                if request is not None:
+                    task = asyncio.ensure_future(self._respond(request, writer, lock))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """Accept connections until interrupted."""
+        if self.pool is None:
+            self.start_pool()
+        if self.address[0] == 'unix':
+            if os.path.exists(self.address[1]):
+                os.unlink(self.address[1])
+            server = await asyncio.start_unix_server(self._handle, path=self.address[1],
+                                                     limit=2**30)
+        else:
+            server = await asyncio.start_server(self._handle, host=self.address[1],
+                                                port=self.address[2], limit=2**30)
+        self.log.info(f"listening on {self.address}")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Only the main thread can install signal handlers.
+                pass
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            self.pool.shutdown()
+            if self.address[0] == 'unix' and os.path.exists(self.address[1]):
+                os.unlink(self.address[1])
+            self.log.info(f"stopped after {self.requests} requests")
+
+
+def serve(address, args=None, workers=None):
+    """Run a fitting server until interrupted.
+
+    Parameters
+    ----------
+    address : `str` or `int`
+        A TCP port, "host:port", or the path of a unix socket.
+    args : `list` of `str`, optional
+        Command line options applied to every request.
+    workers : `int`, optional
+        Number of fitting processes.
+    """
+    asyncio.run(Server(address, args=args, workers=workers).serve())
+
+
+class _Encoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        return super().default(obj)
+
+
+class Client():
+    r"""Blocking client for a fitting server.
+
+    Parameters
+    ----------
+    address : `str` or `int`
+        A TCP port, "host:port", or the path of a unix socket.
+    timeout : `float`, optional
+        Socket timeout, in seconds.
+    """
+    def __init__(self, address, timeout=None):
+        self.address = parse_address(address)
+        if self.address[0] == 'unix':
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(self.address[1])
+        else:
+            self.socket = socket.create_connection(self.address[1:])
+        self.socket.settimeout(timeout)
+        self.stream = self.socket.makefile('rwb')
+        self.next_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.stream.close()
+        self.socket.close()
+
+    def request(self, request):
+        """Send a request and wait for its reply."""
+        request = dict(request)
+        request.setdefault('id', self.next_id)
+        self.next_id += 1
+        self.stream.write(json.dumps(request, cls=_Encoder).encode() + b"\n")
+        self.stream.flush()
+        data = self.stream.readline()
+        if not data:
+            raise RuntimeError("Server closed the connection.")
+        return json.loads(data)
+
+    def ping(self):
+        return self.request({'op': 'ping'})
+
+    def fit(self, spectrum, args=None, line_list=None, return_spectrum=False):
+        """Fit a spectrum on the server.
+
+        Parameters
+        ----------
+        spectrum : `str`, `dict`, or `robospect.spectra.spectrum`
+            Filename (read by the server), dict of `x`, `y` and
+            optionally `error` arrays, or a spectrum object.
+        args : `list` of `str`, optional
+            Command line options for this fit.
+        line_list : `str` or `list` of `float`, optional
+            Line list filename, or wavelengths of the lines to fit.
+        return_spectrum : `bool`, optional
+            Also return the continuum, lines and error arrays.
+
+        Returns
+        -------
+        response : `dict`
+            Server reply, with the line catalog in `lines`.
+
+        Raises
+        ------
+        RuntimeError :
+            Raised if the server could not fit the spectrum.
+        """
+        if hasattr(spectrum, 'x') and hasattr(spectrum, 'y'):
+            spectrum = {'x': spectrum.x, 'y': spectrum.y}
+        request = {'spectrum': spectrum, 'args': list(args) if args else [],
+                   'return_spectrum': return_spectrum}
+        if line_list is not None:
+            request['line_list'] = line_list
+        response = self.request(request)
+        if response.get('status') != 'ok':
+            raise RuntimeError(f"Fit failed: {response.get('error')}")
+        return response
@@ -21,9 +21,13 @@ import numpy as np
 import logging
 
 from robospect import lines
+from robospect import kernels
+from robospect import executors
 
 __all__ = ['spectrum', 'M_spectrum']
 
+_GRID_BLOCK = 1 << 20
+
 class M_spectrum(type):
     pass
 
@@ -45,6 +49,11 @@ class spectrum(object):
         self.alternate = np.zeros(len(self.x))
         self.error = np.zeros(len(self.x))
 
+        self.grid = None
+        self.grid_start = 0.0
+        self.grid_step = 0.0
+        self._grid_x = None
+
         self.log = logging.getLogger("robospect.spectra")
         self.log.debug("Input Kwargs: %s" % (kwargs))
         # Things like general tolerances probably should be here too.
@@ -54,9 +63,93 @@ class spectrum(object):
         if self.fitting_parameters is not None:
             self.iteration = self.fitting_parameters.setdefault('iteration', 0)
             self.max_iteration = self.fitting_parameters.setdefault('max_iterations', 1)
+            # Resolved once here, and passed to each kernel, so that
+            # spectra with different backends do not interfere.
+            self.backend = None
+            if 'backend' in self.fitting_parameters:
+                self.backend = kernels.resolve_backend(self.fitting_parameters['backend'])
+            self.executor = self.fitting_parameters.get('executor', 'process')
+            self.workers = int(self.fitting_parameters.get('workers', 0))
         else:
             self.iteration = 0
             self.max_iteration = 1
+            self.backend = None
+            self.executor = 'process'
+            self.workers = 0
+        if self.workers < 1:
+            self.workers = executors.default_workers()
+        # Phases may select their own executor and number of workers,
+        # with `-C executor thread -C workers 4`.  `parallel` and
+        # `nProc` are older names for `workers`.
+        self.phase_executors = dict()
+        self.phase_workers = dict()
+        for phase, config in kwargs.items():
+            if not isinstance(config, dict) or phase == 'fitting':
+                continue
+            if 'executor' in config:
+                self.phase_executors[phase] = config['executor']
+            for key in ('workers', 'parallel', 'nProc'):
+                if config.get(key, None) is not None:
+                    self.phase_workers[phase] = int(config[key])
+                    break
+
+    @staticmethod
+    def phase_config(model, kwargs):
+        """Return the configuration of a model's fit phase.
+
+        Parameters
+        ----------
+        model : `type`
+            The model class.
+        kwargs : `dict`
+            Keyword arguments of the spectrum constructor.
+
+        Returns
+        -------
+        config : `dict`
+            The configuration for `model.modelPhase`.
+
+        Notes
+        -----
+        Each model's constructor sets `modelPhase` on the instance, so
+        once the composed class is constructed it holds the phase of
+        the last model.  The class attribute of `model` is used
+        instead.
+        """
+        return kwargs.get(model.modelPhase, dict())
+
+    def pool_workers(self, phase):
+        """Number of workers used for a fit phase.
+
+        Parameters
+        ----------
+        phase : `str`
+            The fit phase.
+
+        Returns
+        -------
+        workers : `int`
+            The phase's `workers` option, or else `-F workers`.
+        """
+        workers = self.phase_workers.get(phase, 0)
+        return workers if workers > 0 else self.workers
+
+    def pool(self, phase):
+        """Construct the pool for the independent work items of a fit phase.
+
+        Parameters
+        ----------
+        phase : `str`
+            The fit phase, used to select the executor and the number
+            of workers.
+
+        Returns
+        -------
+        pool : `multiprocessing.pool.Pool` or equivalent
+            The pool, to be used as a context manager.
+        """
+        return executors.get_pool(self.phase_executors.get(phase, self.executor),
+                                  self.pool_workers(phase))
 
     def max(self):
         if self.x is not None:
@@ -70,6 +163,129 @@ class spectrum(object):
         if self.x is not None:
             return len(self.x)
 
+    def set_grid(self, tolerance=0.25):
+        """Determine if the wavelengths lie on a uniform grid.
+
+        Parameters
+        ----------
+        tolerance : `float`, optional
+            Maximum allowed deviation of any pixel from the uniform
+            grid, in units of the pixel spacing.
+
+        Returns
+        -------
+        grid : `str` or None
+            `linear` if the wavelengths are uniformly spaced, `log` if
+            they are uniformly spaced in log(wavelength), and None
+            otherwise.
+
+        Notes
+        -----
+        This is called when the spectrum is read, and again if
+        `self.x` is replaced by a different array.  If `self.x` is
+        modified in place, this must be called to update the grid.
+        """
+        self._grid_x = self.x
+        self.grid = None
+        x = np.asarray(self.x, dtype=float)
+        if len(x) < 3:
+            return self.grid
+
+        N = len(x)
+        for grid, transform in (('linear', np.asarray), ('log', np.log)):
+            if grid == 'log' and x[0] <= 0.0:
+                break
+            start, end = transform(x[[0, -1]])
+            step = (end - start) / (N - 1)
+            if not step > 0.0:
+                break
+            # Check in blocks, so memory mapped spectra are not read at once.
+            deviation = 0.0
+            for block in range(0, N, _GRID_BLOCK):
+                coord = transform(x[block:block + _GRID_BLOCK])
+                index = np.arange(block, block + len(coord))
+                deviation = np.max([deviation, np.max(np.abs(coord - (start + index * step)))])
+            if deviation <= tolerance * step:
+                self.grid = grid
+                self.grid_start = start
+                self.grid_step = step
+                break
+        self.log.debug(f"Wavelength grid: {self.grid} {self.grid_start} {self.grid_step}")
+        return self.grid
+
+    def index_from_wavelength(self, wavelength, side='left'):
+        """Convert wavelengths to pixel indices.
+
+        Parameters
+        ----------
+        wavelength : `float` or `np.ndarray`
+            Wavelengths to convert.
+        side : `str`, optional
+            As in `np.searchsorted`, `left` returns the first pixel
+            with x >= wavelength, and `right` returns the first pixel
+            with x > wavelength.
+
+        Returns
+        -------
+        index : `int` or `np.ndarray` of `int`
+            Pixel indices, identical to those of `np.searchsorted`.
+
+        Notes
+        -----
+        For uniform grids the index is calculated directly, and then
+        corrected by a single comparison against `self.x` to account
+        for round off and the grid tolerance.  Otherwise, this falls
+        back to a binary search.
+        """
+        if self._grid_x is not self.x:
+            self.set_grid()
+        if self.grid is None:
+            return np.searchsorted(self.x, wavelength, side=side)
+
+        x = self.x
+        N = len(x)
+        w = np.asarray(wavelength, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.grid == 'linear':
+                coord = w
+            else:
+                coord = np.where(np.isnan(w), np.nan, np.log(np.where(w > 0.0, w, 0.0)))
+            u = (coord - self.grid_start) / self.grid_step
+        guess = np.ceil(u) if side == 'left' else np.floor(u) + 1
+        guess = np.clip(np.nan_to_num(guess, nan=N, posinf=N, neginf=0), 0, N).astype(int)
+
+        below = x[np.clip(guess - 1, 0, N - 1)]
+        above = x[np.clip(guess, 0, N - 1)]
+        if side == 'left':
+            guess = np.where((guess > 0) & (below >= w), guess - 1, guess)
+            guess = np.where((guess < N) & (above < w), guess + 1, guess)
+        else:
+            guess = np.where((guess > 0) & (below > w), guess - 1, guess)
+            guess = np.where((guess < N) & (above <= w), guess + 1, guess)
+        if np.ndim(wavelength) == 0:
+            return int(guess)
+        return guess
+
+    def window_bounds(self, width):
+        """Calculate the pixel range of a window centered on each pixel.
+
+        Parameters
+        ----------
+        width : `float`
+            Full width of the window, in AA.
+
+        Returns
+        -------
+        start : `np.ndarray` of `int`
+            First pixel of each window.
+        end : `np.ndarray` of `int`
+            One past the last pixel of each window.
+        """
+        x = np.asarray(self.x, dtype=float)
+        start = self.index_from_wavelength(x - width / 2.0, side='left')
+        end = self.index_from_wavelength(x + width / 2.0, side='right')
+        return start, end
+
     def fit(self, **kwargs):
         r"""Method to perform a single fitting iteration.
         """
@@ -82,6 +298,9 @@ class spectrum(object):
             self.fit_continuum(**kwargs)
             self.fit_error(**kwargs)
 
+            # Correct the catalog positions before any line is fit.
+            self.fit_repair(**kwargs)
+
             self.fit_initial(**kwargs)
             self.line_update(**kwargs, alternate=True)
 
@@ -188,12 +407,12 @@ class spectrum(object):
             flagString = 'ALT_CHISQ'
 
         self.lines = np.zeros_like(self.x)
-        for line in self.L:
+        x0 = np.array([line.x0 for line in self.L], dtype=float)
+        starts = self.index_from_wavelength(x0 - chi_window, side='left')
+        ends = self.index_from_wavelength(x0 + chi_window, side='right')
+        for line, start, end in zip(self.L, starts, ends):
             line.flags.unset(flagString=flagString)
 
-            start = np.searchsorted(self.x, line.x0 - chi_window, side='left')
-            end   = np.searchsorted(self.x, line.x0 + chi_window, side='right')
-
             F = 0.0
             if use_alternate is False:
                 F = self.profile.f(self.x[start:end+1], line.Q)
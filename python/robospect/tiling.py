@@ -0,0 +1,309 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import collections
+import concurrent.futures
+import copy
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from robospect import lines
+
+__all__ = ['halo_width', 'plan_tiles', 'make_segment', 'store_segment', 'fit_tiled']
+
+# Number of elements copied at once between memory mapped arrays.
+_COPY_BLOCK = 1 << 20
+
+
+def halo_width(spectrum):
+    r"""Estimate the wavelength range a fit result depends on.
+
+    Parameters
+    ----------
+    spectrum : `robospect.spectra.spectrum`
+        Configured spectrum to be fit.
+
+    Returns
+    -------
+    halo : `float`
+        Width to add to each side of a segment, in wavelength units.
+
+    Notes
+    -----
+    One fitting pass reads the continuum and noise windows
+    (`box_size` / 2), the chi^2 window of `line_update`
+    (`chi_window`), and the line fitting windows (the initial
+    estimate `range`, or five times the largest supplied line sigma).
+    Each pass can carry information one such reach further, so the
+    sum is multiplied by the number of passes, `max_iterations` + 1.
+    """
+    chi_window = float(spectrum.fitting_parameters.get("chi_window", 10.0))
+    box_size = float(getattr(spectrum, "box_size", 0.0))
+
+    reach = float(getattr(spectrum, "range", 0.0))
+    for line in spectrum.L:
+        if len(line.Q) > 1 and np.isfinite(line.Q[1]):
+            reach = max(reach, 5.0 * abs(float(line.Q[1])))
+
+    passes = int(spectrum.max_iteration) + 1
+    return passes * (0.5 * box_size + chi_window + reach)
+
+
+def plan_tiles(spectrum, tiles, halo):
+    r"""Split a spectrum into overlapping segments.
+
+    Parameters
+    ----------
+    spectrum : `robospect.spectra.spectrum`
+        Spectrum to split.
+    tiles : `int`
+        Number of segments.
+    halo : `float`
+        Width added to each side of a segment, in wavelength units.
+
+    Returns
+    -------
+    plan : `list` of `tuple`
+        For each segment, the pixel range it owns (`core_start`,
+        `core_end`) and the pixel range it is fit over (`start`,
+        `end`).  The owned ranges cover the spectrum without overlap.
+    """
+    N = len(spectrum.x)
+    tiles = max(min(int(tiles), N), 1)
+    bounds = np.linspace(0, N, tiles + 1).astype(int)
+    x = np.asarray(spectrum.x, dtype=float)
+
+    plan = []
+    for core_start, core_end in zip(bounds[:-1], bounds[1:]):
+        start = int(spectrum.index_from_wavelength(x[core_start] - halo, side='left'))
+        end = int(spectrum.index_from_wavelength(x[core_end - 1] + halo, side='right')) + 1
+        plan.append((int(core_start), int(core_end),
+                     max(min(start, core_start), 0), min(max(end, core_end), N)))
+    return plan
+
+
+def make_segment(spectrum, start, end, core_start, core_end):
+    r"""Construct a spectrum holding one segment of a larger spectrum.
+
+    Parameters
+    ----------
+    spectrum : `robospect.spectra.spectrum`
+        Spectrum to take the segment from.
+    start, end : `int`
+        Pixel range of the segment, including the halo.
+    core_start, core_end : `int`
+        Pixel range owned by the segment.
+
+    Returns
+    -------
+    segment : `robospect.spectra.spectrum`
+        Spectrum of the same class and configuration.  The catalog
+        lines inside the segment are copies, and those whose
+        wavelength is owned by the segment are marked `tile_owner`.
+    """
+    x = np.asarray(spectrum.x, dtype=float)
+    low = x[core_start] if core_start > 0 else -np.inf
+    high = x[core_end] if core_end < len(x) else np.inf
+
+    segment = copy.copy(spectrum)
+    segment.x = x[start:end].copy()
+    segment.y = np.asarray(spectrum.y, dtype=float)[start:end].copy()
+    segment.e0 = np.asarray(spectrum.e0, dtype=float)[start:end].copy() if len(spectrum.e0) > 0 else []
+    segment.comment = spectrum.comment[start:end] if len(spectrum.comment) == len(x) else []
+    segment.continuum = np.ones(end - start)
+    segment.lines = np.zeros(end - start)
+    segment.alternate = np.zeros(end - start)
+    segment.error = np.zeros(end - start)
+    segment.fitting_parameters = dict(spectrum.fitting_parameters)
+    segment.set_grid()
+
+    segment.L = []
+    for line in spectrum.L:
+        owner = bool(low <= line.x0 < high)
+        if owner or x[start] <= line.x0 <= x[end - 1]:
+            line = copy.deepcopy(line)
+            line.tile_owner = owner
+            segment.L.append(line)
+    return segment
+
+
+def store_segment(spectrum, segment, core_start, core_end, start, end, x=None):
+    r"""Copy the owned part of a fit segment into the full spectrum.
+
+    Parameters
+    ----------
+    spectrum : `robospect.spectra.spectrum`
+        Spectrum to update in place.
+    segment : `robospect.spectra.spectrum`
+        Fit segment, from `make_segment`.
+    core_start, core_end : `int`
+        Pixel range owned by the segment.
+    start, end : `int`
+        Pixel range of the segment, including the halo.
+    x : `np.ndarray`, optional
+        Array holding the corrected wavelengths, if any segment has
+        corrected them so far.
+
+    Returns
+    -------
+    L : `list` of `robospect.lines.line`
+        Lines owned by the segment.
+    x : `np.ndarray` or None
+        The corrected wavelengths.  This is allocated, as a copy of
+        `spectrum.x`, the first time a segment changes them.
+
+    Notes
+    -----
+    Each pixel is taken from the segment that owns it.  Catalog lines
+    are taken from the segment that owned their input wavelength, and
+    detected lines from the segment that owns their fit wavelength, so
+    a line is never reported twice.  The model arrays are written in
+    place, so memory mapped arrays stay on disk.  `spectrum.x` is not
+    changed, as the later segments are still read from it.
+    """
+    N = len(spectrum.x)
+    core = slice(core_start - start, core_end - start)
+    low = spectrum.x[core_start] if core_start > 0 else -np.inf
+    high = spectrum.x[core_end] if core_end < N else np.inf
+    for name in ('continuum', 'lines', 'alternate', 'error'):
+        values = getattr(spectrum, name)
+        if not isinstance(values, np.ndarray) or len(values) != N or not values.flags.writeable:
+            values = np.zeros(N)
+            setattr(spectrum, name, values)
+        values[core_start:core_end] = np.asarray(getattr(segment, name))[core]
+
+    corrected = np.asarray(segment.x)[core]
+    if x is not None or not np.array_equal(corrected, spectrum.x[core_start:core_end]):
+        # The segment has corrected the wavelength solution.
+        if x is None:
+            x = _copy_array(spectrum.x)
+        x[core_start:core_end] = corrected
+
+    L = []
+    for line in segment.L:
+        owner = line.__dict__.pop('tile_owner', None)
+        if owner is None:
+            owner = bool(low <= line.x0 < high)
+        if owner:
+            L.append(line)
+    return L, x
+
+
+def _copy_array(values):
+    """Copy an array, into a new file next to it if it is memory mapped."""
+    if isinstance(values, np.memmap) and values.filename is not None:
+        fd, path = tempfile.mkstemp(prefix="x.", dir=os.path.dirname(values.filename))
+        os.close(fd)
+        result = np.memmap(path, dtype=float, mode='w+', shape=values.shape)
+        for block in range(0, len(values), _COPY_BLOCK):
+            result[block:block + _COPY_BLOCK] = values[block:block + _COPY_BLOCK]
+        return result
+    return np.array(values, dtype=float)
+
+
+def _fit_segment(segment):
+    segment.fit()
+    return segment
+
+
+def fit_tiled(spectrum, tiles, workers=None, halo=None):
+    r"""Fit a spectrum as a set of overlapping segments in parallel.
+
+    Parameters
+    ----------
+    spectrum : `robospect.spectra.spectrum`
+        Configured spectrum to fit.  This is updated in place.
+    tiles : `int`
+        Number of segments.
+    workers : `int`, optional
+        Number of processes.  Defaults to the smaller of `tiles` and
+        the number of available processors.
+    halo : `float`, optional
+        Width added to each side of a segment.  Defaults to
+        `halo_width`.
+
+    Returns
+    -------
+    spectrum : `robospect.spectra.spectrum`
+        The fit spectrum.
+
+    Notes
+    -----
+    Every phase of `spectrum.fit` is run independently on each
+    segment, so models that measure a global quantity (such as the
+    radial velocity) measure it separately in each segment.  With the
+    boxcar models, the continuum and error match the monolithic fit
+    exactly, but the line parameters only agree to rounding: the
+    vectorized sums in the line fits depend on the alignment of the
+    segment arrays, so they may differ in the last bits.  Only
+    twice `workers` segments are held at once, and the results are
+    written into the existing model arrays, so memory mapped spectra
+    (see `io.read_ascii_spectrum_memmap`) are fit in bounded memory.
+    """
+    from robospect.executors import default_workers, process_context
+
+    log = logging.getLogger(__name__)
+    log.setLevel(getattr(spectrum, 'verbose', logging.NOTSET))
+
+    if halo is None:
+        halo = halo_width(spectrum)
+    if workers is None or workers < 1:
+        workers = default_workers()
+    plan = plan_tiles(spectrum, tiles, halo)
+    workers = max(min(workers, len(plan)), 1)
+    log.info(f"tiling: {len(plan)} segments, halo {halo:.2f}, {workers} workers")
+
+    segments = (make_segment(spectrum, start, end, core_start, core_end)
+                for core_start, core_end, start, end in plan)
+    L = []
+    x = None
+    if workers == 1:
+        for item, segment in zip(plan, segments):
+            owned, x = store_segment(spectrum, _fit_segment(segment), *item, x=x)
+            L.extend(owned)
+    else:
+        # Only a few segments are in flight at once, so the memory
+        # used is bounded by the segment size.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    mp_context=process_context()) as executor:
+            pending = collections.deque()
+            for item, segment in zip(plan, segments):
+                # Share the processors between the segments.
+                segment.workers = max(spectrum.workers // workers, 1)
+                segment.phase_workers = {phase: max(n // workers, 1)
+                                         for phase, n in spectrum.phase_workers.items()}
+                pending.append((item, executor.submit(_fit_segment, segment)))
+                del segment
+                if len(pending) >= 2 * workers:
+                    item, future = pending.popleft()
+                    owned, x = store_segment(spectrum, future.result(), *item, x=x)
+                    L.extend(owned)
+            while len(pending) > 0:
+                item, future = pending.popleft()
+                owned, x = store_segment(spectrum, future.result(), *item, x=x)
+                L.extend(owned)
+
+    if x is not None:
+        spectrum.x = x
+        spectrum.set_grid()
+    spectrum.L = sorted(L, key=lines.sortLines)
+    return spectrum
@@ -0,0 +1,318 @@
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+__all__ = ['WorkQueue', 'work']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    spectrum_file TEXT NOT NULL,
+    path_base TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    enqueued REAL,
+    claimed REAL,
+    heartbeat REAL,
+    finished REAL,
+    elapsed REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+
+def worker_name():
+    """Name identifying this process across nodes."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue():
+    r"""Queue of spectra to fit, shared by workers through a SQLite file.
+
+    Parameters
+    ----------
+    path : `str`
+        The queue database, created if needed.
+    stale : `float`, optional
+        Seconds without a heartbeat after which a claimed spectrum is
+        returned to the queue.
+    max_attempts : `int`, optional
+        Number of claims a spectrum may go stale before it is marked
+        failed.
+
+    Notes
+    -----
+    Each spectrum is a row with a `status` of `pending`, `claimed`,
+    `done` or `failed`.  Workers claim the oldest pending spectrum in
+    an immediate transaction, so only one worker can claim it, and
+    update its heartbeat while fitting.  Claims whose heartbeat is
+    older than `stale` are returned to the queue by the next claim, so
+    the spectra held by a worker that died are fit by another.  A
+    worker only updates a spectrum while it still holds the claim.
+
+    The database uses the default rollback journal, as the write-ahead
+    log needs shared memory that network filesystems do not provide.
+    Timestamps are wall clock times, so `stale` should be well above
+    any clock difference between the nodes.
+    """
+    def __init__(self, path, stale=300.0, max_attempts=3):
+        self.path = path
+        self.stale = float(stale)
+        self.max_attempts = int(max_attempts)
+        self.log = logging.getLogger("robospect.workqueue")
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+
+    def _connect(self):
+        return _Connection(sqlite3.connect(self.path, timeout=60.0, isolation_level=None))
+
+    def enqueue(self, spectrum_files, path_bases=None):
+        """Add spectra to the queue.
+
+        Parameters
+        ----------
+        spectrum_files : iterable of `str`
+            Spectra to fit.  Relative paths are made absolute, so
+            workers may run in other directories.
+        path_bases : iterable of `str`, optional
+            Output path base for each spectrum.
+
+        Returns
+        -------
+        count : `int`
+            Number of spectra added.
+        """
+        spectrum_files = [os.path.abspath(f) for f in spectrum_files]
+        if path_bases is None:
+            path_bases = [None] * len(spectrum_files)
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany("INSERT INTO jobs (spectrum_file, path_base, enqueued) VALUES (?, ?, ?)",
+                           [(f, p, now) for f, p in zip(spectrum_files, path_bases)])
+            db.execute("COMMIT")
+        return len(spectrum_files)
+
+    def _requeue_stale(self, db, now):
+        cutoff = now - self.stale
+        failed = db.execute("UPDATE jobs SET status = 'failed', finished = ?, "
+                            "error = 'Claim went stale too many times.' "
+                            "WHERE status = 'claimed' AND heartbeat < ? AND attempts >= ?",
+                            (now, cutoff, self.max_attempts)).rowcount
+        requeued = db.execute("UPDATE jobs SET status = 'pending', worker = NULL "
+                              "WHERE status = 'claimed' AND heartbeat < ?", (cutoff, )).rowcount
+        if failed or requeued:
+            self.log.warning(f"Requeued {requeued} and failed {failed} stale claims.")
+        return requeued
+
+    def requeue_stale(self):
+        """Return stale claims to the queue.
+
+        Returns
+        -------
+        count : `int`
+            Number of spectra returned to the queue.
+        """
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            requeued = self._requeue_stale(db, time.time())
+            db.execute("COMMIT")
+        return requeued
+
+    def claim(self, worker):
+        """Claim the next pending spectrum.
+
+        Parameters
+        ----------
+        worker : `str`
+            Name of the claiming worker.
+
+        Returns
+        -------
+        job : `dict` or None
+            The `id`, `spectrum_file` and `path_base` of the claimed
+            spectrum, or None if no spectrum is pending.
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self._requeue_stale(db, now)
+                row = db.execute("SELECT id, spectrum_file, path_base FROM jobs "
+                                 "WHERE status = 'pending' ORDER BY id LIMIT 1").fetchone()
+                if row is not None:
+                    db.execute("UPDATE jobs SET status = 'claimed', worker = ?, claimed = ?, "
+                               "heartbeat = ?, attempts = attempts + 1 WHERE id = ?",
+                               (worker, now, now, row[0]))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return {'id': row[0], 'spectrum_file': row[1], 'path_base': row[2]}
+
+    def heartbeat(self, job_id, worker):
+        """Record that a worker is still fitting a spectrum.
+
+        Returns
+        -------
+        held : `bool`
+            False if the claim was lost, as it went stale.
+        """
+        with self._connect() as db:
+            return db.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ? "
+                              "AND status = 'claimed'",
+                              (time.time(), job_id, worker)).rowcount == 1
+
+    def finish(self, job_id, worker, elapsed, error=None):
+        """Record the result of a claimed spectrum.
+
+        Parameters
+        ----------
+        job_id : `int`
+            The claimed spectrum.
+        worker : `str`
+            Name of the worker holding the claim.
+        elapsed : `float`
+            Time spent on the spectrum, in seconds.
+        error : `str`, optional
+            The error, if the spectrum could not be fit.
+
+        Returns
+        -------
+        held : `bool`
+            False if the claim was lost, and the result not recorded.
+        """
+        with self._connect() as db:
+            return db.execute("UPDATE jobs SET status = ?, finished = ?, elapsed = ?, error = ? "
+                              "WHERE id = ? AND worker = ? AND status = 'claimed'",
+                              ('done' if error is None else 'failed', time.time(), elapsed,
+                               error, job_id, worker)).rowcount == 1
+
+    def counts(self):
+        """Number of spectra in each state."""
+        with self._connect() as db:
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in ('pending', 'claimed', 'done', 'failed')}
+
+    def jobs(self):
+        """All spectra in the queue, as a list of `dict`."""
+        with self._connect() as db:
+            cursor = db.execute("SELECT * FROM jobs ORDER BY id")
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+
+class _Connection():
+    """Context manager that closes a sqlite3 connection."""
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, *args):
+        self.connection.close()
+
+
+def _heartbeat(queue, job_id, worker, interval, stop):
+    log = logging.getLogger("robospect.workqueue")
+    while not stop.wait(interval):
+        try:
+            if not queue.heartbeat(job_id, worker):
+                log.warning(f"{worker} lost its claim on job {job_id}.")
+                return
+        except sqlite3.Error as e:
+            log.warning(f"Heartbeat for job {job_id} failed: {e!r}")
+
+
+def work(config, queue, worker=None, heartbeat=30.0, wait=False, poll=10.0):
+    """Fit spectra from a work queue until it is empty.
+
+    Parameters
+    ----------
+    config : `robospect.config.Config`
+        Configuration used to read, fit, and write each spectrum.
+    queue : `WorkQueue`
+        The queue to take spectra from.
+    worker : `str`, optional
+        Name of this worker.  Defaults to the host name and process id.
+    heartbeat : `float`, optional
+        Seconds between heartbeats.
+    wait : `bool`, optional
+        Wait for more spectra when the queue is empty, instead of
+        returning.
+    poll : `float`, optional
+        Seconds between checks of an empty queue when waiting.
+
+    Returns
+    -------
+    counts : `dict`
+        Number of spectra this worker finished (`done`) and failed
+        (`failed`), and the time spent on them (`busy`).
+    """
+    from robospect.pipeline import Pipeline
+
+    if worker is None:
+        worker = worker_name()
+    log = logging.getLogger("robospect.workqueue")
+    counts = {'done': 0, 'failed': 0, 'busy': 0.0}
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            if not wait:
+                break
+            time.sleep(poll)
+            continue
+
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(queue, job['id'], worker, heartbeat, stop),
+                                name="robospect-heartbeat", daemon=True)
+        beat.start()
+        start = time.perf_counter()
+        error = None
+        try:
+            path_base = job['path_base']
+            if path_base is None:
+                path_base = Pipeline.path_base(config.path_base, job['spectrum_file'])
+            spectrum = config.read_spectrum(job['spectrum_file'])
+            config.fit_spectrum(spectrum)
+            config.write_results(spectrum, path_base=path_base)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            log.error(f"{job['spectrum_file']} failed: {error}")
+        finally:
+            stop.set()
+            beat.join()
+        elapsed = time.perf_counter() - start
+        queue.finish(job['id'], worker, elapsed, error=error)
+        counts['failed' if error else 'done'] += 1
+        counts['busy'] += elapsed
+        log.info(f"{job['spectrum_file']}: {'failed' if error else 'done'} in {elapsed:.2f}s")
+    config.wait_for_plots()
+    return counts
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#
+# This file is part of robospect.py.
+#
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Time the Humlicek W4 approximation against `scipy.special.wofz`.
+
+This is not run with the unit tests, as the timings depend on the
+machine:
+
+      > python3 tests/benchmark_humlicek.py [-n POINTS] [-r REPEATS]
+
+The Faddeeva function is timed on points in the line cores
+(|Re z| + Im z < 5.5, where W4 uses its two expensive regions), in
+the wings (up to |Re z| = 60), and across both, followed by the
+`humlicek` and `voigt` profiles and their derivatives on a line
+window.
+"""
+import argparse
+import time
+
+import numpy as np
+import scipy.special
+
+import robospect as RS
+from robospect.models.profile_shapes import humlicek_w4
+
+
+def best_time(func, *args, repeats=5):
+    """Return the shortest of `repeats` calls of `func(*args)`, in seconds."""
+    best = np.inf
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--points", type=int, default=400000,
+                        help="Number of points in each region.")
+    parser.add_argument("-r", "--repeats", type=int, default=5,
+                        help="Number of calls to take the fastest of.")
+    parsed = parser.parse_args(args)
+    N = parsed.points
+
+    rng = np.random.default_rng(31)
+    regions = {'core': (rng.uniform(-4.0, 4.0, N) + 1j * rng.uniform(0.0, 1.5, N)),
+               'wing': (rng.choice([-1.0, 1.0], N) * rng.uniform(5.5, 60.0, N) +
+                        1j * rng.uniform(0.0, 2.0, N)),
+               'both': (rng.uniform(-60.0, 60.0, N) + 1j * rng.uniform(0.0, 2.0, N))}
+
+    print(f"{'':20s} {'W4':>9s} {'wofz':>9s} {'ratio':>7s}")
+    for name, z in regions.items():
+        fast = best_time(humlicek_w4, z, repeats=parsed.repeats)
+        exact = best_time(scipy.special.wofz, z, repeats=parsed.repeats)
+        print(f"{'w(z) ' + name:20s} {fast:9.4f} {exact:9.4f} {exact / fast:7.2f}")
+
+    H = RS.models.profileFromName('humlicek')
+    V = RS.models.profileFromName('voigt')
+    x = np.linspace(4990.0, 5010.0, N)
+    Q = np.array([5000.0, 0.1, -0.3, 0.05])
+    fast = best_time(H.fdf, x, Q, repeats=parsed.repeats)
+    exact = best_time(V.fdf, x, Q, repeats=parsed.repeats)
+    print(f"{'profile fdf':20s} {fast:9.4f} {exact:9.4f} {exact / fast:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
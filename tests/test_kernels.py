@@ -0,0 +1,103 @@
+import unittest
+import os
+import numpy as np
+
+import robospect as RS
+
+TestDir = os.path.dirname(__file__)
+
+try:
+    import numba  # noqa: F401
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+def run_backends(func, *args):
+    results = []
+    for backend in ("numpy", "numba"):
+        RS.kernels.set_backend(backend)
+        try:
+            results.append(func(*args))
+        finally:
+            RS.kernels.set_backend("numpy")
+    return results
+
+
+@unittest.skipUnless(HAVE_NUMBA, "Numba is not available.")
+class Test_Kernel_Parity(unittest.TestCase):
+
+    def setUp(self):
+        self.spectra = [RS.read_ascii_spectrum(f"{TestDir}/data/{name}.spect")
+                        for name in ("goodred", "goodblue")]
+        self.lines = RS.read_ascii_linelist(f"{TestDir}/data/linelistjkh.in")
+
+    def test_window_median(self):
+        for S in self.spectra:
+            start, end = S.window_bounds(5.0)
+            np_result, nb_result = run_backends(RS.kernels.window_median_mad, S.y, start, end)
+            for a, b in zip(np_result, nb_result):
+                self.assertTrue(np.array_equal(a, b, equal_nan=True))
+
+            np_result, nb_result = run_backends(RS.kernels.window_median, S.y, start, end)
+            self.assertTrue(np.array_equal(np_result, nb_result, equal_nan=True))
+
+    def test_peak_runs(self):
+        for S in self.spectra:
+            SN = np.abs(S.y - np.median(S.y)) / 0.02
+            for threshold in (1.0, 3.0, 10.0):
+                np_result, nb_result = run_backends(RS.kernels.peak_runs, SN, threshold)
+                self.assertTrue(np.array_equal(np_result[0], nb_result[0]))
+                self.assertTrue(np.array_equal(np_result[1], nb_result[1]))
+
+    def test_gaussian(self):
+        for S in self.spectra:
+            for l in self.lines[::50]:
+                np_result, nb_result = run_backends(RS.kernels.gaussian, S.x, l.x0, 0.1, -0.3)
+                self.assertTrue(np.allclose(np_result, nb_result, rtol=1e-14, atol=0.0))
+
+    def test_half_widths(self):
+        for S in self.spectra:
+            temp = S.y - 1.0
+            for l in self.lines:
+                if l.x0 < S.min() + 2.0 or l.x0 > S.max() - 2.0:
+                    continue
+                center = S.index_from_wavelength(l.x0) - 1
+                start = S.index_from_wavelength(l.x0 - 1.0)
+                end = S.index_from_wavelength(l.x0 + 1.0, side='right')
+                np_result, nb_result = run_backends(RS.kernels.half_widths, S.x, temp,
+                                                    center, start, end, temp[center])
+                self.assertTrue(np.array_equal(np_result, nb_result, equal_nan=True))
+
+    def test_fit(self):
+        # The non-linear fits amplify last-bit differences in exp(),
+        # so compare the deterministic stages and the initial guesses.
+        outputs = []
+        for backend in ("numpy", "numba"):
+            C = RS.Config(["-F", "backend", backend, "-L", "name", "nlls",
+                           "--line_list", f"{TestDir}/data/linelistjkh.in",
+                           f"{TestDir}/data/goodred.spect"])
+            S = C.read_spectrum()
+            S.fit()
+            outputs.append((S.continuum, S.error,
+                            [np.array(l.pQ) for l in S.L]))
+        RS.kernels.set_backend("numpy")
+
+        for a, b in zip(outputs[0][:2], outputs[1][:2]):
+            self.assertTrue(np.array_equal(a, b, equal_nan=True))
+        self.assertEqual(len(outputs[0][2]), len(outputs[1][2]))
+        for a, b in zip(outputs[0][2], outputs[1][2]):
+            self.assertTrue(np.allclose(a, b, rtol=1e-12, atol=1e-14, equal_nan=True))
+
+
+class Test_Kernel_Backend(unittest.TestCase):
+
+    def test_set_backend(self):
+        self.assertEqual(RS.kernels.set_backend("numpy"), "numpy")
+        self.assertEqual(RS.kernels.get_backend(), "numpy")
+        with self.assertRaises(RuntimeError):
+            RS.kernels.set_backend("fortran")
+
+
+if __name__ == '__main__':
+    unittest.main()
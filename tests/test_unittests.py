@@ -1,5 +1,11 @@
 import unittest
+import unittest.mock
 import os
+import sys
+import subprocess
+import signal
+import time
+import tempfile
 import hashlib
 import pickle
 import numpy as np
@@ -29,6 +35,50 @@ class Test_Config_Methods(unittest.TestCase):
     def test_construct_spectra_class(self):
         pass
 
+    def test_registry(self):
+        for phase, name in RS.registry.list_models():
+            self.assertEqual(RS.registry.get_model(phase, name).modelName, name)
+        with self.assertRaises(RuntimeError):
+            RS.registry.get_model("continuum", "no_such_model")
+
+        # Models can be registered by import path, and are only
+        # imported when requested.
+        RS.registry.register("continuum", "alias", "robospect.models.all_null:continuum_null")
+        self.addCleanup(RS.registry._models.pop, ("continuum", "alias"), None)
+        self.assertIs(RS.registry.get_model("continuum", "alias"), RS.models.continuum_null)
+
+    def test_spectra_class_cache(self):
+        C = RS.Config(["-C", "name", "kcs", "-L", "name", "nlls"])
+        S = C.construct_spectra_class(**C.arg_dict)
+        T = C.construct_spectra_class(**C.arg_dict)
+        self.assertIs(type(S), type(T))
+
+        S.x = np.arange(10.0)
+        S.L = [RS.line(4.5, comment="test")]
+        U = pickle.loads(pickle.dumps(S))
+        self.assertIs(type(U), type(S))
+        self.assertTrue(np.array_equal(U.x, S.x))
+        self.assertEqual(U.L[0].comment, "test")
+        self.assertEqual(U.box_size, S.box_size)
+
+    def test_import_time(self):
+        # Plotting, scipy, the models, and the batch, cache and server
+        # modules should only be imported on use.
+        code = ("import sys, time; t = time.perf_counter(); import robospect; "
+                "t = time.perf_counter() - t; "
+                "print(t, ' '.join(m for m in ('matplotlib', 'scipy', 'multiprocessing', "
+                "'asyncio', 'socket', 'sqlite3', 'concurrent.futures', 'queue', "
+                "'robospect.models.line_mp_nlls', 'robospect.pipeline', 'robospect.tiling', "
+                "'robospect.server', 'robospect.cache', 'robospect.workqueue') "
+                "if m in sys.modules))")
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([os.path.join(TestDir, "..", "python")] + sys.path)
+        result = subprocess.run([sys.executable, "-c", code], env=env,
+                                capture_output=True, text=True, check=True)
+        elapsed, *loaded = result.stdout.split()
+        print(f"import robospect: {float(elapsed):.3f}s")
+        self.assertEqual(loaded, [])
+
 
 class Test_IO_Methods(unittest.TestCase):
 
@@ -40,6 +90,30 @@ class Test_IO_Methods(unittest.TestCase):
         print(hash_data_structure(lines))
         self.assertIsInstance(lines[0], RS.lines.line)
 
+    def test_read_linelist_cached(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = f"{tmp}/lines.in"
+            with open(f"{TestDir}/data/linelistjkh.in") as f, open(source, "w") as g:
+                g.write(f.read())
+            full = RS.read_ascii_linelist(source)
+
+            lines = RS.io.read_linelist_cached(source, 5000.0, 6000.0, cache_dir=f"{tmp}/cache")
+            expected = [l for l in full if 5000.0 <= l.x0 <= 6000.0]
+            self.assertEqual([(l.x0, l.comment, l.flags.value) for l in lines],
+                             [(l.x0, l.comment, l.flags.value) for l in expected])
+            self.assertEqual(len(os.listdir(f"{tmp}/cache")), 1)
+
+            # A new process reads the compiled cache; touching the
+            # file does not invalidate it, but changing it does.
+            RS.io.linelist._loaded.clear()
+            os.utime(source, ns=(0, 0))
+            self.assertEqual(len(RS.io.read_linelist_cached(source, cache_dir=f"{tmp}/cache")),
+                             len(full))
+            with open(source, "a") as g:
+                g.write("5500.0 test line\n")
+            lines = RS.io.read_linelist_cached(source, 5499.99, 5500.01, cache_dir=f"{tmp}/cache")
+            self.assertIn((5500.0, "test line"), [(l.x0, l.comment) for l in lines])
+
     def test_read_ascii_spectrum(self):
         spectrum = RS.read_ascii_spectrum(f"{TestDir}/data/goodblue.spect")
 
@@ -54,6 +128,220 @@ class Test_IO_Methods(unittest.TestCase):
     def test_write_ascii_catalog(self):
         pass
 
+    def test_envelope_indices(self):
+        x = np.linspace(4000.0, 5000.0, 100000)
+        y = np.random.normal(size=x.size)
+        y[5000:5010] = np.nan
+        bins = 300
+
+        index = RS.io.plots.envelope_indices(x, y, bins, 4000.0, 5000.0)
+        self.assertLess(len(index), 4 * bins + 1)
+        self.assertEqual(index[0], 0)
+        self.assertEqual(index[-1], x.size - 1)
+
+        # Every column keeps its extrema.
+        column = np.clip(((x - 4000.0) * (bins / 1000.0)).astype(int), 0, bins - 1)
+        for c in np.random.choice(bins, 20):
+            full = y[column == c]
+            kept = y[index][column[index] == c]
+            self.assertEqual(np.nanmin(full), np.nanmin(kept))
+            self.assertEqual(np.nanmax(full), np.nanmax(kept))
+
+    def test_plot_spectrum_decimate(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
+        S = RS.spectrum()
+        S.x = np.linspace(3000.0, 9000.0, 1000000)
+        S.continuum = 1.0 + 0.1 * np.sin(S.x / 300.0)
+        S.y = S.continuum + np.random.normal(scale=0.02, size=S.x.size)
+        S.y -= 0.5 * np.exp(-0.5 * ((S.x - 5000.0) / 0.1)**2)
+        S.lines = np.zeros_like(S.x)
+        S.error = 0.02 * np.ones_like(S.x)
+
+        images = []
+        with tempfile.TemporaryDirectory() as tmp:
+            for decimate in (False, True):
+                plt.figure()
+                RS.io.plots.plot_spectrum(S, min=4990.0, max=5010.0, errors=True,
+                                          decimate=decimate, output=f"{tmp}/{decimate}.png")
+                plt.close('all')
+                images.append(plt.imread(f"{tmp}/{decimate}.png"))
+        self.assertTrue(np.array_equal(images[0], images[1]))
+
+    def test_plot_lines(self):
+        C = RS.Config(["-C", "name", "null"])
+        S = C.construct_spectra_class(**C.arg_dict)
+        S.x = np.arange(4900, 5000, 0.01)
+        S.y = np.ones_like(S.x)
+        S.continuum = np.ones_like(S.x)
+        S.lines = np.zeros_like(S.x)
+        S.error = 0.01 * np.ones_like(S.x)
+        S.L = [RS.line(x0, Q=np.array([x0, 0.05, -0.1])) for x0 in np.arange(4905, 4995, 10.0)]
+        for l in S.L[:7]:
+            l.flags.set("SUPPLIED")
+        S.L[1].flags.set("FIT_CHISQ")
+        S.L[2].flags.set("FIT_FAIL")
+
+        self.assertEqual(len(RS.io.plots.select_lines(S, 'all')), 8)
+        self.assertEqual(len(RS.io.plots.select_lines(S, 'supplied')), 6)
+        self.assertEqual(len(RS.io.plots.select_lines(S, 'flagged')), 1)
+        self.assertEqual(len(RS.io.plots.select_lines(S, 'none')), 0)
+        # Only the plotted range of each line is sent to the renderer.
+        data = RS.io.plots.line_plot_data(S, which='all')
+        self.assertEqual(list(data.keys()), ['panels'])
+        self.assertLess(max(len(p[0][0]) for p in data['panels']), 100)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            job = RS.io.plots.plot_lines(S, output=f"{tmp}/lines.pdf", which='all',
+                                         background=True)
+            job.join()
+            self.assertEqual(job.exitcode, 0)
+            with open(f"{tmp}/lines.pdf", "rb") as f:
+                self.assertEqual(f.read().count(b"/Type /Page "), 2)
+
+    def test_result_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            args = [f"{TestDir}/data/goodblue.spect", "--line_list", f"{TestDir}/data/linelistjkh.in",
+                    "-L", "name", "null", "-F", "result_cache", tmp]
+            C = RS.Config(args)
+            S = C.read_spectrum()
+            C.fit_spectrum(S)
+            self.assertEqual((C.result_cache.hits, C.result_cache.misses), (0, 1))
+
+            T = C.read_spectrum()
+            C.fit_spectrum(T)
+            self.assertEqual(C.result_cache.hits, 1)
+            self.assertTrue(np.array_equal(S.continuum, T.continuum))
+            self.assertEqual([(l.x0, l.comment, l.flags.value) for l in S.L],
+                             [(l.x0, l.comment, l.flags.value) for l in T.L])
+            for a, b in zip(S.L, T.L):
+                self.assertTrue(np.array_equal(a.Q, b.Q))
+
+            # Output options do not change the key, but fit options do.
+            D = RS.Config(args + ["-F", "path_base", f"{tmp}/out", "-F", "plot_lines", "none"])
+            self.assertEqual(D.result_cache.key(D.read_spectrum(), D.arg_dict),
+                             C.result_cache.key(C.read_spectrum(), C.arg_dict))
+            D = RS.Config(args + ["-F", "chi_window", "5.0"])
+            self.assertNotEqual(D.result_cache.key(D.read_spectrum(), D.arg_dict),
+                                C.result_cache.key(C.read_spectrum(), C.arg_dict))
+
+            D = RS.Config(args + ["-F", "result_cache_bypass", "true"])
+            D.fit_spectrum(D.read_spectrum())
+            self.assertEqual((D.result_cache.hits, D.result_cache.misses), (0, 0))
+
+            # The least recently used result is evicted first.
+            D = RS.Config(args + ["-C", "name", "kcs"])
+            D.fit_spectrum(D.read_spectrum())
+            first = C.result_cache.key(C.read_spectrum(), C.arg_dict)
+            second = D.result_cache.key(D.read_spectrum(), D.arg_dict)
+            self.assertEqual(sorted(os.listdir(tmp)), sorted([f"{first}.npz", f"{second}.npz"]))
+            C.result_cache.max_size = os.path.getsize(f"{tmp}/{second}.npz")
+            self.assertEqual(C.result_cache.evict(), 1)
+            self.assertFalse(os.path.exists(f"{tmp}/{first}.npz"))
+            self.assertEqual(C.result_cache.size, C.result_cache.max_size)
+
+            # The results are plain data, and load without pickle.
+            with np.load(f"{tmp}/{second}.npz", allow_pickle=False) as data:
+                self.assertTrue(np.array_equal(data['x'], S.x))
+
+    def test_pipeline(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            C = RS.Config(["-L", "name", "null", "-I", "name", "null",
+                           "-F", "plot_lines", "none", "-P", f"{tmp}/"])
+            files = [f"{TestDir}/data/goodred.spect", f"{TestDir}/data/goodblue.spect",
+                     f"{tmp}/missing.spect"]
+            P = RS.Pipeline(C, read_depth=1, write_depth=1, fit_workers=2)
+            # The fit threads use threads, and share the processors.
+            self.assertEqual(P.executor, 'thread')
+            self.assertEqual(P.workers, max(RS.executors.default_workers() // 2, 1))
+            self.assertEqual(RS.Pipeline(RS.Config(["-F", "executor", "process", "-F", "workers", "8"]),
+                                         fit_workers=2).workers, 4)
+            stats = P.run(files)
+
+            self.assertEqual(stats['read'].count, 3)
+            self.assertEqual(stats['read'].failed, 1)
+            self.assertEqual(stats['fit'].count, 2)
+            self.assertEqual(stats['write'].count, 2)
+            self.assertEqual([(stage, f) for stage, f, e in P.failures],
+                             [('read', f"{tmp}/missing.spect")])
+            for name in ("goodred", "goodblue"):
+                self.assertTrue(os.path.exists(f"{tmp}/{name}.robolines"))
+                self.assertTrue(os.path.exists(f"{tmp}/{name}.robospect"))
+
+    def test_workqueue(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f"{tmp}/queue.db"
+            Q = RS.workqueue.WorkQueue(path, stale=0.0, max_attempts=2)
+            Q.enqueue(["a.spect"])
+            job = Q.claim("one")
+            self.assertEqual(job['spectrum_file'], os.path.abspath("a.spect"))
+            self.assertTrue(Q.heartbeat(job['id'], "one"))
+            # The claim is stale at once, so the next worker takes it.
+            self.assertEqual(Q.claim("two")['id'], job['id'])
+            self.assertFalse(Q.heartbeat(job['id'], "one"))
+            self.assertFalse(Q.finish(job['id'], "one", 1.0))
+            self.assertIsNone(Q.claim("three"))
+            self.assertEqual(Q.counts()['failed'], 1)
+
+            env = dict(os.environ)
+            env["PYTHONPATH"] = os.pathsep.join([os.path.join(TestDir, "..", "python")] + sys.path)
+            script = os.path.join(TestDir, "..", "bin", "rSpect.py")
+            path = f"{tmp}/batch.db"
+            files = [f"{TestDir}/data/goodred.spect", f"{TestDir}/data/goodblue.spect",
+                     f"{tmp}/missing.spect"]
+            subprocess.run([sys.executable, script, "--enqueue", path, *files, "-P", f"{tmp}/"],
+                           env=env, check=True, capture_output=True)
+            workers = [subprocess.Popen([sys.executable, script, "--worker", path,
+                                         "-L", "name", "null", "-I", "name", "null",
+                                         "-F", "plot_lines", "none"],
+                                        env=env, stderr=subprocess.DEVNULL)
+                       for worker in range(2)]
+            for worker in workers:
+                self.assertEqual(worker.wait(timeout=300), 0)
+
+            Q = RS.workqueue.WorkQueue(path)
+            self.assertEqual(Q.counts(), {'pending': 0, 'claimed': 0, 'done': 2, 'failed': 1})
+            jobs = Q.jobs()
+            self.assertEqual([j['attempts'] for j in jobs], [1, 1, 1])
+            self.assertIn("missing.spect", jobs[2]['error'])
+            for name in ("goodred", "goodblue"):
+                self.assertTrue(os.path.exists(f"{tmp}/{name}.robolines"))
+
+    def test_server(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            address = f"{tmp}/robospect.sock"
+            env = dict(os.environ)
+            env["PYTHONPATH"] = os.pathsep.join([os.path.join(TestDir, "..", "python")] + sys.path)
+            server = subprocess.Popen([sys.executable, os.path.join(TestDir, "..", "bin", "rSpect.py"),
+                                       "--serve", address, "--workers", "2", "-C", "name", "kcs"],
+                                      env=env, stderr=subprocess.DEVNULL)
+            try:
+                for attempt in range(600):
+                    if os.path.exists(address) or server.poll() is not None:
+                        break
+                    time.sleep(0.1)
+
+                x = np.linspace(5000.0, 5020.0, 2000)
+                y = 1.0 - 0.3 * np.exp(-0.5 * ((x - 5005.0) / 0.05)**2)
+                with RS.server.Client(address, timeout=60) as client:
+                    self.assertEqual(client.ping()['workers'], 2)
+                    response = client.fit({'x': x, 'y': y}, line_list=[5005.0])
+                    self.assertEqual(len(response['lines']), 1)
+                    self.assertAlmostEqual(response['lines'][0]['Q'][0], 5005.0, places=2)
+
+                    response = client.fit(f"{TestDir}/data/goodred.spect", args=["-L", "name", "null"],
+                                          line_list=f"{TestDir}/data/linelistjkh.in")
+                    self.assertGreater(len(response['lines']), 0)
+
+                    with self.assertRaises(RuntimeError):
+                        client.fit(f"{tmp}/missing.spect")
+            finally:
+                server.send_signal(signal.SIGINT)
+                server.wait(timeout=60)
+            self.assertFalse(os.path.exists(address))
+
 
 class Test_Lines(unittest.TestCase):
 
@@ -89,6 +377,86 @@ class Test_Spectra(unittest.TestCase):
     def test_update(self):
         pass
 
+    def test_index_from_wavelength(self):
+        rng = np.random.default_rng(19)
+        for grid, x in (("linear", np.arange(4900, 5000, 0.01)),
+                        ("log", np.exp(np.arange(np.log(4900), np.log(5000), 2e-6))),
+                        (None, np.sort(rng.uniform(4900, 5000, 1000)))):
+            S = RS.spectrum()
+            S.x = x
+            self.assertEqual(S.set_grid(), grid)
+
+            query = np.concatenate((x, rng.uniform(x[0] - 1.0, x[-1] + 1.0, 1000)))
+            for side in ("left", "right"):
+                self.assertTrue(np.array_equal(S.index_from_wavelength(query, side=side),
+                                               np.searchsorted(x, query, side=side)))
+                self.assertEqual(S.index_from_wavelength(x[10], side=side),
+                                 np.searchsorted(x, x[10], side=side))
+
+    def test_fit_tiled(self):
+        args = [f"{TestDir}/data/goodblue.spect", "--line_list", f"{TestDir}/data/linelistjkh.in",
+                "-L", "name", "nlls"]
+        C = RS.Config(args)
+        S = C.read_spectrum()
+        S.fit()
+
+        T = C.read_spectrum()
+        plan = RS.tiling.plan_tiles(T, 3, RS.tiling.halo_width(T))
+        self.assertEqual([p[0] for p in plan[1:]], [p[1] for p in plan[:-1]])
+        self.assertEqual((plan[0][0], plan[-1][1]), (0, len(T.x)))
+        RS.tiling.fit_tiled(T, 3, workers=2)
+
+        # The boxcar models only read inside the halo, so the result
+        # matches the monolithic fit.  Line fits may differ in the last
+        # bits, as vectorized sums depend on the alignment of the segment,
+        # and poorly constrained fits amplify that to about 1e-6.
+        self.assertTrue(np.array_equal(S.continuum, T.continuum))
+        self.assertTrue(np.array_equal(S.error, T.error))
+        self.assertEqual([(l.x0, l.comment) for l in S.L], [(l.x0, l.comment) for l in T.L])
+        for a, b in zip(S.L, T.L):
+            self.assertTrue(np.allclose(a.Q, b.Q, rtol=1e-4, atol=0.0))
+            self.assertFalse(hasattr(b, 'tile_owner'))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            D = RS.Config(args + ["-F", "out_of_core", tmp, "-F", "tile_size", "15000",
+                                  "-F", "tile_workers", "1"])
+            U = D.read_spectrum()
+            self.assertIsInstance(U.y, np.memmap)
+            self.assertFalse(U.x.flags.writeable)
+            self.assertTrue(np.array_equal(S.x, U.x))
+            D.fit_spectrum(U)
+            self.assertIsInstance(U.continuum, np.memmap)
+            self.assertTrue(np.array_equal(S.continuum, U.continuum))
+            self.assertEqual([(l.x0, l.comment) for l in S.L], [(l.x0, l.comment) for l in U.L])
+            self.assertEqual(len(os.listdir(tmp)), 1)
+            del U
+            self.assertEqual(len(os.listdir(tmp)), 0)
+
+        # Corrected wavelengths go to a new array, as the later
+        # segments are still read from the input.
+        T = C.read_spectrum()
+        x = np.array(T.x)
+        T.x.flags.writeable = False
+        segment = RS.tiling.make_segment(T, 0, 1000, 0, 900)
+        segment.x = segment.x + 0.5
+        L, corrected = RS.tiling.store_segment(T, segment, 0, 900, 0, 1000)
+        self.assertTrue(np.array_equal(T.x, x))
+        self.assertTrue(np.array_equal(corrected[:900], x[:900] + 0.5))
+        self.assertTrue(np.array_equal(corrected[900:], x[900:]))
+
+    def test_window_median(self):
+        rng = np.random.default_rng(19)
+        data = rng.normal(size=200)
+        start = np.clip(np.arange(200) - rng.integers(0, 10, 200), 0, None)
+        end = np.clip(np.arange(200) + rng.integers(0, 10, 200), None, 200)
+        median, mad = RS.kernels.window_median_mad(data, start, end)
+        for i in range(0, 200, 7):
+            window = data[start[i]:end[i]]
+            if len(window) == 0:
+                continue
+            self.assertEqual(median[i], np.median(window))
+            self.assertEqual(mad[i], np.median(np.abs(window - np.median(window))))
+
 
 class Test_Model_Methods(unittest.TestCase):
 
@@ -126,6 +494,132 @@ class Test_Model_Methods(unittest.TestCase):
         pass
 #        self.assertLess(np.nanmean(z_deviation), 1.0)
 
+    def test_continuum_boxcar_decimate(self):
+        x = np.arange(4900, 5000, 0.01)
+        y = 1.0 + 0.05 * np.sin(x / 20.0) + np.random.default_rng(50).normal(scale=0.01, size=x.size)
+
+        C = RS.Config(["-C", "name", "boxcar"])
+        S = C.construct_spectra_class(**C.arg_dict)
+        S.x = x
+        S.y = y
+        S.lines = np.zeros_like(x)
+        S.set_grid()
+        S.fit_continuum()
+        continuum = S.continuum.copy()
+        self.assertIsNone(S.continuum_deviation)
+
+        S.fit_continuum(decimate=0.05, decimate_check=1)
+        deviation = np.abs(S.continuum - continuum)
+        self.assertLess(np.max(deviation), 0.005)
+        self.assertGreater(S.continuum_deviation, 0.0)
+        self.assertLessEqual(S.continuum_deviation, np.max(deviation))
+
+        S.fit_continuum(decimate=0)
+        self.assertTrue(np.array_equal(S.continuum, continuum))
+        self.assertIsNone(S.continuum_deviation)
+
+        C = RS.Config(["-C", "name", "boxcar", "-C", "decimate", "0.05", "-V", "40"])
+        T = C.construct_spectra_class(**C.arg_dict)
+        self.assertEqual((T.decimate, T.decimate_check, T.box_size), (0.05, 10, 40.0))
+
+    def test_continuum_fused_boxcar(self):
+        rng = np.random.default_rng(49)
+        x = np.arange(4900, 5000, 0.05)
+        y = 1.0 + 0.001 * (x - 4950) + rng.normal(scale=0.01, size=x.size)
+
+        def fit(*args):
+            C = RS.Config(["-V", "40"] + list(args))
+            S = C.construct_spectra_class(**C.arg_dict)
+            S.x = x
+            S.y = y
+            S.lines = np.zeros_like(x)
+            S.set_grid()
+            S.fit_continuum()
+            S.fit_error()
+            return S
+
+        S = fit("-C", "name", "boxcar", "-N", "name", "boxcar")
+        T = fit("-C", "name", "fusedbox")
+        self.assertTrue(np.array_equal(S.continuum, T.continuum))
+        self.assertTrue(np.array_equal(S.error, T.error))
+        self.assertIsNone(T.continuum_mad)
+
+        S = fit("-C", "name", "boxcar")
+        T = fit("-C", "name", "fusedbox", "-C", "error", "mad")
+        self.assertTrue(np.array_equal(S.error, T.error))
+        self.assertIsNone(T.noise)
+        T = fit("-C", "name", "fusedbox", "-C", "error", "both", "-C", "noise_box_size", "10")
+        self.assertTrue(np.array_equal(S.error, T.continuum_mad))
+        self.assertIs(T.error, T.noise)
+
+        # A noise model would replace the fused estimate.
+        with self.assertRaises(RuntimeError):
+            RS.Config(["-C", "name", "fusedbox", "-N", "name", "boxcar"])
+
+        # The one sweep kernel matches the separate kernels, for any
+        # noise windows.
+        start, end = T.window_bounds(7.0)
+        end = np.clip(end, None, len(x) - 1)
+        noise_start = np.clip(start[::-1] - 3, 0, None)
+        noise_end = np.clip(noise_start + 100, None, len(x))
+        median, mad = RS.kernels.window_median_mad(y, start, end)
+        noise = RS.kernels.window_median(np.abs(y - median), noise_start, noise_end)
+        RS.kernels.BLOCK_ELEMENTS, blockElements = 1000, RS.kernels.BLOCK_ELEMENTS
+        try:
+            for backend in ("numpy", "numba"):
+                result = RS.kernels.window_continuum_noise(y, start, end, noise_start, noise_end,
+                                                           backend=backend)
+                self.assertTrue(np.array_equal(result[0], median, equal_nan=True))
+                self.assertTrue(np.array_equal(result[1], mad, equal_nan=True))
+                self.assertTrue(np.array_equal(result[2], noise, equal_nan=True))
+        finally:
+            RS.kernels.BLOCK_ELEMENTS = blockElements
+
+        # The backend belongs to each spectrum, and does not change the default.
+        U = fit("-C", "name", "fusedbox", "-F", "backend", "numba")
+        self.assertEqual(U.backend, RS.kernels.resolve_backend("numba"))
+        self.assertEqual(RS.kernels.get_backend(), "numpy")
+        self.assertIsNone(S.backend)
+        self.assertTrue(np.array_equal(U.continuum, fit("-C", "name", "fusedbox").continuum))
+
+    def test_continuum_kcs(self):
+        L_truth = []
+        L_truth.append( RS.line(4925.0, 3, Q=np.array([4925.03, 0.05, -.35])) )
+        L_truth.append( RS.line(4945.0, 3, Q=np.array([4945.03, 0.07, -.40])) )
+
+        G = RS.profile_shapes.gaussian()
+        for kernel in ("boxcar", "gaussian"):
+            C = RS.Config(["-C", "name", "kcs", "-C", "kernel", kernel])
+            S = C.construct_spectra_class()
+            S.x = np.arange(4900, 5000, 0.01)
+            S.y = np.ones_like(S.x) + np.random.normal(loc=0.0, scale=0.01, size=S.x.size)
+            for l in L_truth:
+                S.y += G(S.x, l.Q)
+            S.lines = np.zeros_like(S.x)
+
+            S.fit_continuum()
+            self.assertLess(np.max(np.abs(S.continuum - 1.0)), 0.005)
+            self.assertLess(np.abs(np.median(S.error) - 0.01), 0.002)
+
+    def test_continuum_bspline(self):
+        L_truth = []
+        L_truth.append( RS.line(4925.0, 3, Q=np.array([4925.03, 0.05, -.35])) )
+        L_truth.append( RS.line(4945.0, 3, Q=np.array([4945.03, 0.07, -.40])) )
+
+        G = RS.profile_shapes.gaussian()
+        C = RS.Config(["-C", "name", "bspline"])
+        S = C.construct_spectra_class()
+        S.x = np.arange(4900, 5000, 0.01)
+        truth = 1.0 + 0.1 * np.sin((S.x - 4900) / 15.0)
+        S.y = truth + np.random.normal(loc=0.0, scale=0.01, size=S.x.size)
+        for l in L_truth:
+            S.y += G(S.x, l.Q)
+        S.lines = np.zeros_like(S.x)
+
+        S.fit_continuum()
+        self.assertLess(np.max(np.abs(S.continuum - truth)), 0.01)
+        self.assertLess(np.abs(np.median(S.error * S.continuum) - 0.01), 0.002)
+
     def test_detection_naive(self):
         L_truth = []
         L_truth.append( RS.line(4925.0, 3, Q=np.array([4925.03, 0.05, -.15])) )
@@ -141,6 +635,55 @@ class Test_Model_Methods(unittest.TestCase):
             print(l)
         pass
 
+    def test_peak_runs(self):
+        SN = np.array([0.0, 4.0, 5.0, 4.0, 1.0, 3.0, 6.0, np.nan, 6.0, 0.0, 4.0])
+        peaks, values = RS.kernels.peak_runs(SN, 3.0)
+
+        # The final run never closes, and so is not reported.
+        self.assertEqual(list(peaks), [2, 6])
+        self.assertEqual(list(values), [5.0, 6.0])
+
+    def test_detection_naive_known_lines(self):
+        L_truth = []
+        L_truth.append( RS.line(4925.0, 3, Q=np.array([4925.03, 0.05, -.15])) )
+        L_truth.append( RS.line(4945.0, 3, Q=np.array([4945.03, 0.07, -.17])) )
+
+        G = RS.profile_shapes.gaussian()
+        S = self.spectrum_sim(lines=L_truth, func=G)
+        S.error = 0.01 * np.ones_like(S.x)
+        S.L = [RS.line(4945.03)]
+
+        S.fit_detection()
+        x0 = np.array([l.x0 for l in S.L])
+        self.assertTrue(np.all(np.diff(x0) >= 0))
+        self.assertTrue(np.any(np.abs(x0 - 4925.03) < 0.05))
+        self.assertEqual(np.sum(np.abs(x0 - 4945.03) < 0.05), 1)
+
+    def test_detection_matched(self):
+        L_truth = []
+        L_truth.append( RS.line(4925.0, 3, Q=np.array([4925.03, 0.05, -.15])) )
+        L_truth.append( RS.line(4945.0, 3, Q=np.array([4945.03, 0.30, -.03])) )
+
+        G = RS.profile_shapes.gaussian()
+        C = RS.Config(["-D", "name", "matched"])
+        S = C.construct_spectra_class()
+        S.x = np.arange(4900, 5000, 0.01)
+        S.y = np.ones_like(S.x) + np.random.default_rng(27).normal(loc=0.0, scale=0.01, size=S.x.size)
+        for l in L_truth:
+            S.y += G(S.x, l.Q)
+        S.continuum = np.ones_like(S.x)
+        S.error = 0.01 * np.ones_like(S.x)
+
+        S.fit_detection(widths="2,5,10,30")
+        x0 = np.array([l.x0 for l in S.L])
+        for truth in L_truth:
+            match = np.argmin(np.abs(x0 - truth.Q[0]))
+            self.assertLess(np.abs(x0[match] - truth.Q[0]), 0.05)
+            self.assertLess(S.L[match].Q[2], 0.0)
+        # The broad line is seeded with a broad width.
+        match = np.argmin(np.abs(x0 - 4945.03))
+        self.assertGreater(S.L[match].Q[1], 0.1)
+
     def test_line_gauss_guess(self):
         L_truth = []
         L_truth.append( RS.line(4925.0, 3, Q=np.array([4925.03, 0.05, -.15])) )
@@ -188,6 +731,187 @@ class Test_Model_Methods(unittest.TestCase):
             print(l)
         pass
 
+    def test_line_mp_nlls_budget(self):
+        G = RS.profile_shapes.gaussian()
+        x = np.arange(4900, 5000, 0.01)
+        y = np.ones_like(x) + np.random.default_rng(45).normal(scale=0.01, size=x.size)
+        for center in (4925.0, 4935.0, 4945.0, 4955.0):
+            y += G(x, np.array([center + 0.03, 0.05, -0.15]))
+
+        def fit(*args):
+            C = RS.Config(["-C", "name", "null", "-L", "nProc", "2"] + list(args))
+            S = C.construct_spectra_class(**C.arg_dict)
+            S.x = x
+            S.y = y
+            S.continuum = np.ones_like(x)
+            S.error = 0.01 * np.ones_like(x)
+            # The first line is outside the spectrum, and is not fit.
+            S.L = [RS.line(x0, 3) for x0 in (4800.0, 4925.0, 4935.0, 4945.0, 4955.0)]
+            S.fit_initial()
+            S.line_update()
+            initial = [np.array(l.Q) for l in S.L]
+            S.fit_lines()
+            return S, initial
+
+        S, initial = fit("-L", "name", "nlls")
+        T, initial = fit("-L", "name", "mp_nlls")
+        self.assertTrue(T.L[0].flags.test("FIT_BOUND"))
+        for a, b in zip(S.L[1:], T.L[1:]):
+            self.assertTrue(np.array_equal(a.Q, b.Q))
+            self.assertLess(abs(b.Q[0] - b.x0 - 0.03), 0.01)
+            self.assertGreater(b.nfev, 0)
+
+        T, initial = fit("-L", "name", "mp_nlls", "-L", "maxfev", "3")
+        for l, Q in zip(T.L[1:], initial[1:]):
+            self.assertTrue(l.flags.test("FIT_BUDGET"))
+            self.assertTrue(np.array_equal(l.Q, Q))
+            # The next fit is scheduled with the evaluations used.
+            self.assertEqual(l.nfev, 3)
+
+        T, initial = fit("-L", "name", "mp_nlls", "-L", "timeout", "0")
+        for l, Q in zip(T.L[1:], initial[1:]):
+            self.assertTrue(l.flags.test("FIT_BUDGET"))
+            self.assertGreater(l.nfev, 0)
+
+        # Workers that were given no fits are reported as well.
+        T, initial = fit("-L", "name", "mp_nlls", "-L", "executor", "thread", "-L", "workers", "8")
+        self.assertEqual(len(T.utilization), 8)
+        self.assertEqual(T.utilization[4:], [0.0] * 4)
+        self.assertEqual(T.utilization, sorted(T.utilization, reverse=True))
+
+        # The fixed mean fallback converges within a budget the full
+        # fit exceeds.
+        T, initial = fit("-L", "name", "mp_nlls", "-L", "maxfev", "30", "-L", "fallback", "fixed_mean")
+        for l, Q in zip(T.L[1:], initial[1:]):
+            self.assertTrue(l.flags.test("FIT_BUDGET"))
+            self.assertEqual(l.Q[0], Q[0])
+            self.assertFalse(np.array_equal(l.Q, Q))
+
+    def test_line_mp_nlls_schedule(self):
+        from robospect.models.line_mp_nlls import _schedule
+
+        costs = [1.0, 50.0, 2.0, 1.0, 30.0, 1.0, 3.0, 2.0, 1.0, 1.0]
+        chunks = _schedule(list(range(len(costs))), costs, 2)
+        # Largest fits first, each alone; cheap fits are batched.
+        self.assertEqual(sorted(sum(chunks, [])), list(range(len(costs))))
+        self.assertEqual(chunks[:2], [[1], [4]])
+        order = [costs[i] for i in sum(chunks, [])]
+        self.assertEqual(order, sorted(costs, reverse=True))
+        self.assertLess(len(chunks), len(costs))
+
+    def test_executors(self):
+        G = RS.profile_shapes.gaussian()
+        x = np.arange(4900, 4960, 0.02)
+        y = np.ones_like(x) + np.random.default_rng(47).normal(scale=0.01, size=x.size)
+        for center in (4915.0, 4925.0, 4935.0, 4945.0):
+            y += G(x, np.array([center + 0.03, 0.05, -0.15]))
+
+        def fit(*args):
+            C = RS.Config(["-C", "name", "parbox", "-L", "name", "mp_nlls"] + list(args))
+            S = C.construct_spectra_class(**C.arg_dict)
+            S.x = x
+            S.y = y
+            S.lines = np.zeros_like(x)
+            S.continuum = np.ones_like(x)
+            S.error = 0.01 * np.ones_like(x)
+            S.L = [RS.line(x0, 3) for x0 in (4915.0, 4925.0, 4935.0, 4945.0)]
+            S.fit_continuum()
+            S.fit_initial()
+            S.line_update()
+            S.fit_lines()
+            return S
+
+        S = fit("-F", "executor", "serial")
+        self.assertEqual(S.workers, RS.executors.default_workers())
+        for args in (["-F", "executor", "thread", "-F", "workers", "2"],
+                     ["-F", "workers", "2"],
+                     ["-F", "executor", "serial", "-L", "executor", "freethread", "-L", "workers", "2"]):
+            T = fit(*args)
+            self.assertTrue(np.array_equal(S.continuum, T.continuum))
+            for a, b in zip(S.L, T.L):
+                self.assertTrue(np.array_equal(a.Q, b.Q))
+
+        T = fit("-F", "executor", "serial", "-C", "executor", "thread")
+        self.assertEqual(T.phase_executors, {'continuum': 'thread'})
+        self.assertIsInstance(T.pool('line'), RS.executors.SerialPool)
+        with self.assertRaises(RuntimeError):
+            RS.Config(["-F", "executor", "gpu"])
+        # Worker processes are never forked from a threaded caller.
+        self.assertNotEqual(RS.executors.process_context().get_start_method(), 'fork')
+
+        # The per-phase worker counts hold through a full fit, which
+        # passes the fitting parameters to every phase.
+        C = RS.Config(["-C", "name", "parbox", "-C", "workers", "2", "-L", "name", "mp_nlls",
+                       "-L", "nProc", "3", "-F", "executor", "thread", "-D", "name", "null"])
+        T = C.construct_spectra_class(**C.arg_dict)
+        T.x = x
+        T.y = y
+        T.lines = np.zeros_like(x)
+        T.continuum = np.ones_like(x)
+        T.alternate = np.zeros_like(x)
+        T.error = 0.01 * np.ones_like(x)
+        T.set_grid()
+        T.L = [RS.line(x0, 3) for x0 in (4915.0, 4925.0, 4935.0, 4945.0)]
+        calls = []
+        get_pool = RS.executors.get_pool
+        with unittest.mock.patch.object(RS.executors, 'get_pool',
+                                        side_effect=lambda *a: calls.append(a) or get_pool(*a)):
+            T.fit()
+        self.assertEqual(set(calls), {('thread', 2), ('thread', 3)})
+
+    def test_repair_rv(self):
+        velocity = 37.3
+        centers = np.arange(4905.0, 4995.0, 1.7)
+        shift = 1.0 + velocity / 299792.458
+
+        G = RS.profile_shapes.gaussian()
+        C = RS.Config(["--measure_radial_velocity", "--radial_velocity_range", "200"])
+        S = C.construct_spectra_class(**C.arg_dict)
+        S.x = np.arange(4900, 5000, 0.01)
+        S.y = 1.0 + np.random.normal(loc=0.0, scale=0.01, size=S.x.size)
+        for c in centers:
+            S.y += G(S.x, np.array([c * shift, 0.05, -0.3]))
+        S.continuum = np.ones_like(S.x)
+        S.L = [RS.line(c) for c in centers]
+
+        S.fit_repair()
+        self.assertLess(np.abs(S.velocity - velocity), 0.5)
+        self.assertTrue(np.allclose([l.x0 for l in S.L], centers * shift, rtol=2e-6))
+
+        # The list is already corrected, so only a small residual remains.
+        S.fit_repair()
+        self.assertLess(np.abs(S.velocity - velocity), 0.5)
+
+    def test_repair_rv_config(self):
+        C = RS.Config(["-R", "name", "rv", "-R", "velocity", "12.5",
+                       "-R", "velocity_range", "123"])
+        S = C.construct_spectra_class(**C.arg_dict)
+        self.assertEqual(S.velocity, 12.5)
+        self.assertEqual(S.velocity_range, 123.0)
+        self.assertFalse(S.measure)
+
+    def test_repair_wavelength(self):
+        def truth(x):
+            return 0.02 + 4e-4 * (x - 4900.0) - 1e-3 * np.clip(x - 4950.0, 0.0, None)
+
+        C = RS.Config(["-R", "name", "wavelength", "-R", "segments", "2"])
+        S = C.construct_spectra_class(**C.arg_dict)
+        S.x = np.arange(4900, 5000, 0.01)
+        x = np.copy(S.x)
+
+        centers = np.linspace(4905.0, 4995.0, 80)
+        S.L = [RS.line(c, Q=np.array([c + truth(c) + np.random.normal(scale=0.002), 0.05, -0.2]))
+               for c in centers]
+        # Misidentified lines should be rejected.
+        S.L[3].Q[0] += 0.5
+        S.L[10].Q[0] -= 0.7
+
+        S.fit_repair()
+        self.assertLess(np.max(np.abs(S.offset(x) - truth(x))), 0.003)
+        self.assertTrue(np.allclose(S.x, x - S.offset(x)))
+        self.assertFalse(S.L[3].flags.test("WAVELENGTH_FIT"))
+        self.assertTrue(S.L[4].flags.test("WAVELENGTH_FIT"))
+
     def test_noise_boxcar(self):
         pass
 
@@ -204,7 +928,35 @@ class Test_Profile_Methods(unittest.TestCase):
         pass
 
     def test_voigt(self):
-        pass
+        G = RS.profile_shapes.gaussian()
+        V = RS.profile_shapes.voigt()
+        x = np.linspace(4999.0, 5001.0, 201)
+
+        # eta = 0 reproduces the gaussian profile.
+        self.assertLess(np.max(np.abs(V.f(x, [5000.0, 0.1, -0.3]) - G.f(x, [5000.0, 0.1, -0.3]))), 1e-12)
+
+        Q = np.array([5000.0, 0.1, -0.3, 0.05])
+        f, *dfdQ = V.fdf(x, Q)
+        for k in range(4):
+            dQ = np.zeros(4)
+            dQ[k] = 1e-7
+            numeric = (V.f(x, Q + dQ) - V.f(x, Q - dQ)) / 2e-7
+            self.assertLess(np.max(np.abs(numeric - dfdQ[k])), 1e-5)
+
+    def test_humlicek(self):
+        import scipy.special
+
+        x, y = np.meshgrid(np.linspace(-60, 60, 1201),
+                           np.concatenate(([0.0], np.logspace(-6, 2, 200))))
+        z = x + 1j * y
+        W = scipy.special.wofz(z)
+        self.assertLess(np.max(np.abs(RS.profile_shapes.humlicek_w4(z) - W) / np.abs(W)), 1e-4)
+
+        H = RS.models.profileFromName('humlicek')
+        V = RS.models.profileFromName('voigt')
+        x = np.linspace(4999.0, 5001.0, 201)
+        Q = np.array([5000.0, 0.1, -0.3, 0.05])
+        self.assertLess(np.max(np.abs(H.f(x, Q) - V.f(x, Q))), 1e-4 * abs(Q[2]))
 
     def test_skewgauss(self):
         pass